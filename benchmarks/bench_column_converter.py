@@ -0,0 +1,59 @@
+import argparse
+import time
+import warnings
+
+import pandas as pd
+
+from benchmarks.synthetic import generate_admissions
+from custom_transformers import preprocessor, preprocessor_redeploy
+
+
+# Legacy vs compiled ColumnConverter on synthetic admissions.
+#
+#   python -m benchmarks.bench_column_converter --rows 100000 10000000 --legacy-max-rows 1000000
+#
+# The legacy transformer is only timed up to --legacy-max-rows (it needs several
+# copies of the frame in memory); the compiled output is checked against it
+# wherever both ran.
+
+
+def _time(func, df, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = func(df)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 10000000])
+    parser.add_argument('--legacy-max-rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    print('%-24s %10s %12s %12s %8s' % ('converter', 'rows', 'legacy [s]', 'compiled [s]', 'speedup'))
+    for rows in args.rows:
+        df = generate_admissions(rows)
+        repeat = args.repeat if rows <= args.legacy_max_rows else 1
+        for module in [preprocessor, preprocessor_redeploy]:
+            compiled, compiled_out = _time(module.ColumnConverter(compiled=True).transform, df, repeat)
+            legacy = None
+            if rows <= args.legacy_max_rows:
+                legacy, legacy_out = _time(module.ColumnConverter().transform, df, repeat)
+                pd.testing.assert_frame_equal(legacy_out, compiled_out, check_exact=True)
+                del legacy_out
+            del compiled_out
+            print('%-24s %10d %12s %12.3f %8s' % (module.__name__.split('.')[-1],
+                                                  rows,
+                                                  '-' if legacy is None else '%.3f' % legacy,
+                                                  compiled,
+                                                  '-' if legacy is None else '%.1fx' % (legacy / compiled)))
+        del df
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import time
+import warnings
+
+import numpy as np
+
+from benchmarks.pipelines import build_pipeline
+from benchmarks.synthetic import generate_admissions, generate_target
+from custom_transformers.compiled_forest import CompiledForest
+
+
+# RandomForestClassifier.predict_proba vs CompiledForest on the model input.
+#
+#   python -m benchmarks.bench_forest --n-estimators 1000 --batch-sizes 1 10 100 1000
+#
+# Batch size 1 reports the p50 latency of single observations (and of the
+# single row path of the compiled forest), bigger batches report rows/s.
+
+
+def _timings(func, batches):
+    timings = []
+    for batch in batches:
+        start = time.perf_counter()
+        func(batch)
+        timings.append(time.perf_counter() - start)
+    return np.array(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--n-estimators', type=int, default=1000)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    df = generate_admissions(args.rows)
+    pipeline = build_pipeline(n_estimators=args.n_estimators).fit(df, generate_target(df))
+    model = pipeline.steps[-1][1]
+    X = np.asarray(pipeline[:-1].transform(df.iloc[:max(args.batch_sizes) * args.repeat]), dtype=np.float32)
+
+    start = time.perf_counter()
+    forest = CompiledForest.from_model(pipeline)
+    print('compiled %d trees (%d nodes) in %.2f s' % (forest.n_trees, len(forest.feature), time.perf_counter() - start))
+    diff = np.abs(forest.predict_proba(X) - model.predict_proba(X)).max()
+    print('max |proba difference| %.3g' % diff)
+
+    print('%8s %16s %16s %16s' % ('batch', 'sklearn', 'compiled', 'compiled row'))
+    for size in args.batch_sizes:
+        batches = [X[i * size:(i + 1) * size] for i in range(args.repeat)]
+        sklearn = _timings(model.predict_proba, batches)
+        compiled = _timings(forest.predict_proba, batches)
+        if size == 1:
+            row = _timings(forest.predict_proba_row, [batch[0] for batch in batches])
+            print('%8d %13.3f ms %13.3f ms %13.3f ms  (p50)' % (size, np.median(sklearn) * 1000,
+                                                               np.median(compiled) * 1000, np.median(row) * 1000))
+        else:
+            print('%8d %12.0f r/s %12.0f r/s %16s' % (size, size / np.median(sklearn), size / np.median(compiled), '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import time
+import warnings
+
+import pandas as pd
+
+from benchmarks.pipelines import build_pipeline
+from benchmarks.synthetic import generate_admissions, generate_target
+from custom_transformers.row_mode import RowPipeline
+
+
+# Single observation latency, one-row DataFrame path vs RowPipeline.
+#
+#   python -m benchmarks.bench_row_mode --rows 100000
+#
+# Fits the initial deployment and redeploy pipelines on synthetic admissions,
+# checks row mode against the DataFrame path on the whole training set and
+# times the feature vector (everything before the model) per observation.
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--n-estimators', type=int, default=100)
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    df = generate_admissions(args.rows)
+    y = generate_target(df)
+    observations = df.iloc[:args.samples].to_dict('records')
+
+    print('%-10s %10s %14s %14s %8s' % ('pipeline', 'verified', 'frame [ms]', 'row mode [ms]', 'speedup'))
+    for redeploy in [False, True]:
+        pipeline = build_pipeline(redeploy=redeploy, n_estimators=args.n_estimators, n_jobs=1).fit(df, y)
+        row_pipeline = RowPipeline(pipeline)
+        verified = row_pipeline.verify(df)
+
+        features = pipeline[:-1]
+        start = time.perf_counter()
+        for observation in observations[:200]:
+            features.transform(pd.DataFrame([observation]))
+        frame = (time.perf_counter() - start) / 200 * 1000
+
+        start = time.perf_counter()
+        for observation in observations:
+            row_pipeline.transform(observation)
+        row = (time.perf_counter() - start) / len(observations) * 1000
+
+        print('%-10s %10d %14.3f %14.4f %7.0fx' % ('redeploy' if redeploy else 'initial', verified, frame, row, frame / row))
+
+
+if __name__ == '__main__':
+    main()
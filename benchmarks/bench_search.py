@@ -0,0 +1,75 @@
+import argparse
+import os
+import time
+import warnings
+
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import GridSearchCV
+
+from benchmarks.pipelines import build_pipeline
+from benchmarks.synthetic import generate_admissions, generate_target
+from custom_transformers.search import SharedHalvingSearchCV
+
+
+# GridSearchCV vs SharedHalvingSearchCV (budget n_estimators) on the model
+# input of the deployed pipeline, with the same cores:
+#
+#   python -m benchmarks.bench_search --rows 20000 --n-jobs 4
+#
+# The grid is the one of "Redeploy.ipynb" ('auto' is 'sqrt' since it was
+# removed from the forests), with n_estimators as the halving budget. Reported:
+# wall time of both searches, their best parameters and scores, and where the
+# halving winner ranks among the grid search candidates at full budget.
+
+parameters = {
+    'max_depth': [2, 5, 10],
+    'max_features': ['sqrt', 'log2'],
+    'class_weight': ['balanced'],
+    'criterion': ['gini', 'entropy'],
+    'bootstrap': [True, False],
+    'min_samples_split': [2, 5, 10]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--n-estimators', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--n-jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--cv', type=int, default=5)
+    parser.add_argument('--skip-grid', action='store_true', help='only run the halving search')
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    df = generate_admissions(args.rows)
+    y = generate_target(df).to_numpy()
+    X = build_pipeline(n_estimators=1)[:-1].fit_transform(df, y)
+    n_candidates = int(np.prod([len(values) for values in parameters.values()]))
+    print('model input %s, %d candidates x %d folds' % (X.shape, n_candidates, args.cv))
+
+    start = time.perf_counter()
+    halving = SharedHalvingSearchCV(RandomForestClassifier(random_state=42), parameters,
+                                    resource='n_estimators', max_resources=max(args.n_estimators),
+                                    cv=args.cv, scoring='f1', n_jobs=args.n_jobs).fit(X, y)
+    halving_time = time.perf_counter() - start
+    print('halving: %.1f s, rounds %s with budgets %s, best %.4f %s'
+          % (halving_time, halving.n_candidates_, halving.n_resources_, halving.best_score_, halving.best_params_))
+    if args.skip_grid:
+        return
+
+    start = time.perf_counter()
+    grid = GridSearchCV(RandomForestClassifier(random_state=42, n_jobs=1),
+                        dict(parameters, n_estimators=args.n_estimators),
+                        cv=args.cv, scoring='f1', n_jobs=args.n_jobs).fit(X, y)
+    grid_time = time.perf_counter() - start
+    print('grid:    %.1f s, best %.4f %s' % (grid_time, grid.best_score_, grid.best_params_))
+
+    winner = dict(halving.best_params_, n_estimators=max(args.n_estimators))
+    index = grid.cv_results_['params'].index(winner)
+    print('halving winner in the grid: rank %d of %d, score %.4f; halving took %.0f%% of the grid search time'
+          % (grid.cv_results_['rank_test_score'][index], len(grid.cv_results_['params']),
+             grid.cv_results_['mean_test_score'][index], 100 * halving_time / grid_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import argparse
+import asyncio
+import collections
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import generate_admissions
+
+
+# Load test of serving.server on a model bundle:
+#
+#   python -m benchmarks.bench_server /tmp/bundle --concurrency 64 --duration 10 --workers 2
+#
+# For every configuration a server process is started and --concurrency
+# keep-alive clients send synthetic observations back to back for --duration
+# seconds (after a short warm up). Reported per configuration: requests/s,
+# p50/p99 latency, response statuses and the mean batch size the server formed.
+#
+#   per_request_frame   --mode frame --max-batch 1, a one row DataFrame through the
+#                       pipeline per request (how the app scores today)
+#   per_request_row     --mode row --max-batch 1
+#   batched_row         --mode row with --max-batch / --max-wait-ms
+#   batched_frame       --mode frame with --max-batch / --max-wait-ms
+
+CONFIGS = {'per_request_frame': ['--mode', 'frame', '--max-batch', '1'],
+           'per_request_row': ['--mode', 'row', '--max-batch', '1'],
+           'batched_row': ['--mode', 'row'],
+           'batched_frame': ['--mode', 'frame']}
+
+
+async def _request(reader, writer, method, path, body=b''):
+    writer.write(b'%s %s HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                 % (method, path, len(body)) + body)
+    head = await reader.readuntil(b'\r\n\r\n')
+    length = 0
+    for line in head.split(b'\r\n'):
+        if line.lower().startswith(b'content-length:'):
+            length = int(line.split(b':', 1)[1])
+    return int(head[9:12]), await reader.readexactly(length)
+
+
+async def _client(port, bodies, offset, start_at, stop_at, latencies, statuses):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    i = offset
+    try:
+        while time.perf_counter() < stop_at:
+            start = time.perf_counter()
+            status, _ = await _request(reader, writer, b'POST', b'/predict', bodies[i % len(bodies)])
+            i += 1
+            if start >= start_at:
+                latencies.append(time.perf_counter() - start)
+                statuses[status] += 1
+    finally:
+        writer.close()
+
+
+async def _health(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        _, body = await _request(reader, writer, b'GET', b'/health')
+        return json.loads(body)
+    finally:
+        writer.close()
+
+
+async def _wait_ready(port, timeout=120):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            return await _health(port)
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def load_test(port, bodies, concurrency, warmup, duration):
+    await _wait_ready(port)
+    latencies, statuses = [], collections.Counter()
+    before = await _health(port)
+    start_at = time.perf_counter() + warmup
+    stop_at = start_at + duration
+    await asyncio.gather(*[_client(port, bodies, k * 7, start_at, stop_at, latencies, statuses)
+                           for k in range(concurrency)])
+    after = await _health(port)
+    batches = after['batches'] - before['batches']
+    p50, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 99]) if latencies else (np.nan, np.nan)
+    return {'requests_per_s': len(latencies) / duration, 'p50_ms': p50, 'p99_ms': p99,
+            'statuses': dict(statuses),
+            'mean_batch': (after['rows'] - before['rows']) / batches if batches else None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bundle')
+    parser.add_argument('--configs', nargs='+', default=['per_request_frame', 'per_request_row', 'batched_row'],
+                        choices=sorted(CONFIGS))
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--warmup', type=float, default=2.0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args(argv)
+
+    observations = generate_admissions(1000, seed=3).to_json(orient='records')
+    bodies = [json.dumps({'admission_id': i, 'observation': observation}).encode()
+              for i, observation in enumerate(json.loads(observations))]
+    for name in args.configs:
+        command = [sys.executable, '-m', 'serving.server', args.bundle, '--port', str(args.port),
+                   '--workers', str(args.workers), '--max-batch', str(args.max_batch),
+                   '--max-wait-ms', str(args.max_wait_ms)] + CONFIGS[name]
+        server = subprocess.Popen(command, stderr=subprocess.DEVNULL)
+        try:
+            result = asyncio.run(load_test(args.port, bodies, args.concurrency, args.warmup, args.duration))
+        finally:
+            server.terminate()
+            server.wait()
+        print(json.dumps(dict(config=name, **result)))
+
+
+if __name__ == '__main__':
+    main()
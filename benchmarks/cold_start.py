@@ -0,0 +1,145 @@
+import argparse
+import collections
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import generate_admissions
+
+
+# Cold start of a serving process: from launching a fresh interpreter to the
+# first prediction of a model bundle (serving.bundle), with an import time
+# breakdown and a budget check:
+#
+#   python -m benchmarks.cold_start /tmp/bundle --budget-ms 1000
+#
+# Every run is a new process that imports serving.bundle, loads (and verifies)
+# the bundle and scores one synthetic observation, in row mode or, with
+# --frame, as a one row DataFrame through the unpickled pipeline. The median
+# of --repeat runs is compared with --budget-ms and the exit status is 1 when
+# it is over budget, so this can gate a deployment like benchmarks.compare.
+# The breakdown comes from one more run under python -X importtime, summed
+# per top level package.
+#
+# The gate also covers the entry point: fresh processes that only import
+# serving.server (without --validate or --shadow nothing it loads needs
+# scikit-learn) fail it when they load any of the heavy packages or take
+# longer than the budget.
+
+HEAVY = ('sklearn', 'category_encoders', 'scipy', 'joblib')
+
+_CHILD = '''
+import json, sys, time
+started = time.time()
+from serving.bundle import load_bundle
+imported = time.time()
+bundle = load_bundle(sys.argv[1])
+loaded = time.time()
+observation = json.loads(sys.argv[2])
+if sys.argv[3] == 'frame':
+    bundle.predict_proba(bundle.frame([observation]))
+else:
+    bundle.predict_proba_one(observation)
+done = time.time()
+print(json.dumps({'started': started, 'imported': imported, 'loaded': loaded, 'done': done,
+                  'modules': sorted(name for name in %r if name in sys.modules)}))
+''' % (HEAVY,)
+
+_SERVER_CHILD = '''
+import json, sys, time
+started = time.time()
+import serving.server
+imported = time.time()
+print(json.dumps({'started': started, 'imported': imported,
+                  'modules': sorted(name for name in %r if name in sys.modules)}))
+''' % (HEAVY,)
+
+
+def run_once(bundle, observation, mode):
+    # seconds from launch to each step, and the heavy packages the process imported
+    launched = time.time()
+    out = subprocess.run([sys.executable, '-c', _CHILD, bundle, observation, mode],
+                         capture_output=True, text=True, check=True)
+    stamps = json.loads(out.stdout.strip().splitlines()[-1])
+    return {'startup': stamps['started'] - launched,
+            'import': stamps['imported'] - stamps['started'],
+            'load': stamps['loaded'] - stamps['imported'],
+            'first_prediction': stamps['done'] - stamps['loaded'],
+            'total': stamps['done'] - launched}, stamps['modules']
+
+
+def server_import_once():
+    # seconds to import serving.server in a fresh process, and the heavy packages it imported
+    out = subprocess.run([sys.executable, '-c', _SERVER_CHILD], capture_output=True, text=True, check=True)
+    stamps = json.loads(out.stdout.strip().splitlines()[-1])
+    return stamps['imported'] - stamps['started'], stamps['modules']
+
+
+def import_breakdown(bundle, observation, mode):
+    # self import time (seconds) per top level package
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', _CHILD, bundle, observation, mode],
+                         capture_output=True, text=True, check=True)
+    totals = collections.Counter()
+    for line in out.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        totals[name.strip().split('.')[0]] += int(self_us) / 1e6
+    return totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bundle', help='model bundle directory')
+    parser.add_argument('--budget-ms', type=float, default=1000.0, help='cold start to first prediction budget')
+    parser.add_argument('--frame', action='store_true', help='score a one row DataFrame instead of row mode')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=12, help='packages shown in the import breakdown')
+    args = parser.parse_args(argv)
+
+    mode = 'frame' if args.frame else 'row'
+    observation = generate_admissions(1, seed=1).to_json(orient='records')[1:-1]
+    runs = []
+    for _ in range(args.repeat):
+        timings, modules = run_once(args.bundle, observation, mode)
+        runs.append(timings)
+    median = {step: float(np.median([run[step] for run in runs])) for step in runs[0]}
+
+    print('cold start (%s mode), median of %d runs:' % (mode, args.repeat))
+    for step, seconds in median.items():
+        print('  %-17s %8.1f ms' % (step, seconds * 1000))
+    print('  heavy packages imported: %s' % (', '.join(modules) or 'none'))
+
+    totals = import_breakdown(args.bundle, observation, mode)
+    total_import = sum(totals.values())
+    print('import time by package (%.1f ms in all):' % (total_import * 1000))
+    for package, seconds in totals.most_common(args.top):
+        print('  %-20s %8.1f ms %5.1f%%' % (package, seconds * 1000, 100 * seconds / total_import))
+
+    server = [server_import_once() for _ in range(args.repeat)]
+    server_ms = float(np.median([seconds for seconds, _ in server])) * 1000
+    server_modules = sorted({name for _, modules in server for name in modules})
+    print('import serving.server: %.1f ms, heavy packages imported: %s'
+          % (server_ms, ', '.join(server_modules) or 'none'))
+
+    failed = False
+    total_ms = median['total'] * 1000
+    if total_ms > args.budget_ms:
+        print('OVER BUDGET: %.1f ms > %.1f ms' % (total_ms, args.budget_ms))
+        failed = True
+    if server_ms > args.budget_ms:
+        print('OVER BUDGET: import serving.server %.1f ms > %.1f ms' % (server_ms, args.budget_ms))
+        failed = True
+    if server_modules:
+        print('HEAVY IMPORTS: serving.server imports %s' % ', '.join(server_modules))
+        failed = True
+    if failed:
+        sys.exit(1)
+    print('within budget: %.1f ms <= %.1f ms' % (total_ms, args.budget_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import json
+import sys
+
+
+# Compares two benchmarks.suite result files and flags regressions.
+#
+#   python -m benchmarks.compare baseline.json results.json --tolerance 0.1
+#
+# A result regresses when its time (seconds, or p50 latency) grows, or its
+# rows/s drops, by more than --tolerance relative to the baseline; peak memory
+# is compared the same way. Exits with status 1 if anything regressed.
+
+# (metric, higher is better)
+metrics = [('seconds', False), ('p50_ms', False), ('p99_ms', False), ('rows_per_s', True), ('peak_bytes', False)]
+
+
+def _key(result):
+    return result.get('variant'), result['name'], result['rows']
+
+
+def compare(baseline, current, tolerance=0.1):
+    # rows of (key, metric, baseline value, current value, relative change, regressed)
+    old = {_key(result): result for result in baseline['results']}
+    rows = []
+    for result in current['results']:
+        before = old.get(_key(result))
+        if before is None:
+            continue
+        for metric, higher_is_better in metrics:
+            a, b = before.get(metric), result.get(metric)
+            if not a or b is None:
+                continue
+            change = (b - a) / a
+            regressed = change < -tolerance if higher_is_better else change > tolerance
+            rows.append((_key(result), metric, a, b, change, regressed))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as fh:
+        baseline = json.load(fh)
+    with open(args.current) as fh:
+        current = json.load(fh)
+
+    rows = compare(baseline, current, args.tolerance)
+    print('%-10s %-34s %10s %-11s %14s %14s %8s' % ('variant', 'name', 'rows', 'metric', 'baseline', 'current', 'change'))
+    for (variant, name, n_rows), metric, a, b, change, regressed in rows:
+        print('%-10s %-34s %10d %-11s %14.6g %14.6g %+7.1f%% %s' % (variant, name, n_rows, metric, a, b,
+                                                                    change * 100, 'REGRESSION' if regressed else ''))
+    n_regressed = sum(regressed for *_, regressed in rows)
+    print('%d of %d measurements regressed by more than %.0f%%' % (n_regressed, len(rows), args.tolerance * 100))
+    sys.exit(1 if n_regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
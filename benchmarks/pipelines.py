@@ -0,0 +1,109 @@
+import category_encoders as ce
+from sklearn.compose import ColumnTransformer
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import make_pipeline, Pipeline
+from sklearn.preprocessing import RobustScaler
+
+from custom_transformers import preprocessor, preprocessor_redeploy
+from custom_transformers import custom_ordinal_encoder, custom_ordinal_encoder_redeploy
+from custom_transformers.compiled_encoder import LeanOneHotEncoder
+from custom_transformers.featureselector import SelectColumns
+
+
+# The deployed pipelines as defined in "Random Forest for initial deployment.ipynb"
+# and "Redeploy.ipynb", so benchmarks and checks run against the real layout.
+# lean=True builds the memory-lean variant (ColumnConverter(lean=True) and
+# LeanOneHotEncoder), which has to be fitted in that mode.
+
+num_features = ['time_in_hospital',
+                'num_lab_procedures',
+                'num_procedures',
+                'num_medications',
+                'number_outpatient',
+                'number_emergency',
+                'number_inpatient',
+                'number_diagnoses',
+                'hemoglobin_level']
+
+selected_features = ['time_in_hospital',
+                     'num_lab_procedures',
+                     'num_procedures',
+                     'num_medications',
+                     'number_outpatient',
+                     'number_emergency',
+                     'number_inpatient',
+                     'number_diagnoses',
+                     'hemoglobin_level',
+
+                     'blood_transfusion',
+                     'insulin',
+                     'change',
+                     'diabetesMed',
+
+                     'race',
+                     'gender',
+                     'admission_type_code',
+                     'discharge_disposition_code',
+                     'admission_source_code',
+                     'payer_code',
+                     'blood_type',
+                     'diag_1',
+                     'diag_2',
+                     'diag_3',
+
+                     'max_glu_serum',
+                     'A1Cresult',
+                     'age']
+
+cat_features = ['race',
+                'gender',
+                'admission_type_code',
+                'discharge_disposition_code',
+                'admission_source_code',
+                'payer_code',
+                'diag_1',
+                'diag_2',
+                'diag_3',
+                'blood_type']
+
+selected_features_redeploy = (selected_features[:19] + ['medical_specialty'] + selected_features[19:]
+                              + ['diag_1_risk', 'diag_2_risk', 'diag_3_risk'])
+
+cat_features_redeploy = cat_features[:6] + ['medical_specialty'] + cat_features[6:]
+
+
+def build_preprocessor(num_feats, cat_feats, lean=False):
+    numeric_transformer = Pipeline(steps=[
+        ('imputer', SimpleImputer(strategy='median')),
+        ('scaler', RobustScaler())])
+    categorical_transformer = Pipeline(steps=[
+        ('imputer', SimpleImputer(strategy='constant', fill_value='unknown')),
+        ('onehot', (LeanOneHotEncoder if lean else ce.OneHotEncoder)(handle_unknown='ignore'))])
+    return ColumnTransformer(
+        transformers=[
+            ('num', numeric_transformer, num_feats),
+            ('cat', categorical_transformer, cat_feats)],
+        remainder="passthrough", sparse_threshold=0)
+
+
+def build_pipeline(redeploy=False, n_estimators=1000, compiled=False, n_jobs=-1, lean=False):
+    if redeploy:
+        converter, encoder = preprocessor_redeploy.ColumnConverter, custom_ordinal_encoder_redeploy.custom_oe
+        features, cats = selected_features_redeploy, cat_features_redeploy
+    else:
+        converter, encoder = preprocessor.ColumnConverter, custom_ordinal_encoder.custom_oe
+        features, cats = selected_features, cat_features
+    num_feats = [feat for feat in features if feat in num_features]
+    return make_pipeline(
+        converter(compiled=compiled, lean=lean),
+        encoder(compiled=compiled or lean),
+        SelectColumns(cols=features),
+        build_preprocessor(num_feats, cats, lean=lean),
+        RandomForestClassifier(max_depth=10,
+                               class_weight="balanced",
+                               random_state=42, n_jobs=n_jobs,
+                               n_estimators=n_estimators,
+                               criterion='gini',
+                               max_features='sqrt',
+                               bootstrap=False))
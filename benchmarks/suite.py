@@ -0,0 +1,184 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+from benchmarks.pipelines import build_pipeline
+from benchmarks.synthetic import generate_admissions, generate_target, iter_admissions
+from custom_transformers.compiled_forest import CompiledForest
+from custom_transformers.row_mode import RowPipeline
+
+
+# Benchmark suite for the scoring path, on synthetic admissions.
+#
+#   python -m benchmarks.suite --rows 1000 100000 1000000 10000000 --output results.json
+#   python -m benchmarks.compare baseline.json results.json
+#
+# For every variant ('default' is the pipeline as deployed, 'compiled' switches
+# ColumnConverter and custom_oe to their compiled modes, 'lean' is fitted with
+# the memory-lean dtype plan and LeanOneHotEncoder) and every row count it
+# records
+#   stage/<step>      transform time and peak traced memory of each pipeline step
+#   pipeline          predict_proba time and peak memory of the whole pipeline
+#   latency/frame     p50/p95/p99 of single observations as one-row DataFrames
+#   latency/row_mode  the same for RowPipeline + CompiledForest
+#   throughput/<n>    rows/s of predict_proba on batches of n rows
+# Row counts above --chunk-rows are generated and scored chunk by chunk (times
+# are summed, peak memory is the largest chunk's). Times are the best of
+# --repeat runs; memory is measured in a separate run under tracemalloc.
+
+
+def _best_time(func, arg, repeat):
+    best, out = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = func(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, out
+
+
+def _peak_bytes(func, arg):
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        func(arg)
+        return tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+
+
+def _percentiles(timings):
+    p50, p95, p99 = np.percentile(np.asarray(timings) * 1000, [50, 95, 99])
+    return {'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99}
+
+
+def _chunks(rows, chunk_rows):
+    if rows <= chunk_rows:
+        yield generate_admissions(rows)
+    else:
+        yield from iter_admissions(rows, chunksize=chunk_rows)
+
+
+def bench_stages(pipeline, rows, args):
+    totals = {}
+    for chunk in _chunks(rows, args.chunk_rows):
+        X = chunk
+        for name, step in pipeline.steps[:-1]:
+            seconds, out = _best_time(step.transform, X, args.repeat)
+            peak = _peak_bytes(step.transform, X) if args.memory else None
+            totals.setdefault('stage/' + name, []).append((seconds, peak))
+            X = out
+        name, model = pipeline.steps[-1]
+        seconds, _ = _best_time(model.predict_proba, X, args.repeat)
+        peak = _peak_bytes(model.predict_proba, X) if args.memory else None
+        totals.setdefault('stage/' + name, []).append((seconds, peak))
+        del X
+
+        seconds, _ = _best_time(pipeline.predict_proba, chunk, args.repeat)
+        peak = _peak_bytes(pipeline.predict_proba, chunk) if args.memory else None
+        totals.setdefault('pipeline', []).append((seconds, peak))
+
+    results = []
+    for name, measures in totals.items():
+        peaks = [peak for _, peak in measures if peak is not None]
+        results.append({'name': name, 'rows': rows,
+                        'seconds': sum(seconds for seconds, _ in measures),
+                        'peak_bytes': max(peaks) if peaks else None})
+    return results
+
+
+def bench_latency(pipeline, observations):
+    frame_timings = []
+    for observation in observations:
+        frame = pd.DataFrame([observation])
+        start = time.perf_counter()
+        pipeline.predict_proba(frame)
+        frame_timings.append(time.perf_counter() - start)
+
+    row_pipeline = RowPipeline(pipeline, model=CompiledForest.from_model(pipeline))
+    row_timings = []
+    for observation in observations:
+        start = time.perf_counter()
+        row_pipeline.model.predict_proba_row(row_pipeline.transform(observation))
+        row_timings.append(time.perf_counter() - start)
+    return [dict(name='latency/frame', rows=1, **_percentiles(frame_timings)),
+            dict(name='latency/row_mode', rows=1, **_percentiles(row_timings))]
+
+
+def bench_throughput(pipeline, df, batch_sizes, repeat):
+    results = []
+    for size in batch_sizes:
+        seconds, _ = _best_time(pipeline.predict_proba, df.iloc[:size], repeat)
+        results.append({'name': 'throughput/%d' % size, 'rows': size, 'seconds': seconds, 'rows_per_s': size / seconds})
+    return results
+
+
+def _meta(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'versions': {'numpy': np.__version__, 'pandas': pd.__version__, 'sklearn': sklearn.__version__},
+            'args': vars(args)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--variants', nargs='+', default=['default', 'compiled'], choices=['default', 'compiled', 'lean'])
+    parser.add_argument('--redeploy', action='store_true', help='benchmark the redeploy pipeline')
+    parser.add_argument('--fit-rows', type=int, default=20000)
+    parser.add_argument('--n-estimators', type=int, default=100)
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--chunk-rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--latency-samples', type=int, default=200)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 100, 10000])
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='skip the tracemalloc runs')
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+    train = generate_admissions(args.fit_rows)
+    target = generate_target(train)
+    holdout = generate_admissions(max(args.batch_sizes + [args.latency_samples]), seed=7)
+    observations = holdout.iloc[:args.latency_samples].to_dict('records')
+
+    results = []
+    for variant in args.variants:
+        pipeline = build_pipeline(redeploy=args.redeploy, n_estimators=args.n_estimators,
+                                  compiled=variant == 'compiled', lean=variant == 'lean',
+                                  n_jobs=args.n_jobs).fit(train, target)
+        measured = bench_latency(pipeline, observations)
+        measured += bench_throughput(pipeline, holdout, args.batch_sizes, args.repeat)
+        for rows in args.rows:
+            measured += bench_stages(pipeline, rows, args)
+        for result in measured:
+            result['variant'] = variant
+            print(json.dumps(result))
+        results += measured
+
+    with open(args.output, 'w') as fh:
+        json.dump({'meta': _meta(args), 'results': results}, fh, indent=1)
+    print('wrote %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import pandas as pd
+import numpy as np
+
+
+# Synthetic admissions with the raw schema of data/train_data.csv, including the
+# messy spellings, '?' placeholders and missing values ColumnConverter cleans up.
+
+race = ['Caucasian', 'AfricanAmerican', 'Hispanic', 'Asian', 'Other', '?', None,
+        'WHITE', ' european', 'Black', 'latino', 'African American', 'caucasian']
+race_p = [0.55, 0.15, 0.03, 0.01, 0.02, 0.04, 0.04, 0.04, 0.03, 0.03, 0.02, 0.02, 0.02]
+
+gender = ['Female', 'Male', 'female', 'MALE', 'Unknown/Invalid', None]
+gender_p = [0.45, 0.41, 0.05, 0.05, 0.02, 0.02]
+
+age = ['[70-80)', '[60-70)', '[50-60)', '[80-90)', '[40-50)', '[30-40)', '[90-100)',
+       '[20-30)', '[10-20)', '[0-10)', '70-80', '[100-110)', None]
+age_p = [0.24, 0.21, 0.16, 0.16, 0.09, 0.03, 0.02, 0.02, 0.01, 0.01, 0.02, 0.01, 0.02]
+
+weight = ['?', None, '[75-100)', '[50-75)', '[100-125)', '[125-150)', '[25-50)', '[0-25)',
+          '[150-175)', '[175-200)', '>200']
+weight_p = [0.9, 0.05, 0.015, 0.01, 0.01, 0.005, 0.003, 0.002, 0.002, 0.002, 0.001]
+
+payer_code = ['?', None, 'MC', 'HM', 'SP', 'BC', 'MD', 'CP', 'UN', 'CM', 'OG', 'PO', 'DM', 'CH', 'WC', 'OT', 'MP', 'SI']
+payer_code_p = [0.36, 0.04, 0.32, 0.06, 0.05, 0.05, 0.03, 0.025, 0.025, 0.02, 0.01, 0.005, 0.005,
+                0.002, 0.002, 0.002, 0.002, 0.002]
+
+medical_specialty = ['?', None, 'InternalMedicine', 'Emergency/Trauma', 'Family/GeneralPractice', 'Cardiology',
+                     'Surgery-General', 'Nephrology', 'Orthopedics', 'Orthopedics-Reconstructive', 'Radiologist',
+                     'Pulmonology', 'Psychiatry', 'Urology', 'ObstetricsandGynecology', 'Surgery-Cardiovascular/Thoracic',
+                     'Gastroenterology', 'Surgery-Vascular', 'Oncology', 'Dentistry', 'Speech', 'internalmedicine']
+medical_specialty_p = [0.45, 0.04, 0.14, 0.07, 0.07, 0.05, 0.03, 0.02, 0.015, 0.015, 0.012, 0.01, 0.01,
+                       0.008, 0.008, 0.007, 0.006, 0.005, 0.004, 0.003, 0.002, 0.01]
+
+blood_type = ['A+', 'O+', 'B+', 'AB+', 'A-', 'O-', 'B-', 'AB-', 'o+', 'a+', None, 'unknown']
+blood_type_p = [0.3, 0.32, 0.08, 0.03, 0.06, 0.07, 0.02, 0.01, 0.03, 0.03, 0.04, 0.01]
+
+max_glu_serum = ['None', 'Norm', '>200', '>300', 'norm', None]
+max_glu_serum_p = [0.9, 0.03, 0.015, 0.015, 0.01, 0.03]
+
+A1Cresult = ['None', '>8', 'Norm', '>7', 'NONE', None]
+A1Cresult_p = [0.78, 0.08, 0.05, 0.04, 0.02, 0.03]
+
+complete_vaccination_status = ['Complete', 'Incomplete', 'complete', None]
+complete_vaccination_status_p = [0.6, 0.3, 0.05, 0.05]
+
+yes_no = ['No', 'Yes', 'no', 'YES', None]
+yes_no_p = [0.5, 0.4, 0.04, 0.03, 0.03]
+
+change = ['No', 'Ch', 'no', 'CH', None]
+change_p = [0.5, 0.42, 0.03, 0.02, 0.03]
+
+admission_type_code = [1, 3, 2, 6, 5, 8, 7, 4, np.nan]
+admission_type_code_p = [0.52, 0.18, 0.18, 0.05, 0.04, 0.01, 0.005, 0.005, 0.01]
+
+discharge_disposition_code = [1, 3, 6, 18, 2, 22, 11, 5, 25, 4, 7, 23, 13, 14, 28, 8, 15, 24, 9, 17,
+                              16, 19, 10, 27, 12, 20, np.nan]
+discharge_disposition_code_p = np.array([0.58, 0.13, 0.12, 0.035, 0.02, 0.02, 0.015, 0.012, 0.01, 0.008,
+                                         0.006, 0.004, 0.004, 0.004, 0.001, 0.001, 0.001, 0.001, 0.001,
+                                         0.001, 0.001, 0.001, 0.001, 0.001, 0.001, 0.001, 0.005])
+
+admission_source_code = [7, 1, 17, 4, 6, 2, 5, 3, 20, 9, 8, 22, 10, 11, 25, 14, 13, np.nan]
+admission_source_code_p = np.array([0.55, 0.28, 0.06, 0.03, 0.02, 0.01, 0.01, 0.005, 0.005, 0.005,
+                                    0.005, 0.003, 0.002, 0.001, 0.001, 0.001, 0.001, 0.006])
+
+
+def _diag_pool(rng, size=2500):
+    # raw ICD-9 codes as they appear in the requests: numeric codes with and
+    # without decimals or zero padding, V and E codes in mixed case, '?' and blanks
+    main = rng.integers(1, 1000, size)
+    decimals = rng.integers(0, 100, size)
+    kind = rng.random(size)
+    pool = []
+    for m, d, k in zip(main, decimals, kind):
+        if k < 0.55:
+            pool.append(str(m))
+        elif k < 0.75:
+            pool.append('%d.%d' % (m, d))
+        elif k < 0.8:
+            pool.append('%03d' % m)
+        elif k < 0.9:
+            pool.append('%s%02d' % ('V' if k < 0.88 else 'v', 1 + m % 90))
+        else:
+            pool.append('%s%d' % ('E' if k < 0.98 else 'e', 800 + m % 100))
+    pool += ['250', '250.83', '428', '414', '786', '276', 'V57', 'V45', '996', '?', None]
+    weights = rng.pareto(1.2, len(pool)) + 0.01
+    weights[-11:] = weights.max()
+    return pool, weights / weights.sum()
+
+
+def _choice(rng, values, p, n):
+    p = np.asarray(p, dtype=float)
+    return np.asarray(values, dtype=object)[rng.choice(len(values), size=n, p=p / p.sum())]
+
+
+def _codes(rng, values, p, n):
+    p = np.asarray(p, dtype=float)
+    return np.asarray(values, dtype=float)[rng.choice(len(values), size=n, p=p / p.sum())]
+
+
+def generate_admissions(n, seed=42, first_id=0, chunk=0):
+    rng = np.random.default_rng(seed)
+    diag, diag_p = _diag_pool(rng)
+    if chunk:
+        # later chunks of iter_admissions: same code pool, fresh rows
+        rng = np.random.default_rng([seed, chunk])
+
+    hemoglobin_level = rng.normal(13.5, 1.8, n).round(1)
+    hemoglobin_level[rng.random(n) < 0.08] = np.nan
+
+    df = pd.DataFrame({
+        'admission_id': np.arange(first_id, first_id + n),
+        'patient_id': rng.integers(1, max(2, n // 2), n),
+        'race': _choice(rng, race, race_p, n),
+        'gender': _choice(rng, gender, gender_p, n),
+        'age': _choice(rng, age, age_p, n),
+        'weight': _choice(rng, weight, weight_p, n),
+        'admission_type_code': _codes(rng, admission_type_code, admission_type_code_p, n),
+        'discharge_disposition_code': _codes(rng, discharge_disposition_code, discharge_disposition_code_p, n),
+        'admission_source_code': _codes(rng, admission_source_code, admission_source_code_p, n),
+        'time_in_hospital': rng.integers(1, 15, n),
+        'payer_code': _choice(rng, payer_code, payer_code_p, n),
+        'medical_specialty': _choice(rng, medical_specialty, medical_specialty_p, n),
+        'has_prosthesis': rng.random(n) < 0.05,
+        'complete_vaccination_status': _choice(rng, complete_vaccination_status, complete_vaccination_status_p, n),
+        'num_lab_procedures': rng.integers(1, 133, n),
+        'num_procedures': rng.integers(0, 7, n),
+        'num_medications': rng.integers(1, 82, n),
+        'number_outpatient': rng.poisson(0.4, n),
+        'number_emergency': rng.poisson(0.2, n),
+        'number_inpatient': rng.poisson(0.6, n),
+        'diag_1': _choice(rng, diag, diag_p, n),
+        'diag_2': _choice(rng, diag, diag_p, n),
+        'diag_3': _choice(rng, diag, diag_p, n),
+        'number_diagnoses': rng.integers(1, 17, n),
+        'blood_type': _choice(rng, blood_type, blood_type_p, n),
+        'hemoglobin_level': hemoglobin_level,
+        'blood_transfusion': rng.random(n) < 0.1,
+        'max_glu_serum': _choice(rng, max_glu_serum, max_glu_serum_p, n),
+        'A1Cresult': _choice(rng, A1Cresult, A1Cresult_p, n),
+        'diuretics': _choice(rng, yes_no, yes_no_p, n),
+        'insulin': _choice(rng, yes_no, yes_no_p, n),
+        'change': _choice(rng, change, change_p, n),
+        'diabetesMed': _choice(rng, yes_no, yes_no_p, n),
+    })
+    return df.set_index('admission_id')
+
+
+def iter_admissions(n, chunksize=1000000, seed=42):
+    # the same distributions in chunks (with consecutive admission ids), for row
+    # counts whose frame would not fit in memory at once, e.g. 10M
+    for i, start in enumerate(range(0, n, chunksize)):
+        yield generate_admissions(min(chunksize, n - start), seed=seed, first_id=start, chunk=i)
+
+
+def generate_target(df, seed=42):
+    # readmission label loosely tied to prior inpatient visits, so fitted models have something to learn
+    rng = np.random.default_rng(seed)
+    logit = -2.2 + 0.45 * df['number_inpatient'].to_numpy() + 0.05 * df['time_in_hospital'].to_numpy()
+    return pd.Series(rng.random(len(df)) < 1 / (1 + np.exp(-logit)), index=df.index, name='readmitted')
+
+
+def generate_requests(df, seed=42):
+    # request log in the format of data/moment_1_requests.csv: one JSON observation
+    # per admission (with the 'index' and 'admission_id' keys the API stored too)
+    rng = np.random.default_rng(seed)
+    raw = df.reset_index()
+    raw.insert(0, 'index', np.arange(len(raw)))
+    observations = raw.to_json(orient='records', lines=True).splitlines()
+    return pd.DataFrame({'admission_id': df.index,
+                         'observation': observations,
+                         'predicted_readmitted': rng.random(len(df)) < 0.3,
+                         'actual_readmitted': generate_target(df, seed).to_numpy()})
@@ -0,0 +1,99 @@
+import os
+
+import joblib
+from sklearn.base import clone
+from sklearn.pipeline import Pipeline
+
+
+# On-disk caching of deterministic preprocessing for model searches.
+#
+# Keys are content hashes (joblib.hash) of the transformer parameters and of
+# the input data, so a cached output is reused whenever the same stage sees the
+# same rows again, across candidates, folds, processes and sessions. Every
+# lookup appends 'hit' or 'miss' to <location>/cache_stats.log, which keeps
+# the counts right when estimators are cloned or searches run with n_jobs > 1.
+#
+#   search = GridSearchCV(make_pipeline(ColumnConverter(), custom_oe(), SelectColumns(cols=selected_features),
+#                                       preprocessor, RandomForestClassifier()),
+#                         {'randomforestclassifier__max_depth': [5, 10]}, cv=5, scoring='f1')
+#   cached_search(search, X_train, y_train, '/tmp/preprocessing_cache')
+#   cache_info('/tmp/preprocessing_cache')   # {'hits': ..., 'misses': ...}
+
+_STATS = 'cache_stats.log'
+
+
+def _record(location, hit):
+    with open(os.path.join(location, _STATS), 'a') as fh:
+        fh.write('hit\n' if hit else 'miss\n')
+
+
+def cache_info(location):
+    try:
+        with open(os.path.join(location, _STATS)) as fh:
+            lines = fh.read().split()
+    except FileNotFoundError:
+        lines = []
+    return {'hits': lines.count('hit'), 'misses': lines.count('miss')}
+
+
+class CountingMemory(joblib.Memory):
+    # joblib.Memory for Pipeline(memory=...) that records hits and misses of the
+    # cached fit_transform calls in cache_stats.log
+    def cache(self, func=None, **kwargs):
+        memorized = super().cache(func, **kwargs)
+        if func is None or self.location is None:
+            return memorized
+
+        def call(*args, **kw):
+            _record(self.location, memorized.check_call_in_cache(*args, **kw))
+            return memorized(*args, **kw)
+        return call
+
+
+def is_stateless(estimator):
+    # steps declare it with a stateless attribute (scikit-learn's tags API changes between versions)
+    return estimator is None or estimator == 'passthrough' or bool(getattr(estimator, 'stateless', False))
+
+
+def cached_fit_transform(transformer, X, location):
+    # (fitted clone of transformer, its output on X), loaded from location when
+    # the same transformer already saw the same X; only for stateless stages
+    os.makedirs(location, exist_ok=True)
+    path = os.path.join(location, 'fit_transform_%s.pkl' % joblib.hash((transformer, X)))
+    if os.path.exists(path):
+        _record(location, True)
+        return joblib.load(path)
+    _record(location, False)
+    fitted = clone(transformer)
+    result = fitted, fitted.fit_transform(X)
+    joblib.dump(result, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return result
+
+
+def cached_search(search, X, y, location):
+    # Fits a GridSearchCV/RandomizedSearchCV over a Pipeline with
+    #   - the leading stateless steps (ColumnConverter, custom_oe, SelectColumns, ...)
+    #     applied once to all of X, through cached_fit_transform
+    #   - the remaining steps searched as Pipeline(memory=CountingMemory(location)),
+    #     so the fitted preprocessing of every fold is computed once and reused
+    #     by all candidates
+    # best_estimator_ is the full pipeline again, so it takes raw data.
+    pipeline = search.estimator
+    n_stateless = 0
+    for _, step in pipeline.steps[:-1]:
+        if not is_stateless(step):
+            break
+        n_stateless += 1
+
+    search = clone(search)
+    prefix, Xt = None, X
+    if n_stateless:
+        prefix, Xt = cached_fit_transform(Pipeline(pipeline.steps[:n_stateless]), X, location)
+    rest = Pipeline(pipeline.steps[n_stateless:], memory=CountingMemory(location, verbose=0))
+    search.set_params(estimator=rest)
+    search.fit(Xt, y)
+
+    if getattr(search, 'refit', False) and prefix is not None:
+        search.best_estimator_ = Pipeline(prefix.steps + search.best_estimator_.steps)
+    return search
@@ -0,0 +1,376 @@
+import pandas as pd
+import numpy as np
+from pandas.api.types import is_object_dtype
+
+from custom_transformers import diagnosis_index
+
+
+# Compiled (lookup-table driven) version of ColumnConverter.transform.
+#
+# Every column is factorized once, the per-value rules below are applied to
+# the (few) distinct raw values only, and the resulting integer table is used
+# to build the output Categorical in a single vectorized take. The rules
+# reproduce the chained .str/.loc/.isin passes of the original transformer
+# value for value, so the output is identical to the legacy path.
+
+
+class FallbackToLegacy(Exception):
+    # raised when the input contains something the lookup tables cannot
+    # reproduce exactly (e.g. unexpected numeric codes left untouched by the
+    # legacy transformer); ColumnConverter then runs the original code
+    pass
+
+
+_UNTOUCHED = object()
+
+num_columns = ['admission_source_code', 'time_in_hospital', 'num_procedures', 'num_medications',
+               'number_outpatient', 'number_emergency', 'number_inpatient', 'number_diagnoses',
+               'admission_type_code', 'discharge_disposition_code', 'num_lab_procedures', 'hemoglobin_level']
+
+# categories of the columns that end up with a fixed, ordered category list
+ordered_age = ['unknown', '0-10', '10-20', '20-30', '30-40', '40-50', '50-60', '60-70', '70-80', '80-90', '90-100']
+ordered_weight = ['unknown', '0-25', '25-50', '50-75', '75-100', '100-125', '125-150', '150-175', '175-200', '>200']
+ordered_max_glu = ['unknown', 'norm', '>200', '>300']
+ordered_A1C = ['unknown', 'norm', '>7', '>8']
+
+race_groups = {'afr': 'black', 'bla': 'black',
+               'cau': 'white', 'whi': 'white', 'eur': 'white',
+               'his': 'hispanic', 'lat': 'hispanic',
+               'asi': 'asian'}
+
+admission_types = {1: 'emergency', 2: 'urgent', 3: 'elective', 4: 'newborn',
+                   5: 'n/a', 6: 'n/a', 8: 'n/a', 7: 'trauma'}
+
+admission_sources = {1: 'referral', 2: 'referral', 3: 'referral',
+                     4: 'transfer', 5: 'transfer', 6: 'transfer', 10: 'transfer',
+                     18: 'transfer', 19: 'transfer', 22: 'transfer', 25: 'transfer',
+                     7: 'emergency'}
+
+discharge_dispositions = {1: 'discharged_home', 7: 'left_ama', 13: 'discharged_hospice', 14: 'discharged_hospice',
+                          6: 'home_care', 8: 'home_care',
+                          11: 'expired', 19: 'expired', 20: 'expired', 21: 'expired'}
+for code in [2, 3, 4, 5, 9, 10, 15, 22, 23, 24, 27, 28, 29, 12, 16, 17]:
+    discharge_dispositions[code] = 'transferred_inpatient'
+
+selected_specialties = ['pulmonology', 'internalmedicine', 'cardiology', 'unknown', 'surgery-general',
+                        'emergency/trauma', 'physicalmedicineandrehabilitation', 'family/generalpractice',
+                        'surgery-cardiovascular/thoracic', 'nephrology', 'radiologist', 'hematology/oncology',
+                        'other', 'orthopedics', 'orthopedics-reconstructive', 'pediatrics-endocrinology',
+                        'gastroenterology', 'surgery-vascular', 'obstetricsandgynecology', 'psychiatry',
+                        'urology', 'surgery-neuro', 'oncology', 'neurology', 'pediatrics']
+
+blood_types = ['a+', 'b+', 'o+', 'ab-', 'a-', 'o-', 'ab+', 'b-']
+
+### per value rules (value -> output label)
+
+def _lower(value):
+    return value.lower() if isinstance(value, str) else np.nan
+
+
+def _strip_bin(value):
+    return value.lstrip('\\[').rstrip(')') if isinstance(value, str) else np.nan
+
+
+def _yes_no(value):
+    # map({'yes': True, 'no': False}).astype('bool') turns everything but 'no' into True
+    return _lower(value) != 'no'
+
+
+def _change(value):
+    return _lower(value) != 'no'
+
+
+def _vaccination(value):
+    # the legacy map looks up 'Complete'/'Incomplete' after lowercasing, so nothing matches
+    return True
+
+
+def _age(value):
+    value = _lower(_strip_bin(value))
+    return value if value in ordered_age else 'unknown'
+
+
+def _weight(value):
+    value = _strip_bin(value)
+    return value if value in ordered_weight else 'unknown'
+
+
+def _max_glu(value):
+    value = _lower(value)
+    return value if value in ordered_max_glu else 'unknown'
+
+
+def _A1C(value):
+    value = _lower(value)
+    return value if value in ordered_A1C else 'unknown'
+
+
+def _gender(value):
+    value = _lower(value)
+    return value if value in ['male', 'female'] else 'unknown'
+
+
+def _race(value):
+    if isinstance(value, str):
+        return race_groups.get(value.lower().lstrip()[0:3], 'unknown/other')
+    return 'unknown/other'
+
+
+def _payer(value):
+    if pd.isna(value) or value == '?' or value == 'unknown':
+        return 'unknown'
+    return 'SP' if value == 'SP' else 'insured'
+
+
+def _admission_type(value):
+    if np.isnan(value):
+        return np.nan
+    return admission_types.get(value, _UNTOUCHED)
+
+
+def _admission_source(value):
+    return admission_sources.get(value, 'unknown')
+
+
+def _discharge(value):
+    return discharge_dispositions.get(value, 'unknown')
+
+
+def _specialty(value):
+    value = _lower(value)
+    if value == '?':
+        value = 'unknown'
+    return value if value in selected_specialties else 'other'
+
+
+def _blood_type(value):
+    value = _lower(value)
+    return value if value in blood_types else 'unknown'
+
+
+# (rule, categories, categories are fixed and ordered, needs string values)
+_str_columns = {
+    'age': (_age, ordered_age, True),
+    'weight': (_weight, ordered_weight, True),
+    'max_glu_serum': (_max_glu, ordered_max_glu, True),
+    'A1Cresult': (_A1C, ordered_A1C, True),
+    'gender': (_gender, sorted(['male', 'female', 'unknown']), False),
+    'race': (_race, sorted(set(race_groups.values()) | {'unknown/other'}), False),
+    'medical_specialty': (_specialty, sorted(selected_specialties), False),
+    'blood_type': (_blood_type, sorted(blood_types + ['unknown']), False),
+}
+
+_code_columns = {
+    'admission_type_code': (_admission_type, sorted(set(admission_types.values()))),
+    'admission_source_code': (_admission_source, sorted(set(admission_sources.values()) | {'unknown'})),
+    'discharge_disposition_code': (_discharge, sorted(set(discharge_dispositions.values()) | {'unknown'})),
+}
+
+binary_cols = {'diuretics': _yes_no,
+               'insulin': _yes_no,
+               'change': _change,
+               'diabetesMed': _yes_no,
+               'complete_vaccination_status': _vaccination}
+
+# per process memo of raw value -> output code, so repeated batches skip the rules
+_memo = {}
+_MAX_MEMO = 100000
+
+
+def _factorize(series):
+    # codes into uniques (-1 for missing), which uniques occur and whether anything is missing
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes = series.cat.codes.to_numpy()
+        counts = np.bincount(codes + 1, minlength=len(series.cat.categories) + 1)
+        return codes, list(series.cat.categories), counts[1:] > 0, counts[0] > 0
+    codes, uniques = pd.factorize(series.to_numpy())
+    return codes, list(uniques), np.ones(len(uniques), dtype=bool), bool((codes == -1).any())
+
+
+def _is_str_like(series):
+    # pandas string dtypes keep their dtype in the legacy output categories, leave them to the legacy path
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return is_object_dtype(series.cat.categories.dtype)
+    return is_object_dtype(series.dtype)
+
+
+def _lookup_table(key, uniques, rule, encode):
+    # table[i] = encoded output of uniques[i], the extra last slot is the output
+    # for missing values so that code -1 from factorize indexes it directly
+    memo = _memo.setdefault(key, {})
+    if len(memo) > _MAX_MEMO:
+        memo.clear()
+    table = []
+    for value in uniques:
+        try:
+            code = memo[value]
+        except (KeyError, TypeError):
+            code = encode(rule(value))
+            try:
+                memo[value] = code
+            except TypeError:
+                pass
+        table.append(code)
+    table.append(encode(rule(np.nan)))
+    return table
+
+
+def _categorical(table, codes, present, has_missing, categories, ordered, index, name, categories_dtype=None,
+                 fixed=False):
+    if not ordered and not fixed:
+        # the legacy astype('category') only keeps the categories it has seen,
+        # work that out on the lookup table instead of the (much longer) column
+        seen = set(table[:-1][present]) | ({table[-1]} if has_missing else set())
+        seen.discard(-1)
+        remap = np.full(len(categories), -1, dtype=np.int8)
+        remap[sorted(seen)] = np.arange(len(seen))
+        table = np.where(table >= 0, remap[table], -1).astype(np.int8)
+        categories = [categories[code] for code in sorted(seen)]
+    if categories_dtype is not None:
+        categories = pd.Index(categories, dtype=categories_dtype)
+    cat = pd.Categorical.from_codes(table[codes], categories=categories, ordered=ordered)
+    return pd.Series(cat, index=index, name=name)
+
+
+def _to_categorical(series, key, rule, categories, ordered, index, fixed=False):
+    position = {category: code for code, category in enumerate(categories)}
+
+    def encode(label):
+        if label is _UNTOUCHED:
+            raise FallbackToLegacy(series.name)
+        if not isinstance(label, str):
+            return -1
+        return position[label]
+
+    codes, uniques, present, has_missing = _factorize(series)
+    table = np.array(_lookup_table(key, uniques, rule, encode), dtype=np.int8)
+    return _categorical(table, codes, present, has_missing, categories, ordered, index, series.name, fixed=fixed)
+
+
+def convert_diag(series, risk_col=None, fixed=False, tables=None):
+    # ICD chapter of a raw diag_* column and, with risk_col, its readmission
+    # risk bucket (from tables, default diagnosis_index.risk_tables); both come
+    # out of a single factorize of the raw codes
+    categories_dtype = None
+    if not _is_str_like(series):
+        # same error as the legacy .str calls for non-string columns, same
+        # category dtype as the legacy output for pandas string columns
+        categories_dtype = series.str.lower().dtype
+    codes, uniques, present, has_missing = _factorize(series)
+    slots = diagnosis_index.slots(uniques)
+    chapter = _categorical(diagnosis_index.chapter_table[slots], codes, present, has_missing,
+                           diagnosis_index.diag_categories, False, series.index, series.name, categories_dtype, fixed)
+    if risk_col is None:
+        return chapter
+    tables = diagnosis_index.risk_tables if tables is None else tables
+    risk = _categorical(tables[risk_col][slots], codes, present, has_missing,
+                        diagnosis_index.ordered_risk, True, series.index, risk_col)
+    return chapter, risk
+
+
+# dtype plan of the lean mode: counts and measurements as float32 (exact for
+# the counts, and NaN stays possible), yes/no flags as int8, and every
+# categorical with its full, fixed category list instead of the observed
+# categories. With only numeric flags and codes left for remainder='passthrough',
+# the ColumnTransformer output stays numeric instead of an object array.
+lean_num_columns = [col for col in num_columns if col not in _code_columns]
+lean_flag_columns = ['has_prosthesis', 'blood_transfusion']
+
+
+def convert_columns(df, risk=False, lean=False):
+    # risk adds the diag_*_risk columns of the redeploy converter (True for the
+    # buckets of diag_readmission, or a table in that format, see
+    # diagnosis_index.tables_for), lean applies the dtype plan above; the input
+    # frame is never copied or modified
+    _df = df.copy(deep=False)
+    index = df.index
+
+    for col in num_columns:
+        _df[col] = df[col].astype('float32' if lean and col in lean_num_columns else 'float64')
+
+    for col, rule in binary_cols.items():
+        if not _is_str_like(df[col]):
+            raise FallbackToLegacy(col)
+        codes, uniques, _, _ = _factorize(df[col])
+        table = np.array(_lookup_table(col, uniques, rule, bool), dtype=np.int8 if lean else bool)
+        _df[col] = pd.Series(table[codes], index=index, name=col)
+    if lean:
+        for col in lean_flag_columns:
+            if col in df and df[col].dtype == bool:
+                _df[col] = df[col].astype(np.int8)
+
+    for col, (rule, categories, ordered) in _str_columns.items():
+        if not _is_str_like(df[col]):
+            raise FallbackToLegacy(col)
+        _df[col] = _to_categorical(df[col], col, rule, categories, ordered, index, fixed=lean)
+
+    if not _is_str_like(df['payer_code']) and not df['payer_code'].isna().all():
+        raise FallbackToLegacy('payer_code')
+    _df['payer_code'] = _to_categorical(df['payer_code'], 'payer_code', _payer,
+                                        sorted(['SP', 'insured', 'unknown']), False, index, fixed=lean)
+
+    for col, (rule, categories) in _code_columns.items():
+        converted = _to_categorical(_df[col], col, rule, categories, False, index, fixed=lean)
+        if len(converted.cat.categories) == 0:
+            # nothing mapped, the legacy path keeps float categories
+            raise FallbackToLegacy(col)
+        _df[col] = converted
+
+    tables = diagnosis_index.tables_for(risk) if risk else None
+    for col in ['diag_1', 'diag_2', 'diag_3']:
+        if not _is_str_like(df[col]):
+            raise FallbackToLegacy(col)
+        if risk:
+            _df[col], _df[col + '_risk'] = convert_diag(df[col], col + '_risk', fixed=lean, tables=tables)
+        else:
+            _df[col] = convert_diag(df[col], fixed=lean)
+    return _df
+
+
+### single observation (row mode)
+
+def _float(value):
+    return np.nan if value is None else float(value)
+
+
+def _code_cell(rule):
+    def cell(value):
+        value = _float(value)
+        label = rule(value)
+        # unmapped codes stay in the column as floats, like in the legacy path
+        return value if label is _UNTOUCHED else label
+    return cell
+
+
+def _slot(value):
+    return diagnosis_index.prefix_slot(value.lower()[0:3] if isinstance(value, str) else None)
+
+
+def _diag_cell(value):
+    return diagnosis_index.diag_categories[diagnosis_index.chapter_table[_slot(value)]]
+
+
+def _risk_cell(risk_col, tables):
+    table = tables[risk_col]
+
+    def cell(value):
+        bucket = table[_slot(value)]
+        return np.nan if bucket < 0 else diagnosis_index.ordered_risk[bucket]
+    return cell
+
+
+def cell_rules(risk=False):
+    # col -> (raw column, rule), where rule(raw value) is what ColumnConverter
+    # leaves in that cell; missing values come out as np.nan. risk is as in
+    # convert_columns
+    rules = {col: (col, _float) for col in num_columns}
+    rules.update({col: (col, rule) for col, rule in binary_cols.items()})
+    rules.update({col: (col, rule) for col, (rule, _, _) in _str_columns.items()})
+    rules['payer_code'] = ('payer_code', _payer)
+    rules.update({col: (col, _code_cell(rule)) for col, (rule, _) in _code_columns.items()})
+    tables = diagnosis_index.tables_for(risk) if risk else None
+    for col in ['diag_1', 'diag_2', 'diag_3']:
+        rules[col] = (col, _diag_cell)
+        if risk:
+            rules[col + '_risk'] = (col, _risk_cell(col + '_risk', tables))
+    return rules
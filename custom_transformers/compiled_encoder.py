@@ -0,0 +1,150 @@
+import pandas as pd
+import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.utils.validation import check_is_fitted
+
+
+# Native replacement for the category_encoders.OrdinalEncoder used by custom_oe.
+#
+# The {'col': ..., 'mapping': {...}} list is compiled once into one small int8
+# table per column, indexed by the categorical codes of the input (plus a last
+# slot for missing values, so code -1 picks it with mode='wrap'). Encoding a
+# column is then a single np.take. Unknown and missing values both encode to
+# -1, which is what OrdinalEncoder(handle_unknown='value', handle_missing='value')
+# produces when it is given an explicit mapping.
+
+UNKNOWN = -1
+
+
+class OrdinalTables:
+    def __init__(self, mapping):
+        self.cols = [m['col'] for m in mapping]
+        self.mapping = {m['col']: dict(m['mapping']) for m in mapping}
+        self._tables = {}
+
+    def _categories(self, series):
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            return series.cat.codes.to_numpy(), series.cat.categories
+        codes, uniques = pd.factorize(series.to_numpy())
+        return codes, uniques
+
+    def _table(self, col, categories):
+        # tables are cached per category list; after ColumnConverter the
+        # ordered columns always carry the same categories, so this is a lookup
+        key = (col, tuple(categories))
+        table = self._tables.get(key)
+        if table is None:
+            mapping = self.mapping[col]
+            table = np.array([mapping.get(category, UNKNOWN) for category in categories] + [UNKNOWN],
+                             dtype=np.int8)
+            if len(self._tables) > 1000:
+                self._tables.clear()
+            self._tables[key] = table
+        return table
+
+    def fit(self, df):
+        for col in self.cols:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                self._table(col, df[col].cat.categories)
+        return self
+
+    def encode_into(self, df, out):
+        # writes column j of out with the codes of self.cols[j]; out can be any
+        # (n_rows, len(self.cols)) numeric array, e.g. a slice of the model input
+        for j, col in enumerate(self.cols):
+            codes, categories = self._categories(df[col])
+            table = self._table(col, categories)
+            if out.dtype != table.dtype:
+                table = table.astype(out.dtype)
+            if out[:, j].flags.contiguous:
+                np.take(table, codes, out=out[:, j], mode='wrap')
+            else:
+                out[:, j] = np.take(table, codes, mode='wrap')
+        return out
+
+    def transform(self, df):
+        # one Fortran ordered int8 block, so every column is written in place
+        block = np.empty((len(df), len(self.cols)), dtype=np.int8, order='F')
+        self.encode_into(df, block)
+        _df = df.copy(deep=False)
+        for j, col in enumerate(self.cols):
+            _df[col] = block[:, j]
+        return _df
+
+
+# Table version of a fitted category_encoders.OneHotEncoder (the 'onehot' step
+# of the ColumnTransformer in the deployment notebooks).
+#
+# Every input column gets one float32 table with the dummies of each known
+# label, followed by the rows category_encoders uses for unknown (-1) and
+# missing (-2) values; rows it has no mapping for (e.g. unknown labels with
+# handle_unknown='ignore') are NaN, exactly like its reindex. transform()
+# writes straight into one float32 output array instead of concatenating
+# int64 frames, which is what makes category_encoders the memory peak of the
+# whole pipeline.
+
+class OneHotTables:
+    def __init__(self, encoder):
+        ordinals = {m['col']: m['mapping'] for m in encoder.ordinal_encoder.mapping}
+        if len(encoder.mapping) != len(encoder.feature_names_in_):
+            raise ValueError('OneHotTables needs every input column to be encoded')
+        self.labels = []
+        self.tables = []
+        self.feature_names = []
+        for m in encoder.mapping:
+            dummies, ordinal = m['mapping'], ordinals[m['col']]
+            known = [(label, code) for label, code in ordinal.items() if label == label]
+            self.labels.append({label: row for row, (label, _) in enumerate(known)})
+            rows = [code for _, code in known] + [-1, -2]
+            self.tables.append(dummies.reindex(rows).to_numpy(dtype=np.float32))
+            self.feature_names += [str(name) for name in dummies.columns]
+
+    def _rows(self, j, values):
+        # row of every value in tables[j]: its label, unknown (-2) or missing (-1)
+        labels = self.labels[j]
+        unknown, missing = len(labels), len(labels) + 1
+        codes, uniques = pd.factorize(values)
+        table = np.array([labels.get(value, unknown) if value == value else missing for value in uniques] + [missing],
+                         dtype=np.intp)
+        return table[codes]
+
+    def transform(self, X):
+        values = X.to_numpy() if isinstance(X, pd.DataFrame) else np.asarray(X, dtype=object)
+        out = np.empty((len(values), len(self.feature_names)), dtype=np.float32)
+        start = 0
+        for j, table in enumerate(self.tables):
+            stop = start + table.shape[1]
+            out[:, start:stop] = table[self._rows(j, values[:, j])]
+            start = stop
+        return out
+
+
+class LeanOneHotEncoder(TransformerMixin, BaseEstimator):
+    # drop-in for ce.OneHotEncoder in the categorical pipeline of the
+    # ColumnTransformer: the same dummies, as one float32 array
+    def __init__(self, handle_unknown='value', handle_missing='value'):
+        self.handle_unknown = handle_unknown
+        self.handle_missing = handle_missing
+
+    @classmethod
+    def from_encoder(cls, encoder):
+        # from an already fitted ce.OneHotEncoder, e.g. inside a pickled pipeline
+        lean = cls(handle_unknown=encoder.handle_unknown, handle_missing=encoder.handle_missing)
+        lean.tables_ = OneHotTables(encoder)
+        return lean
+
+    def fit(self, X, y=None):
+        # fitting only, transform needs nothing but the tables
+        import category_encoders as ce
+        encoder = ce.OneHotEncoder(handle_unknown=self.handle_unknown, handle_missing=self.handle_missing)
+        self.tables_ = OneHotTables(encoder.fit(X))
+        return self
+
+    def transform(self, X):
+        check_is_fitted(self, 'tables_')
+        return self.tables_.transform(X)
+
+    def get_feature_names_out(self, input_features=None):
+        check_is_fitted(self, 'tables_')
+        return np.array(self.tables_.feature_names, dtype=object)
+
@@ -0,0 +1,149 @@
+import argparse
+
+import numpy as np
+
+
+# Flattened inference engine for fitted RandomForestClassifier / DecisionTreeClassifier
+# ensembles (single output).
+#
+# All trees are concatenated into one set of contiguous node arrays (feature,
+# threshold, left, right, normalized leaf probabilities) with the root of every
+# tree at roots[t]. Leaves point to themselves with an infinite threshold, so a
+# batch is predicted by walking all (row, tree) pairs down max_depth levels
+# with plain array indexing, without per tree Python dispatch or a thread pool.
+#
+# Inputs are converted to float32 and compared to the float64 thresholds exactly
+# like sklearn does, so every row reaches the same leaves; probabilities match
+# predict_proba up to the order in which the trees are summed.
+
+_NODES_PER_BATCH = 1 << 20
+
+
+class CompiledForest:
+    def __init__(self, feature, threshold, left, right, value, roots, max_depth, classes, n_features, children=None):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        # children[2 * node] is the left child, children[2 * node + 1] the right one;
+        # passed in by loaders that map it from disk (left and right are then views of it)
+        self.children = np.stack([left, right], axis=1).ravel() if children is None else children
+        self.max_depth = int(max_depth)
+        self.classes_ = classes
+        self.n_features_in_ = int(n_features)
+
+    @classmethod
+    def from_model(cls, model):
+        # model is a fitted forest, a single tree or a pipeline ending in one
+        if hasattr(model, 'steps'):
+            model = model.steps[-1][1]
+        trees = getattr(model, 'estimators_', [model])
+        if getattr(model, 'n_outputs_', 1) != 1:
+            raise ValueError('only single output classifiers can be compiled')
+
+        features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+        offset = 0
+        for tree in trees:
+            tree_ = tree.tree_
+            n_nodes = tree_.node_count
+            leaf = tree_.children_left == -1
+            nodes = np.arange(offset, offset + n_nodes)
+            features.append(np.where(leaf, 0, tree_.feature))
+            thresholds.append(np.where(leaf, np.inf, tree_.threshold))
+            lefts.append(np.where(leaf, nodes, tree_.children_left + offset))
+            rights.append(np.where(leaf, nodes, tree_.children_right + offset))
+            # DecisionTreeClassifier.predict_proba normalizes the (weighted) class counts of the leaf
+            value = tree_.value[:, 0, :].astype(np.float64)
+            normalizer = value.sum(axis=1, keepdims=True)
+            normalizer[normalizer == 0.0] = 1.0
+            values.append(value / normalizer)
+            roots.append(offset)
+            offset += n_nodes
+
+        return cls(feature=np.ascontiguousarray(np.concatenate(features), dtype=np.int32),
+                   threshold=np.ascontiguousarray(np.concatenate(thresholds), dtype=np.float64),
+                   left=np.ascontiguousarray(np.concatenate(lefts), dtype=np.int32),
+                   right=np.ascontiguousarray(np.concatenate(rights), dtype=np.int32),
+                   value=np.ascontiguousarray(np.concatenate(values)),
+                   roots=np.array(roots, dtype=np.int32),
+                   max_depth=max(tree.tree_.max_depth for tree in trees),
+                   classes=np.asarray(model.classes_),
+                   n_features=model.n_features_in_)
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def _check(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X[None, :]
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError('X has %d features, the forest expects %d' % (X.shape[1], self.n_features_in_))
+        if np.isnan(X).any():
+            raise ValueError('Input X contains NaN.')
+        return X
+
+    def _leaves(self, X):
+        # (n_rows, n_trees) leaf of every tree for every row, level by level
+        flat = np.ascontiguousarray(X).ravel()
+        row_start = (np.arange(len(X), dtype=np.int64) * X.shape[1])[:, None]
+        node = np.broadcast_to(self.roots, (len(X), self.n_trees)).copy()
+        for _ in range(self.max_depth):
+            go_right = flat[row_start + self.feature[node]] > self.threshold[node]
+            node = self.children[2 * node + go_right]
+        return node
+
+    def predict_proba(self, X):
+        X = self._check(X)
+        proba = np.empty((len(X), self.value.shape[1]))
+        step = max(1, _NODES_PER_BATCH // self.n_trees)
+        for start in range(0, len(X), step):
+            leaves = self._leaves(X[start:start + step])
+            proba[start:start + step] = self.value[leaves].sum(axis=1)
+        proba /= self.n_trees
+        return proba
+
+    def predict_proba_row(self, x):
+        # single observation (e.g. the RowPipeline buffer), no conversion or batching
+        if np.isnan(x).any():
+            raise ValueError('Input X contains NaN.')
+        node = self.roots
+        feature, threshold, children = self.feature, self.threshold, self.children
+        for _ in range(self.max_depth):
+            node = children[2 * node + (x[feature[node]] > threshold[node])]
+        return self.value[node].sum(axis=0) / self.n_trees
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+    def save(self, path):
+        np.savez(path, feature=self.feature, threshold=self.threshold, left=self.left, right=self.right,
+                 value=self.value, roots=self.roots, max_depth=self.max_depth, classes=self.classes_,
+                 n_features=self.n_features_in_)
+
+    @classmethod
+    def from_children(cls, children, **arrays):
+        return cls(left=children[0::2], right=children[1::2], children=children, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as arrays:
+            return cls(**{name: arrays[name] for name in arrays.files})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compile the forest of a pipeline artifact into node arrays')
+    parser.add_argument('pipeline', help='joblib pickle of the pipeline (or of the model)')
+    parser.add_argument('output', help='.npz file to write')
+    args = parser.parse_args(argv)
+    import joblib
+    forest = CompiledForest.from_model(joblib.load(args.pipeline))
+    forest.save(args.output)
+    print('%d trees, %d nodes, max depth %d' % (forest.n_trees, len(forest.feature), forest.max_depth))
+
+
+if __name__ == '__main__':
+    main()
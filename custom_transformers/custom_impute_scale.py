@@ -1,37 +1,104 @@
-from sklearn.base import TransformerMixin
-from sklearn.impute import SimpleImputer, KNNImputer
-from sklearn.preprocessing import StandardScaler, power_transform, RobustScaler
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.neighbors import KDTree
+from sklearn.preprocessing import RobustScaler
+from sklearn.utils.validation import check_is_fitted
 import numpy as np
+import threading
+
+num_features = ['time_in_hospital',
+                'num_lab_procedures',
+                'num_procedures',
+                'num_medications',
+                'number_outpatient',
+                'number_emergency',
+                'number_inpatient',
+                'number_diagnoses',
+                'hemoglobin_level']
+
+# guards building the KD-trees, which is rare; lookups of built trees take no lock
+_trees_lock = threading.Lock()
+
+
+class custom_impute_scale(TransformerMixin, BaseEstimator):
+    # KNN imputation (distance weighted, like KNNImputer(n_neighbors=5, weights='distance'))
+    # followed by robust scaling, both fitted once on the training data.
+    #
+    # Donors are the complete training rows. For every missingness pattern a
+    # KD-tree over the observed features of the donors is built (lazily, once),
+    # so imputing a batch costs one tree query per incomplete row instead of a
+    # distance matrix against the whole batch. The trees are a cache, not fitted
+    # state: they are left out of pickles and rebuilt on first use.
+    def __init__(self, n_neighbors=5):
+        self.n_neighbors = n_neighbors
 
-class custom_impute_scale(TransformerMixin):
-    def __init__(self):
-        return None
-    
     def fit(self, df, *args):
+        X = df[num_features].to_numpy(dtype=np.float64)
+        self.donors_ = X[~np.isnan(X).any(axis=1)]
+        if len(self.donors_) == 0:
+            raise ValueError('custom_impute_scale needs at least one training row without missing values')
+        # rows with nothing observed get the training means, as KNNImputer does
+        self.means_ = np.nanmean(X, axis=0)
+        self._trees = {}
+        self.scaler_ = RobustScaler().fit(self._impute(X))
         return self
-    
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop('_trees', None)
+        return state
+
+    def __setstate__(self, state):
+        # pickles from before the trees were a cache have them as trees_
+        state.pop('trees_', None)
+        super().__setstate__(state)
+
+    def _tree(self, observed):
+        key = observed.tobytes()
+        tree = self.__dict__.get('_trees', {}).get(key)
+        if tree is None:
+            with _trees_lock:
+                trees = self.__dict__.setdefault('_trees', {})
+                tree = trees.get(key)
+                if tree is None:
+                    tree = trees[key] = KDTree(self.donors_[:, observed])
+        return tree
+
+    def _impute(self, X):
+        X = X.copy()
+        missing = np.isnan(X)
+        incomplete = np.flatnonzero(missing.any(axis=1))
+        if len(incomplete) == 0:
+            return X
+        k = min(self.n_neighbors, len(self.donors_))
+
+        # group the incomplete rows by missingness pattern
+        patterns, group = np.unique(missing[incomplete], axis=0, return_inverse=True)
+        for i, pattern in enumerate(patterns):
+            rows = incomplete[group.ravel() == i]
+            observed = ~pattern
+            if not observed.any():
+                X[np.ix_(rows, pattern)] = self.means_[pattern]
+                continue
+
+            distances, neighbours = self._tree(observed).query(X[np.ix_(rows, observed)], k=k)
+            # 1 / distance weights; exact matches (distance 0) share all the weight
+            with np.errstate(divide='ignore'):
+                weights = 1.0 / distances
+            exact = np.isinf(weights)
+            has_exact = exact.any(axis=1)
+            weights[has_exact] = exact[has_exact]
+
+            donor_values = self.donors_[neighbours][:, :, pattern]
+            X[np.ix_(rows, pattern)] = ((weights[:, :, None] * donor_values).sum(axis=1)
+                                        / weights.sum(axis=1)[:, None])
+        return X
+
     def transform(self, df, *args):
-       ### Put your transformation here
-        _df = df.copy()
-  
-        num_features = ['time_in_hospital',
-                        'num_lab_procedures',
-                        'num_procedures',
-                        'num_medications',
-                        'number_outpatient',
-                        'number_emergency',
-                        'number_inpatient',
-                        'number_diagnoses',
-                        'hemoglobin_level']
-
-        num_imputer = KNNImputer(n_neighbors = 5,
-                         missing_values = np.nan,
-                         weights = 'distance',
-                         copy = True)
-
-        robust_scaler = RobustScaler()
-
-        _df[num_features] = num_imputer.fit_transform(_df[num_features])
-        _df[num_features] = robust_scaler.fit_transform(_df[num_features])
-                                          
-        return _df
\ No newline at end of file
+        check_is_fitted(self, 'scaler_')
+        # the numeric columns are replaced, everything else is shared with df
+        _df = df.copy(deep=False)
+        X = df[num_features].to_numpy(dtype=np.float64)
+        Xt = self.scaler_.transform(self._impute(X))
+        for j, col in enumerate(num_features):
+            _df[col] = Xt[:, j]
+        return _df
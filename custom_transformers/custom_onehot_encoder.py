@@ -1,37 +1,135 @@
-from sklearn.base import TransformerMixin
-import category_encoders as ce
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.utils.validation import check_is_fitted
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
+import numpy as np
+import scipy.sparse as sp
+
+possible_cats = ['race',
+                 'gender',
+                 'admission_type_code',
+                 'discharge_disposition_code',
+                 'admission_source_code',
+                 'payer_code',
+                 'medical_specialty',
+                 'diag_1',
+                 'diag_2',
+                 'diag_3',
+                 'blood_type']
+
+
+class custom_one_hot(TransformerMixin, BaseEstimator):
+    # compiled=True freezes the vocabulary of every category column at fit(), so
+    # the output has the same width and column order for every batch. Columns are
+    # named and ordered like the category_encoders output (col_value, values in
+    # order of first appearance, col_nan last if the training data had missing
+    # values); unseen and unexpected missing values encode to all zeros.
+    # The dummies are uint8, or with sparse=True the whole output is a float32
+    # CSR matrix whose columns are described by get_feature_names_out().
+    # defaults for pipelines pickled before the compiled mode existed
+    compiled = False
+    sparse = False
+
+    def __init__(self, compiled=False, sparse=False):
+        self.compiled = compiled
+        self.sparse = sparse
 
-class custom_one_hot(TransformerMixin):
-    def __init__(self):
-        return None
-    
     def fit(self, df, *args):
+        if getattr(self, 'compiled', False):
+            self.cats_ = [cat for cat in df.select_dtypes(include = 'category').columns.tolist() if cat in possible_cats]
+            self.vocabulary_ = {}
+            self.has_nan_ = {}
+            for cat in self.cats_:
+                values = pd.unique(df[cat])
+                self.vocabulary_[cat] = [value for value in values if not pd.isna(value)]
+                self.has_nan_[cat] = bool(pd.isna(values).any())
+            self.columns_ = df.columns.tolist()
+            self.feature_names_out_ = []
+            for col in self.columns_:
+                if col in self.vocabulary_:
+                    self.feature_names_out_ += self._dummy_names(col)
+                else:
+                    self.feature_names_out_.append(col)
         return self
-    
+
+    @property
+    def stateless(self):
+        # only the compiled mode learns a vocabulary at fit
+        return not self.compiled
+
+    def _dummy_names(self, cat):
+        names = ['%s_%s' % (cat, value) for value in self.vocabulary_[cat]]
+        if self.has_nan_[cat]:
+            names.append('%s_nan' % cat)
+        return names
+
+    def get_feature_names_out(self, input_features=None):
+        check_is_fitted(self, 'feature_names_out_')
+        return np.array(self.feature_names_out_, dtype=object)
+
+    def _codes(self, series, cat):
+        # position of every row in the frozen vocabulary, -1 for all zeros
+        position = {value: i for i, value in enumerate(self.vocabulary_[cat])}
+        nan_position = len(position) if self.has_nan_[cat] else -1
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            codes, uniques = series.cat.codes.to_numpy(), series.cat.categories
+        else:
+            codes, uniques = pd.factorize(series.to_numpy())
+        table = np.array([position.get(value, -1) for value in uniques] + [nan_position], dtype=np.int32)
+        return np.take(table, codes, mode='wrap')
+
+    def _compiled_transform(self, df):
+        check_is_fitted(self, 'vocabulary_')
+        n = len(df)
+        if self.sparse:
+            # the other columns go into the float32 matrix as they are, so they must already be numbers
+            strings = [col for col in self.columns_ if col not in self.vocabulary_
+                       and not (is_numeric_dtype(df[col]) or is_bool_dtype(df[col]))]
+            if strings:
+                raise ValueError('sparse=True needs numeric columns besides the one-hot categories, '
+                                 'got %s; put custom_oe before custom_one_hot' % ', '.join(strings))
+        blocks = []
+        for col in self.columns_:
+            if col not in self.vocabulary_:
+                blocks.append(df[[col]])
+                continue
+            width = len(self.vocabulary_[col]) + self.has_nan_[col]
+            codes = self._codes(df[col], col)
+            valid = codes >= 0
+            if self.sparse:
+                indptr = np.concatenate([[0], np.cumsum(valid)])
+                blocks.append(sp.csr_matrix((np.ones(valid.sum(), dtype=np.float32), codes[valid], indptr),
+                                            shape=(n, width)))
+            else:
+                dummies = np.zeros((n, width), dtype=np.uint8)
+                dummies[np.flatnonzero(valid), codes[valid]] = 1
+                blocks.append(pd.DataFrame(dummies, columns=self._dummy_names(col), index=df.index))
+
+        if not self.sparse:
+            return pd.concat(blocks, axis=1)
+        return sp.hstack([block if sp.issparse(block) else sp.csr_matrix(block.to_numpy(dtype=np.float32))
+                          for block in blocks], format='csr')
+
     def transform(self, df, *args):
+        # pipelines pickled before the compiled mode existed have no `compiled` attribute
+        if getattr(self, 'compiled', False):
+            return self._compiled_transform(df)
+
        ### Put your transformation here
-        _df = df.copy()
-        
-        possible_cats = ['race',
-                         'gender',
-                         'admission_type_code',
-                         'discharge_disposition_code',
-                         'admission_source_code',
-                         'payer_code',
-                         'medical_specialty',
-                         'diag_1',
-                         'diag_2',
-                         'diag_3',
-                         'blood_type']
-        
+        # imported here, serving with the compiled mode never needs category_encoders
+        import category_encoders as ce
+
+        # category_encoders deep copies its input itself
+        _df = df.copy(deep=False)
+
         cats = [cat for cat in _df.select_dtypes(include = 'category').columns.tolist() if cat in possible_cats]
-        
+
         if len(cats) == 0:
             return _df
-        
+
         oh = ce.OneHotEncoder(cols = cats,
                            handle_unknown='value',
                            handle_missing='value',
                            use_cat_names = True)
 
-        return oh.fit_transform(_df)
\ No newline at end of file
+        return oh.fit_transform(_df)
@@ -1,16 +1,75 @@
-from sklearn.base import TransformerMixin
-import category_encoders as ce
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.utils.validation import check_is_fitted
 
-class custom_oe(TransformerMixin):
-    def __init__(self):
-        return None
+from custom_transformers.compiled_encoder import OrdinalTables
+
+
+mapping = [{'col': 'age', 'mapping': {'0-10':1,
+                                      '10-20':2,
+                                      '20-30':3,
+                                      '30-40':4,
+                                      '40-50':5,
+                                      '50-60':6,
+                                      '60-70':7,
+                                      '70-80':8,
+                                      '80-90':9,
+                                      '90-100':10}},
+        
+           {'col': 'weight', 'mapping': {'0-25':1,
+                                         '25-50':2, 
+                                         '50-75':3,
+                                         '75-100':4,
+                                         '100-125':5, 
+                                         '125-150':6, 
+                                         '150-175':7, 
+                                         '175-200':8, 
+                                         '>200':9}},
+           
+           {'col': 'max_glu_serum', 'mapping': {'norm':1,
+                                                '>200':2,
+                                                '>300':3,}},
+           
+           {'col': 'A1Cresult', 'mapping': {'norm':1,
+                                                '>7':2,
+                                                '>8':3,}},
+          
+           {'col': 'complete_vaccination_status', 'mapping': {'Complete':1,
+                                                              'Incomplete':0}}]
+
+
+class custom_oe(TransformerMixin, BaseEstimator):
+    # the output only depends on the fixed mapping
+    stateless = True
+
+    # default for pipelines pickled before the compiled mode existed
+    compiled = False
+
+    def __init__(self, compiled=False):
+        self.compiled = compiled
     
     def fit(self, df, *args):
+        if getattr(self, 'compiled', False):
+            # mapping tables compiled once, see compiled_encoder
+            self.tables_ = OrdinalTables(mapping).fit(df)
         return self
+
+    def encode_into(self, df, out):
+        # writes the encoded [m['col'] for m in mapping] columns into a caller supplied array
+        check_is_fitted(self, 'tables_')
+        return self.tables_.encode_into(df, out)
     
     def transform(self, df, *args):
+        # pipelines pickled before the compiled mode existed have no `compiled` attribute
+        if getattr(self, 'compiled', False):
+            check_is_fitted(self, 'tables_')
+            return self.tables_.transform(df)
+
        ### Put your transformation here
-        _df = df.copy()
+        # imported here, serving with the compiled mode never needs category_encoders
+        import category_encoders as ce
+
+        # category_encoders deep copies its input itself
+        _df = df.copy(deep=False)
   
         orde = ce.OrdinalEncoder(verbose=1,
                         cols=['age',
@@ -20,36 +79,6 @@ class custom_oe(TransformerMixin):
                                'complete_vaccination_status'],
                          handle_unknown='value',
                          handle_missing='value',
-                         mapping = [{'col': 'age', 'mapping': {'0-10':1,
-                                                               '10-20':2,
-                                                               '20-30':3,
-                                                               '30-40':4,
-                                                               '40-50':5,
-                                                               '50-60':6,
-                                                               '60-70':7,
-                                                               '70-80':8,
-                                                               '80-90':9,
-                                                               '90-100':10}},
-        
-                                    {'col': 'weight', 'mapping': {'0-25':1,
-                                                                  '25-50':2, 
-                                                                  '50-75':3,
-                                                                  '75-100':4,
-                                                                  '100-125':5, 
-                                                                  '125-150':6, 
-                                                                  '150-175':7, 
-                                                                  '175-200':8, 
-                                                                  '>200':9}},
-                                    
-                                    {'col': 'max_glu_serum', 'mapping': {'norm':1,
-                                                                         '>200':2,
-                                                                         '>300':3,}},
-                                    
-                                    {'col': 'A1Cresult', 'mapping': {'norm':1,
-                                                                         '>7':2,
-                                                                         '>8':3,}},
-                                   
-                                    {'col': 'complete_vaccination_status', 'mapping': {'Complete':1,
-                                                                                       'Incomplete':0}}])
+                         mapping = mapping)
                                           
         return orde.fit_transform(_df)
\ No newline at end of file
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.utils.validation import check_is_fitted
+
+from custom_transformers import diagnosis_index
+from custom_transformers.compiled_converter import convert_diag
+
+
+# Learns the readmission risk buckets of the diag_*_risk columns from labelled
+# admissions, instead of the hand computed diag_readmission table of
+# diagnosis_index:
+#
+#   learner = DiagnosisRiskLearner().fit(X_train, y_train)
+#   learner.partial_fit(X_new, y_new)                 # e.g. moment_1 with actual_readmitted
+#   ColumnConverter(risk_table=learner.export())      # preprocessor_redeploy, scores with the learned buckets
+#
+# Like the notebook that computed diag_readmission, a code is the lowercase 3
+# character prefix of the diagnosis, missing values and prefixes that are not
+# risk codes count as 'unknown', and a code's bucket follows from its
+# readmission rate in percent: below 5 very_low, below 15 low, below 25
+# medium, below 50 medium_high, else high (cut_points). Codes never seen stay
+# without a bucket (NaN).
+#
+# The learner only keeps two counters per diagnosis slot and column (rows and
+# readmissions), filled with one bincount per column over the slots of the
+# distinct raw codes, so partial_fit costs O(new rows) and the buckets of the
+# whole history are recomputed from the counters alone. export() freezes them
+# into a table in the format of diag_readmission (JSON-able, so it also goes
+# into the row mode spec of a model bundle). transform() returns the
+# diag_*_risk columns of the learned buckets.
+
+_RISK_SLOTS = np.full(diagnosis_index.N_SLOTS, diagnosis_index.UNKNOWN_SLOT, dtype=np.int16)
+for _code in diagnosis_index.risk_codes:
+    if len(_code) <= 3:
+        _RISK_SLOTS[diagnosis_index.prefix_slot(_code)] = diagnosis_index.prefix_slot(_code)
+
+
+def _code(slot):
+    if slot == diagnosis_index.UNKNOWN_SLOT:
+        return 'unknown'
+    if slot >= diagnosis_index.E_OFFSET:
+        return 'e%d' % (slot - diagnosis_index.E_OFFSET)
+    if slot >= diagnosis_index.V_OFFSET:
+        return 'v%d' % (slot - diagnosis_index.V_OFFSET)
+    return str(slot)
+
+
+def _target(y):
+    y = pd.Series(np.asarray(y))
+    if y.dtype == object:
+        # 'Yes' / 'No' as in the raw readmitted column
+        y = y == 'Yes'
+    return y.to_numpy(dtype=np.float64)
+
+
+class DiagnosisRiskLearner(TransformerMixin, BaseEstimator):
+    def __init__(self, columns=('diag_1', 'diag_2', 'diag_3'), cut_points=(5, 15, 25, 50)):
+        self.columns = columns
+        self.cut_points = cut_points
+
+    def fit(self, X, y):
+        for attr in ('rows_', 'readmissions_'):
+            if hasattr(self, attr):
+                delattr(self, attr)
+        return self.partial_fit(X, y)
+
+    def partial_fit(self, X, y):
+        if not hasattr(self, 'rows_'):
+            self.rows_ = np.zeros((len(self.columns), diagnosis_index.N_SLOTS), dtype=np.int64)
+            self.readmissions_ = np.zeros((len(self.columns), diagnosis_index.N_SLOTS), dtype=np.int64)
+        target = _target(y)
+        for i, col in enumerate(self.columns):
+            codes, uniques = pd.factorize(X[col])
+            # slot of every distinct raw code, then of every row (-1, missing, is the trailing slot)
+            slots = _RISK_SLOTS[diagnosis_index.slots(list(uniques))][codes]
+            self.rows_[i] += np.bincount(slots, minlength=diagnosis_index.N_SLOTS)
+            self.readmissions_[i] += np.bincount(slots, weights=target,
+                                                 minlength=diagnosis_index.N_SLOTS).round().astype(np.int64)
+        return self
+
+    def buckets(self):
+        # (columns, slots) index into diagnosis_index.ordered_risk, -1 for codes never seen
+        check_is_fitted(self, 'rows_')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = 100 * self.readmissions_ / self.rows_
+        buckets = 1 + np.searchsorted(np.asarray(self.cut_points, dtype=np.float64), rate, side='right')
+        return np.where(self.rows_ > 0, buckets, -1)
+
+    def export(self):
+        # {'diag_1_risk': {'very_low': [codes], ...}, ...}, the format of diagnosis_index.diag_readmission
+        table = {}
+        for col, buckets in zip(self.columns, self.buckets()):
+            codes = {bucket: [] for bucket in diagnosis_index.risk_buckets}
+            for slot in np.flatnonzero(buckets >= 0):
+                codes[diagnosis_index.ordered_risk[buckets[slot]]].append(_code(slot))
+            table[col + '_risk'] = {bucket: sorted(values) for bucket, values in codes.items()}
+        return table
+
+    def transform(self, X):
+        tables = diagnosis_index.tables_for(self.export())
+        return pd.DataFrame({col + '_risk': convert_diag(X[col], col + '_risk', tables=tables)[1]
+                             for col in self.columns}, index=X.index)
@@ -0,0 +1,227 @@
+import bisect
+import json
+
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.utils.validation import check_is_fitted
+
+
+# Streaming population drift monitor over the output of ColumnConverter.
+#
+#   monitor = DriftMonitor().fit(ColumnConverter().transform(X_train))   # the training baseline
+#   pipeline = make_pipeline(ColumnConverter(), monitor, custom_oe(), ...)
+#   ...                                          # every transform() updates the counts
+#   monitor.report()                             # {'race': {'psi': ..., 'kl': ..., 'rows': ...}, ...}
+#
+# Fitting (fit, or fit_transform when the pipeline is fitted) only sets the
+# baseline, the training rows are not counted as production traffic. A column
+# without production rows yet has None for psi and kl in report().
+#
+# Every monitored column is a fixed set of bins:
+#   - categorical columns (race, gender, payer_code, diag chapters, risk buckets):
+#     the training labels (at most max_categories, most frequent first), 'other'
+#     for labels the baseline never saw, and 'missing'
+#   - numeric columns: bins between the training quantiles (bins of them, so
+#     the baseline is about uniform over them, plus the TAIL quantiles, the
+#     minimum and the maximum) and 'missing'
+# All bins live in one flat count array, so a summary takes constant memory,
+# summaries of several workers are merged by adding their counts (merge(),
+# counts()), nothing of the raw data is kept, and PSI / KL against the
+# baseline are a few vectorized sums over that array. transform() updates it
+# with one bincount per column; update_row() does the same for a single row of
+# converted cells (a dict) in O(columns).
+#
+# The numeric "sketch" is a histogram on the training quantiles rather than a
+# general quantile sketch: it is exact for PSI on those bins, mergeable, and
+# quantiles() interpolates production quantiles from it.
+
+categorical_columns = ['race', 'gender', 'payer_code', 'diag_1', 'diag_2', 'diag_3',
+                       'diag_1_risk', 'diag_2_risk', 'diag_3_risk']
+numeric_columns = ['time_in_hospital', 'num_lab_procedures', 'num_procedures', 'num_medications',
+                   'number_outpatient', 'number_emergency', 'number_inpatient', 'number_diagnoses',
+                   'hemoglobin_level']
+
+TAIL = [0.99, 0.999]
+OTHER = 'other'
+MISSING = 'missing'
+
+
+def _labels(series, max_categories):
+    counts = series.value_counts(dropna=True)
+    return [label for label in counts.index[:max_categories]]
+
+
+def _edges(series, bins):
+    values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return []
+    # the tail quantiles and the extremes bound the outer bins, so upper tail drift shows in quantiles()
+    q = np.concatenate([[0.0], np.linspace(0, 1, bins + 1)[1:-1], TAIL, [1.0]])
+    return np.unique(np.quantile(values, np.sort(q))).tolist()
+
+
+class DriftMonitor(TransformerMixin, BaseEstimator):
+    def __init__(self, categorical=None, numeric=None, bins=10, max_categories=50):
+        self.categorical = categorical
+        self.numeric = numeric
+        self.bins = bins
+        self.max_categories = max_categories
+
+    def fit(self, X, y=None):
+        categorical = categorical_columns if self.categorical is None else self.categorical
+        numeric = numeric_columns if self.numeric is None else self.numeric
+        # column -> ('categorical', labels) or ('numeric', edges); bins are the labels
+        # (or the intervals between edges) followed by 'other' (categorical only) and 'missing'
+        self.layout_ = {}
+        for col in categorical:
+            if col in X:
+                self.layout_[col] = ('categorical', _labels(X[col], self.max_categories))
+        for col in numeric:
+            if col in X:
+                self.layout_[col] = ('numeric', _edges(X[col], self.bins))
+        self._index()
+        self.baseline_ = self._count(X).astype(np.float64)
+        self.counts_ = np.zeros_like(self.baseline_, dtype=np.int64)
+        return self
+
+    def _index(self):
+        # offsets of every column in the flat arrays, and label -> bin lookups
+        self.offsets_ = {}
+        self._lookup = {}
+        offset = 0
+        for col, (kind, values) in self.layout_.items():
+            self.offsets_[col] = offset
+            if kind == 'categorical':
+                self._lookup[col] = {label: i for i, label in enumerate(values)}
+            offset += len(values) + 2
+        self.size_ = offset
+        self._starts = np.array(list(self.offsets_.values()), dtype=np.intp)
+        self._sizes = np.diff(np.append(self._starts, offset))
+        self._expected = None
+
+    def _bins(self, col, series):
+        # bin (within the column) of every value of series
+        kind, values = self.layout_[col]
+        if kind == 'numeric':
+            x = series.to_numpy(dtype=np.float64, na_value=np.nan)
+            bins = np.searchsorted(values, x, side='right')
+            bins[np.isnan(x)] = len(values) + 1
+            return bins
+        lookup = self._lookup[col]
+        codes, uniques = pd.factorize(series)
+        table = np.array([lookup.get(label, len(values)) for label in uniques] + [len(values) + 1], dtype=np.intp)
+        return table[codes]
+
+    def _count(self, X):
+        counts = np.zeros(self.size_, dtype=np.int64)
+        for col, offset in self.offsets_.items():
+            if col not in X:
+                continue
+            kind, values = self.layout_[col]
+            size = len(values) + 2
+            counts[offset:offset + size] += np.bincount(self._bins(col, X[col]), minlength=size)
+        return counts
+
+    def fit_transform(self, X, y=None, **fit_params):
+        # fitting in a pipeline sets the baseline without counting X as production rows
+        self.fit(X, y)
+        return X
+
+    def transform(self, X):
+        check_is_fitted(self, 'counts_')
+        self.counts_ += self._count(X)
+        return X
+
+    def update_row(self, row):
+        # one row of converted cells, e.g. {'race': 'white', 'num_lab_procedures': 41.0, ...}
+        counts, lookup = self.counts_, self._lookup
+        for col, offset in self.offsets_.items():
+            kind, values = self.layout_[col]
+            value = row.get(col)
+            if value is None or value != value:
+                counts[offset + len(values) + 1] += 1
+            elif kind == 'numeric':
+                counts[offset + bisect.bisect_right(values, value)] += 1
+            else:
+                counts[offset + lookup[col].get(value, len(values))] += 1
+
+    def merge(self, other):
+        # adds the counts of another monitor (e.g. from another worker) with the same baseline
+        counts = other.counts_ if isinstance(other, DriftMonitor) else np.asarray(other)
+        if counts.shape != self.counts_.shape:
+            raise ValueError('cannot merge counts of a different layout')
+        self.counts_ += counts
+        return self
+
+    def counts(self):
+        return self.counts_.copy()
+
+    def reset(self):
+        self.counts_[:] = 0
+
+    def report(self, epsilon=1e-4):
+        # per column PSI and KL(production || baseline) over the bins, and the production rows
+        check_is_fitted(self, 'counts_')
+        if self._expected is None or self._expected[0] != epsilon:
+            self._expected = (epsilon, np.maximum(self._shares(self.baseline_)[0], epsilon))
+        expected = self._expected[1]
+        actual, rows = self._shares(self.counts_)
+        actual = np.maximum(actual, epsilon)
+        log_ratio = np.log(actual / expected)
+        psi = np.add.reduceat((actual - expected) * log_ratio, self._starts)
+        kl = np.add.reduceat(actual * log_ratio, self._starts)
+        # no production rows: nothing to compare with the baseline yet
+        return {col: {'psi': float(psi[i]) if rows[i] else None, 'kl': float(kl[i]) if rows[i] else None,
+                      'rows': int(rows[i])}
+                for i, col in enumerate(self.offsets_)}
+
+    def _shares(self, counts):
+        # counts as a share of their column's rows, and the rows per column
+        rows = np.add.reduceat(counts, self._starts)
+        return counts / np.repeat(np.maximum(rows, 1), self._sizes), rows
+
+    def distribution(self, col, baseline=False):
+        # share of rows per bin of a column, in production or in the baseline
+        kind, values = self.layout_[col]
+        offset = self.offsets_[col]
+        counts = (self.baseline_ if baseline else self.counts_)[offset:offset + len(values) + 2]
+        if kind == 'numeric':
+            bounds = ['-inf'] + ['%g' % edge for edge in values] + ['inf']
+            names = ['[%s, %s)' % pair for pair in zip(bounds, bounds[1:])] + [MISSING]
+        else:
+            names = list(values) + [OTHER, MISSING]
+        total = counts.sum()
+        return pd.Series(counts / total if total else counts * 0.0, index=names, name=col)
+
+    def quantiles(self, col, q=(0.5, 0.9, 0.99)):
+        # production quantiles of a numeric column, interpolated within the bins
+        kind, edges = self.layout_[col]
+        if kind != 'numeric' or not edges:
+            raise ValueError('%s is not a numeric column with bins' % col)
+        offset = self.offsets_[col]
+        counts = self.counts_[offset:offset + len(edges) + 1].astype(np.float64)
+        cumulative = np.cumsum(counts) / max(counts.sum(), 1)
+        # the outer bins only hold values beyond the training minimum and maximum, clamped to them
+        points = np.array(edges[:1] + edges + edges[-1:], dtype=np.float64)
+        return {quantile: float(np.interp(quantile, np.concatenate([[0.0], cumulative]), points))
+                for quantile in q}
+
+    def to_json(self):
+        # layout, baseline and counts, e.g. to store the baseline with a model or ship counts between processes
+        check_is_fitted(self, 'counts_')
+        layout = {col: [kind, [value.item() if isinstance(value, np.generic) else value for value in values]]
+                  for col, (kind, values) in self.layout_.items()}
+        return json.dumps({'params': self.get_params(), 'layout': layout,
+                           'baseline': self.baseline_.tolist(), 'counts': self.counts_.tolist()})
+
+    @classmethod
+    def from_json(cls, text):
+        state = json.loads(text)
+        monitor = cls(**state['params'])
+        monitor.layout_ = {col: (kind, values) for col, (kind, values) in state['layout'].items()}
+        monitor._index()
+        monitor.baseline_ = np.array(state['baseline'], dtype=np.float64)
+        monitor.counts_ = np.array(state['counts'], dtype=np.int64)
+        return monitor
@@ -0,0 +1,363 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from custom_transformers import diagnosis_index
+from custom_transformers.cache import is_stateless
+from custom_transformers.loader import TRAIN_DATA, _decode_column, _encode_column, load_train_data, raw_columns
+
+
+# Local store of the output of the deterministic stages (ColumnConverter ->
+# custom_oe) per admission, so a retrain only converts the admissions it has
+# not seen before:
+#
+#   store = FeatureStore('data/.features', [ColumnConverter(), custom_oe()])
+#   X = store.features(raw)          # raw observations indexed by admission_id, as converted by the steps
+#   store.stats                      # {'rows': ..., 'converted': ..., 'reused': ..., 'stale_columns': [...],
+#                                    #  'pending': stored rows left to convert again}
+#   pipeline[2:].fit(X, y)           # SelectColumns -> ColumnTransformer -> model on the stored features
+#   store.matrix(columns=['age', 'num_medications'])   # float32, categoricals as their codes
+#
+#   python -m custom_transformers.feature_store --redeploy --requests data/moment_1_requests.csv
+#
+# features() hashes every raw row (pd.util.hash_pandas_object, so the hash
+# covers the raw columns and dtypes as passed). Rows whose admission_id is
+# stored with the same hash are read from the store, new and changed rows go
+# through the steps and are upserted. The result is the output of the steps
+# on raw, with the index of raw, in the dtypes of the steps that stored it
+# (the compiled and legacy custom_oe store the same values as int8 and
+# float64). Every source has to give the same raw columns (e.g.
+# loader.raw_columns()), as the converter passes extra ones through.
+#
+# Every output column has a version: the steps it depends on and their
+# settings for that column (the converter class and its parameters, the
+# column's entry of risk_table or of diagnosis_index.diag_readmission for the
+# diag_*_risk columns, the encoder class and the column's entry of its mapping
+# for the ordinal columns; compiled is left out, it does not change the
+# output). A column whose version changed is stale: it is recomputed for the
+# rows of raw and the other columns keep their files. Stored rows missing
+# from raw keep their old values of it, marked pending (a boolean file per
+# column); features() converts pending rows again when they come back, and
+# matrix() refuses to read them.
+# A change to the conversion code itself has no version, bump FORMAT for that.
+#
+# The store is a directory like the cache of custom_transformers.loader: the
+# sorted admission ids, the row hashes and one .npy file per column
+# (categoricals as codes, their categories in the manifest), loaded
+# memory-mapped. An upsert merges the new rows into the sorted arrays and
+# writes the columns it changed as new files, then replaces the manifest; a
+# reader of the previous manifest still finds its files. One writer at a time.
+
+FORMAT = 1
+MANIFEST = 'manifest.json'
+
+
+def _step_name(step):
+    return '%s.%s' % (type(step).__module__, type(step).__name__)
+
+
+def _jsonable(value):
+    if isinstance(value, dict):
+        return {str(key): _jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(item) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _step_version(step, col):
+    # what col depends on in step, None if step passes it through unchanged
+    mapping = getattr(sys.modules[type(step).__module__], 'mapping', None)
+    if mapping is not None:
+        # custom_oe: only the columns of its mapping change
+        entry = next((m for m in mapping if m['col'] == col), None)
+        return None if entry is None else [_step_name(step), sorted(_jsonable(entry['mapping']).items())]
+    params = {name: value for name, value in step.get_params().items() if name not in ('compiled', 'risk_table')}
+    if 'risk_table' in step.get_params() and col.endswith('_risk'):
+        params['risk_table'] = (step.risk_table or diagnosis_index.diag_readmission).get(col)
+    return [_step_name(step), params]
+
+
+def column_versions(steps, columns):
+    return {col: hashlib.sha256(json.dumps([FORMAT] + [_step_version(step, col) for step in steps],
+                                           sort_keys=True, default=str).encode()).hexdigest()[:16]
+            for col in columns}
+
+
+def _code_dtype(n):
+    return np.int8 if n < 128 else np.int16 if n < 32768 else np.int32
+
+
+def _union(old, new):
+    # categories of both, sorted when both are (the converter's astype('category') sorts them)
+    if old == new:
+        return old
+    merged = old + [label for label in new if label not in set(old)]
+    try:
+        if old == sorted(old) and new == sorted(new):
+            merged = sorted(merged)
+    except TypeError:
+        pass
+    return merged
+
+
+def _recode(codes, categories, merged):
+    table = np.append(pd.Index(merged).get_indexer(categories), -1).astype(_code_dtype(len(merged)))
+    return table[np.asarray(codes)]
+
+
+class FeatureStore:
+    def __init__(self, path, steps):
+        self.path = path
+        self.steps = list(steps)
+        for step in self.steps:
+            if not is_stateless(step):
+                raise ValueError('only stateless steps can be stored, not %s' % _step_name(step))
+        self.stats = {}
+
+    def _manifest(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST)) as fh:
+                manifest = json.load(fh)
+        except FileNotFoundError:
+            return None
+        return manifest if manifest.get('format') == FORMAT else None
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, name), mmap_mode='r', allow_pickle=False)
+
+    def _pending(self, manifest, columns=None):
+        # stored rows with a value of an older version in any of columns (all by default)
+        pending = np.zeros(manifest['rows'], dtype=bool)
+        for entry in manifest['columns']:
+            if 'pending' in entry and (columns is None or entry['name'] in columns):
+                pending |= self._load(entry['pending'])
+        return pending
+
+    def _transform(self, raw):
+        X = raw
+        for step in self.steps:
+            X = step.fit_transform(X)
+        return X
+
+    def features(self, raw):
+        if not raw.index.is_unique:
+            raise ValueError('the index of raw (admission_id) must be unique')
+        ids = np.asarray(raw.index, dtype=np.int64)
+        hashes = pd.util.hash_pandas_object(raw, index=False).to_numpy()
+        manifest = self._manifest()
+
+        fresh = np.zeros(len(raw), dtype=bool)
+        stale = []
+        if manifest is not None:
+            stored_ids, stored_hashes = self._load(manifest['ids']), self._load(manifest['hashes'])
+            at = np.searchsorted(stored_ids, ids).clip(max=max(len(stored_ids) - 1, 0))
+            if len(stored_ids):
+                # rows pending in some column are converted again
+                fresh = (stored_ids[at] == ids) & (stored_hashes[at] == hashes) & ~self._pending(manifest)[at]
+            versions = column_versions(self.steps, [entry['name'] for entry in manifest['columns']])
+            stale = [entry['name'] for entry in manifest['columns'] if versions[entry['name']] != entry['version']]
+
+        if manifest is None and not len(raw):
+            return self._transform(raw)
+        # stale columns are recomputed for every row of raw
+        convert = np.ones(len(raw), dtype=bool) if stale else ~fresh
+        if convert.any():
+            converted = self._transform(raw[convert])
+            stored = [entry['name'] for entry in manifest['columns']] if manifest is not None else None
+            if stored is not None and list(converted.columns) != stored:
+                if len(stale) < len(stored):
+                    # the same steps on other raw columns, e.g. extra fields they pass through
+                    raise ValueError('raw gives the columns %s, the store has %s; pass the same raw columns'
+                                     % (list(converted.columns), stored))
+                # other steps: a new store
+                manifest = None
+            changed = stale if fresh[convert].all() else list(converted.columns)
+            manifest = self._upsert(manifest, ids[convert], hashes[convert], converted, changed, stale)
+        self.stats = {'rows': len(raw), 'converted': int(convert.sum()), 'reused': int(len(raw) - convert.sum()),
+                      'stale_columns': stale, 'pending': int(self._pending(manifest).sum())}
+        return self._read(manifest, ids, raw.index)
+
+    def _upsert(self, manifest, ids, hashes, converted, changed, stale=()):
+        # merges converted (rows ids) into the store and writes the changed columns; the other
+        # stored rows of the stale columns keep their old values as pending
+        os.makedirs(self.path, exist_ok=True)
+        generation = 0 if manifest is None else manifest['generation'] + 1
+        if manifest is None:
+            stored_ids, stored_hashes, entries = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint64), {}
+        else:
+            stored_ids, stored_hashes = self._load(manifest['ids']), self._load(manifest['hashes'])
+            entries = {entry['name']: entry for entry in manifest['columns']}
+        all_ids = np.union1d(stored_ids, ids)
+        same_rows = np.array_equal(all_ids, stored_ids)
+        old_at, new_at = np.searchsorted(all_ids, stored_ids), np.searchsorted(all_ids, ids)
+        rows = np.zeros(len(all_ids), dtype=np.uint64)
+        rows[old_at] = stored_hashes
+        rows[new_at] = hashes
+
+        def save(name, values):
+            filename = '%s.%d.npy' % (name, generation)
+            np.save(os.path.join(self.path, filename), values, allow_pickle=False)
+            return filename
+
+        def pending(col, old):
+            # rows whose value of col is from an older version, {} when there are none
+            rows_pending = np.zeros(len(all_ids), dtype=bool)
+            if old is not None and 'pending' in old:
+                rows_pending[old_at] = self._load(old['pending'])
+            if col in stale:
+                rows_pending[old_at] = True
+            rows_pending[new_at] = False
+            return {'pending': save(col + '.pending', rows_pending)} if rows_pending.any() else {}
+
+        versions = column_versions(self.steps, converted.columns)
+        columns = []
+        for col in converted.columns:
+            old = entries.get(col)
+            if col not in changed and same_rows:
+                columns.append(old)
+                continue
+            entry, values = _encode_column(converted[col])
+            if old is not None and len(stored_ids) and len(ids) < len(all_ids):
+                old_values = self._load(old['file'])
+                if 'categories' in entry and 'categories' in old:
+                    merged = _union(old['categories'], entry['categories'])
+                    old_values = _recode(old_values, old['categories'], merged)
+                    values = _recode(values, entry['categories'], merged)
+                    entry['categories'] = merged
+                elif ('categories' in entry) != ('categories' in old) or entry['dtype'] != old['dtype']:
+                    # e.g. a flag that is bool in one batch and object (with missing values) in the other
+                    combined = np.empty(len(all_ids), dtype=object)
+                    combined[old_at] = np.asarray(_decode_column(old, old_values), dtype=object)
+                    combined[new_at] = converted[col].to_numpy(dtype=object)
+                    entry, values = _encode_column(pd.Series(combined).infer_objects())
+                    columns.append(dict(name=col, version=versions[col], file=save(col, values),
+                                        **pending(col, old), **entry))
+                    continue
+                merged_values = np.empty(len(all_ids), dtype=np.result_type(old_values, values))
+                merged_values[old_at] = old_values
+                merged_values[new_at] = values
+                values = merged_values
+            else:
+                ordered = np.empty_like(values)
+                ordered[new_at] = values
+                values = ordered
+            columns.append(dict(name=col, version=versions[col], file=save(col, values), **pending(col, old),
+                                **entry))
+
+        ids_file = manifest['ids'] if same_rows else save('_ids', all_ids)
+        hashes_file = manifest['hashes'] if same_rows and np.array_equal(rows, stored_hashes) else \
+            save('_hashes', rows)
+        manifest = {'format': FORMAT, 'generation': generation, 'steps': [_step_name(step) for step in self.steps],
+                    'rows': len(all_ids), 'ids': ids_file, 'hashes': hashes_file, 'columns': columns}
+        tmp = os.path.join(self.path, '%s.tmp-%d' % (MANIFEST, os.getpid()))
+        with open(tmp, 'w') as fh:
+            json.dump(manifest, fh)
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+        # files of earlier generations
+        keep = {MANIFEST, manifest['ids'], manifest['hashes']} | {entry['file'] for entry in columns} | \
+            {entry['pending'] for entry in columns if 'pending' in entry}
+        for name in os.listdir(self.path):
+            if name not in keep and '.tmp-' not in name:
+                os.remove(os.path.join(self.path, name))
+        return manifest
+
+    def _read(self, manifest, ids, index):
+        stored_ids = self._load(manifest['ids'])
+        at = np.searchsorted(stored_ids, ids)
+        # the whole store in its order: the memory-mapped arrays as they are
+        everything = len(ids) == len(stored_ids) and np.array_equal(stored_ids, ids)
+        data = {}
+        for entry in manifest['columns']:
+            values = self._load(entry['file'])
+            data[entry['name']] = _decode_column(entry, values if everything else values[at])
+        return pd.DataFrame(data, index=index, columns=[entry['name'] for entry in manifest['columns']])
+
+    def matrix(self, ids=None, columns=None):
+        # float32 (rows, columns) of the stored features (all rows, in admission_id order, by
+        # default); categoricals as their codes, missing values NaN
+        manifest = self._manifest()
+        if manifest is None:
+            raise ValueError('%s is empty' % self.path)
+        entries = {entry['name']: entry for entry in manifest['columns']}
+        columns = list(entries) if columns is None else list(columns)
+        stored_ids = self._load(manifest['ids'])
+        at = None
+        if ids is not None:
+            ids = np.asarray(ids, dtype=np.int64)
+            at = np.searchsorted(stored_ids, ids).clip(max=max(len(stored_ids) - 1, 0))
+            if not len(stored_ids) or (stored_ids[at] != ids).any():
+                raise KeyError('admission ids not in the store')
+        pending = self._pending(manifest, columns)
+        pending = pending if at is None else pending[at]
+        if pending.any():
+            raise ValueError('%d rows have values of an older version of these columns; pass them to '
+                             'features() first' % pending.sum())
+        out = np.empty((len(stored_ids) if at is None else len(at), len(columns)), dtype=np.float32)
+        for j, col in enumerate(columns):
+            entry = entries[col]
+            values = self._load(entry['file'])
+            values = values if at is None else values[at]
+            out[:, j] = values
+            if 'categories' in entry:
+                out[values < 0, j] = np.nan
+        return out
+
+    def info(self):
+        manifest = self._manifest()
+        if manifest is None:
+            return {'path': self.path, 'rows': 0}
+        return {'path': self.path, 'rows': manifest['rows'], 'generation': manifest['generation'],
+                'steps': manifest['steps'], 'columns': [entry['name'] for entry in manifest['columns']],
+                'pending': int(self._pending(manifest).sum()),
+                'bytes': sum(os.path.getsize(os.path.join(self.path, name)) for name in os.listdir(self.path))}
+
+
+def read_requests(path):
+    # raw observations of a moment_1 style request log, indexed by admission_id
+    log = pd.read_csv(path, usecols=['admission_id', 'observation'], dtype={'observation': str})
+    log = log.dropna(subset=['observation'])
+    df = pd.DataFrame.from_records(json.loads('[' + ','.join(log['observation']) + ']'))
+    df.index = pd.Index(log['admission_id'].to_numpy(), name='admission_id')
+    return df.drop(columns=[col for col in ('index', 'admission_id') if col in df.columns])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Update the feature store with train data and request logs')
+    parser.add_argument('--store', default=os.path.join('data', '.features'))
+    parser.add_argument('--train', default=TRAIN_DATA, help='train_data.csv, empty to skip it')
+    parser.add_argument('--requests', nargs='*', default=[], help='moment_1 style request logs')
+    parser.add_argument('--redeploy', action='store_true', help='the converter and encoder of the redeploy')
+    parser.add_argument('--lean', action='store_true', help='the memory-lean converter')
+    args = parser.parse_args(argv)
+
+    if args.redeploy:
+        from custom_transformers.preprocessor_redeploy import ColumnConverter
+        from custom_transformers.custom_ordinal_encoder_redeploy import custom_oe
+    else:
+        from custom_transformers.preprocessor import ColumnConverter
+        from custom_transformers.custom_ordinal_encoder import custom_oe
+    store = FeatureStore(args.store, [ColumnConverter(compiled=True, lean=args.lean), custom_oe(compiled=True)])
+    sources = ([args.train] if args.train else []) + args.requests
+    for source in sources:
+        start = time.perf_counter()
+        if source in args.requests:
+            raw = read_requests(source)
+        else:
+            raw = load_train_data(source).set_index('admission_id')
+        # every source with the columns the converter reads, in the same order
+        raw = raw[raw_columns(index=None, target=None)]
+        store.features(raw)
+        print('%s: %s in %.2f s' % (source, json.dumps(store.stats), time.perf_counter() - start), file=sys.stderr)
+    print(json.dumps(store.info()))
+
+
+if __name__ == '__main__':
+    main()
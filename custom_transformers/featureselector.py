@@ -1,13 +1,13 @@
-from sklearn.base import TransformerMixin
+from sklearn.base import BaseEstimator, TransformerMixin
 import pandas as pd
 import numpy as np
 
-class SelectColumns(TransformerMixin):
+class SelectColumns(TransformerMixin, BaseEstimator):
+    stateless = True
     def __init__(self, cols=[]):
         self.cols = cols
     def fit(self, X=None, y=None, **fit_params):
         return self
     def transform(self, data):
-        X = data.copy()
-        X = X[self.cols]
-        return X
\ No newline at end of file
+        # selecting the columns already copies them, no need to copy the whole frame first
+        return data[self.cols]
\ No newline at end of file
@@ -0,0 +1,293 @@
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from custom_transformers import diagnosis_index
+
+
+# Prebuilt, memory-mapped index of the ICD-9 codes of data/icd9.txt, for
+# diagnosis features finer than the 3 character prefix of ColumnConverter:
+#
+#   index = load_index()                         # builds data/.icd9.txt.index on first use
+#   index.valid(df['diag_1'])                    # True where the raw code is an ICD-9 code or category
+#   index.rollup(df['diag_1'], 4)                # '428.21' -> '4282', '428' stays '428', '428.99' -> '4289'
+#   index.chapter(df['diag_1'])                  # as diag_1 after ColumnConverter, for all codes of the file
+#   index.description('250.83')
+#
+#   python -m custom_transformers.icd9_index     # (re)build the index, e.g. when building an image
+#
+# icd9.txt has one code per line, 5 characters wide (no decimal point, space
+# padded) followed by its description. A raw diagnosis ('8', '038', '250.83',
+# 'V57.1', 'E812') is normalized once per distinct value to that form ('008',
+# '038', '25083', 'V571', 'E812'). Values that cannot be an ICD-9 code are
+# missing.
+#
+# The index is a sorted array of every code and every 3, 4 and 5 character
+# prefix of a code (the nodes: the file lists leaf codes, its categories
+# such as 250 only appear as prefixes). Per node it holds
+# - the offsets of its description in one latin-1 blob (empty for pure prefixes);
+# - its level (3, 4 or 5 characters) and its parent node;
+# - its chapter, as in diagnosis_index.
+# Lookups are a single searchsorted of the normalized distinct values of a
+# column into the nodes; roll-up and chapters are array lookups on the result.
+#
+# The arrays are .npy files in a directory next to the source, loaded
+# memory-mapped, so a process only pages in what it reads. The manifest records
+# the size and modification time of the source, and an index of another
+# version of the file is rebuilt on load.
+
+FORMAT = 1
+MANIFEST = 'manifest.json'
+# next to the package, not the working directory of the process
+ICD9 = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'icd9.txt')
+WIDTH = 5
+LEVELS = (3, 4, 5)
+
+_ARRAYS = ('codes', 'offsets', 'blob', 'level', 'parent', 'leaf', 'chapters')
+
+
+def _split(value, width):
+    # head (zero padded to width) and decimals of the part after the V or E
+    head, dot, tail = value.partition('.')
+    if not dot and len(head) > width:
+        # already written without the decimal point, as in icd9.txt
+        head, tail = head[:width], head[width:]
+    if not head.isdigit() or (tail and not tail.isdigit()) or len(head) > width:
+        return None
+    return head.zfill(width) + tail
+
+
+def normalize(value):
+    # raw diagnosis -> code as written in icd9.txt, None if it cannot be one
+    if not isinstance(value, str) or not value.isascii():
+        return None
+    value = value.strip().upper()
+    if value[:1] == 'V':
+        code = _split(value[1:], 2)
+        code = None if code is None else 'V' + code
+    elif value[:1] == 'E':
+        code = _split(value[1:], 3)
+        code = None if code is None else 'E' + code
+    else:
+        code = _split(value, 3)
+    return code if code is not None and len(code) <= WIDTH else None
+
+
+def _source(source):
+    stat = os.stat(source)
+    return {'path': os.path.abspath(source), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _default_path(source):
+    return os.path.join(os.path.dirname(os.path.abspath(source)), '.%s.index' % os.path.basename(source))
+
+
+def _chapter(node):
+    # the categories of chapter_codes are 3 characters, 4 for E codes; an E node of
+    # 3 characters spans ten E categories of the same chapter (E80 -> E800-E809)
+    if node[0] == 'E':
+        return 'e%d' % int(node[1:4].ljust(3, '0'))
+    if node[0] == 'V':
+        return 'v%d' % int(node[1:3])
+    return str(int(node[:3]))
+
+
+def _read(source):
+    descriptions = {}
+    with open(source, 'rb') as fh:
+        for line in fh:
+            line = line.rstrip(b'\r\n')
+            code = line[:WIDTH].strip().decode('ascii')
+            if code:
+                descriptions[code] = line[WIDTH + 1:].strip()
+    return descriptions
+
+
+def build_index(source=ICD9, path=None):
+    # writes the index of source to path (default next to source), returns path
+    path = _default_path(source) if path is None else path
+    descriptions = _read(source)
+    nodes = sorted({code[:n] for code in descriptions for n in LEVELS if n <= len(code)}
+                   | set(descriptions))
+    position = {node: i for i, node in enumerate(nodes)}
+    chapter_of = {code: diagnosis_index.diag_categories.index(chapter)
+                  for chapter, codes in diagnosis_index.chapter_codes.items() for code in codes}
+    unknown = diagnosis_index.diag_categories.index('unknown')
+
+    blob = b''.join(descriptions.get(node, b'') for node in nodes)
+    arrays = {
+        'codes': np.array(nodes, dtype='S%d' % WIDTH),
+        'offsets': np.concatenate([[0], np.cumsum([len(descriptions.get(node, b'')) for node in nodes])]),
+        'blob': np.frombuffer(blob, dtype=np.uint8),
+        'level': np.array([len(node) for node in nodes], dtype=np.int8),
+        'parent': np.array([position.get(node[:len(node) - 1], -1) if len(node) > LEVELS[0] else -1
+                            for node in nodes], dtype=np.int32),
+        'leaf': np.array([node in descriptions for node in nodes]),
+        'chapters': np.array([chapter_of.get(_chapter(node), unknown) for node in nodes], dtype=np.int8)}
+
+    tmp = '%s.tmp-%d-%d' % (path, os.getpid(), time.monotonic_ns())
+    os.makedirs(tmp)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp, name + '.npy'), array, allow_pickle=False)
+    with open(os.path.join(tmp, MANIFEST), 'w') as fh:
+        json.dump({'format': FORMAT, 'source': _source(source), 'nodes': len(nodes),
+                   'codes': len(descriptions)}, fh)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        # another process built the same index first
+        shutil.rmtree(tmp)
+    return path
+
+
+def _current(path, source):
+    try:
+        with open(os.path.join(path, MANIFEST)) as fh:
+            manifest = json.load(fh)
+    except (OSError, ValueError):
+        return False
+    if manifest.get('format') != FORMAT:
+        return False
+    if source is None or not os.path.exists(source):
+        # a shipped index without its source
+        return True
+    recorded, actual = manifest['source'], _source(source)
+    return recorded['size'] == actual['size'] and recorded['mtime_ns'] == actual['mtime_ns']
+
+
+_loaded = {}
+
+
+def load_index(source=ICD9, path=None, build=True):
+    # memory-mapped index of source, built first if missing or stale (an error without build);
+    # one per path and process
+    path = _default_path(source) if path is None else path
+    if not _current(path, source):
+        if not build:
+            raise FileNotFoundError('no current ICD-9 index of %s at %s, build it with '
+                                    'python -m custom_transformers.icd9_index' % (source, path))
+        build_index(source, path)
+        _loaded.pop(path, None)
+    index = _loaded.get(path)
+    if index is None:
+        index = _loaded[path] = ICD9Index(path)
+    return index
+
+
+class ICD9Index:
+    def __init__(self, path):
+        self.path = path
+        for name in _ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r', allow_pickle=False))
+        self._memo = {}
+        self._ancestors = {}
+        self._categories = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _keys(self, values):
+        # normalized codes of the distinct values, b'' where there is none
+        keys = np.empty(len(values), dtype='S%d' % WIDTH)
+        if len(self._memo) > 100000:
+            self._memo.clear()
+        for i, value in enumerate(values):
+            try:
+                keys[i] = self._memo[value]
+            except (KeyError, TypeError):
+                key = normalize(value) or ''
+                keys[i] = key
+                try:
+                    self._memo[value] = key
+                except TypeError:
+                    pass
+        return keys
+
+    def nodes(self, values, closest=False):
+        # node of every value (a scalar, list or Series), -1 if it is not a code or prefix in
+        # the file; closest falls back to the longest prefix in the file ('250.99' -> '2509')
+        scalar = np.ndim(values) == 0
+        codes, uniques = pd.factorize(pd.Series([values] if scalar else values, dtype=object))
+        keys = self._keys(uniques)
+        found = np.full(len(keys), -1, dtype=np.int32)
+        for width in (LEVELS[::-1] if closest else (WIDTH,)):
+            keys = keys.astype('S%d' % width)
+            todo = (found < 0) & (keys != b'')
+            at = np.searchsorted(self.codes, keys[todo]).clip(max=len(self.codes) - 1)
+            found[todo] = np.where(self.codes[at] == keys[todo], at, -1)
+        nodes = np.append(found, -1)[codes]
+        return int(nodes[0]) if scalar else nodes
+
+    def _rollup_codes(self, level):
+        # node -> position of its ancestor with at most level characters (itself when
+        # shorter) among the categories of that level
+        table = self._ancestors.get(level)
+        if table is None:
+            ancestor = np.arange(len(self.codes), dtype=np.int32)
+            for _ in LEVELS:
+                deeper = self.level[ancestor] > level
+                ancestor[deeper] = self.parent[ancestor[deeper]]
+            position = np.cumsum(self.level <= level) - 1
+            table = self._ancestors[level] = position[ancestor].astype(np.int32)
+        return table
+
+    def categories(self, level):
+        # codes of the nodes with at most level characters, the categories of rollup(..., level)
+        categories = self._categories.get(level)
+        if categories is None:
+            categories = self._categories[level] = pd.Index(self.codes[self.level <= level].astype(str))
+        return categories
+
+    def valid(self, series):
+        return pd.Series(self.nodes(series) >= 0, index=getattr(series, 'index', None))
+
+    def rollup(self, series, level):
+        # codes truncated to level characters (shorter codes as they are), codes missing
+        # from the file as their closest prefix in it, NaN if there is none
+        if level not in LEVELS:
+            raise ValueError('level must be one of %s, got %r' % (LEVELS, level))
+        nodes = self.nodes(series, closest=True)
+        codes = np.where(nodes >= 0, self._rollup_codes(level)[nodes], -1)
+        categorical = pd.Categorical.from_codes(codes, self.categories(level))
+        return pd.Series(categorical, index=getattr(series, 'index', None), name=getattr(series, 'name', None))
+
+    def chapter(self, series):
+        # chapter of every value (of its closest prefix in the file) in the categories of
+        # the converted diag_* columns, 'unknown' if there is none
+        nodes = self.nodes(series, closest=True)
+        unknown = diagnosis_index.diag_categories.index('unknown')
+        codes = np.where(nodes >= 0, self.chapters[nodes], unknown)
+        categorical = pd.Categorical.from_codes(codes, diagnosis_index.diag_categories)
+        return pd.Series(categorical, index=getattr(series, 'index', None), name=getattr(series, 'name', None))
+
+    def description(self, value):
+        # description of a code of the file, None for prefixes and invalid values
+        node = self.nodes(value)
+        if node < 0 or not self.leaf[node]:
+            return None
+        return bytes(self.blob[self.offsets[node]:self.offsets[node + 1]]).decode('latin-1')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the ICD-9 index of icd9.txt')
+    parser.add_argument('--source', default=ICD9)
+    parser.add_argument('--path', default=None, help='index directory, default next to the source')
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    path = build_index(args.source, args.path)
+    index = ICD9Index(path)
+    print('%s: %d codes, %d nodes, %d bytes, built in %.2f s'
+          % (path, int(index.leaf.sum()), len(index),
+             sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)),
+             time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
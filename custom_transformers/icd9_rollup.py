@@ -0,0 +1,33 @@
+from sklearn.base import BaseEstimator, TransformerMixin
+
+from custom_transformers.icd9_index import ICD9, load_index
+
+
+# Pipeline step for the ICD-9 index of custom_transformers.icd9_index, kept
+# apart from it so that the index (and serving.validation, which normalizes
+# diagnoses with it) can be imported without scikit-learn:
+#
+#   make_pipeline(ICD9Rollup(level=4), ColumnConverter(), ...)
+
+
+class ICD9Rollup(TransformerMixin, BaseEstimator):
+    # adds <col>_icd9, the codes of the diagnosis columns rolled up to level
+    # characters, as categoricals with the fixed categories of the index (so
+    # every batch encodes the same); fit builds the index if needed, transform only
+    # loads it (memory-mapped, not pickled), so scoring never writes next to the source
+    def __init__(self, columns=('diag_1', 'diag_2', 'diag_3'), level=4, source=None):
+        self.columns = columns
+        self.level = level
+        self.source = source
+
+    def fit(self, X, y=None):
+        # source None is icd9_index.ICD9, resolved where the pipeline runs, not where it was fitted
+        load_index(self.source or ICD9)
+        return self
+
+    def transform(self, X):
+        index = load_index(self.source or ICD9, build=False)
+        _X = X.copy(deep=False)
+        for col in self.columns:
+            _X[col + '_icd9'] = index.rollup(X[col], self.level)
+        return _X
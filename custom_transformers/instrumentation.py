@@ -0,0 +1,205 @@
+import collections
+import copy
+import os
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+from sklearn.compose import ColumnTransformer
+from sklearn.pipeline import Pipeline
+
+
+# Opt-in per stage instrumentation of a fitted pipeline.
+#
+#   instrumentation = Instrumentation(track_memory=True)
+#   scored = instrumentation.instrument(pipeline)     # same fitted steps, wrapped
+#   scored.predict_proba(X)
+#   instrumentation.snapshot()                         # {'columnconverter': {'p50_s': ...}, ...}
+#   instrumentation.prometheus()                       # text exposition format
+#
+# instrument() returns a new pipeline whose steps (and the transformers inside
+# a ColumnTransformer or nested Pipeline, named e.g. 'columntransformer/num/imputer')
+# are wrappers around the original fitted objects, so results are unchanged and
+# the original pipeline is left alone. Every call records wall time and rows;
+# with track_memory the peak traced memory above the start of the call and the
+# bytes still allocated at its end are recorded too (tracemalloc, which slows
+# allocation heavy code down, so it is off by default). Latencies are kept in a
+# rolling window for p50/p95/p99.
+#
+# With enabled = False every wrapper calls straight through to its step. Memory
+# tracking assumes the pipeline is not called from several threads at once.
+
+QUANTILES = [0.5, 0.95, 0.99]
+
+
+class StageStats:
+    def __init__(self, window):
+        self.seconds = collections.deque(maxlen=window)
+        self.calls = 0
+        self.rows = 0
+        self.seconds_total = 0.0
+        self.peak_bytes = 0
+        self.allocated_bytes = 0
+
+    def summary(self):
+        seconds = np.array(self.seconds) if self.seconds else np.full(1, np.nan)
+        summary = {'calls': self.calls, 'rows': self.rows, 'seconds_total': self.seconds_total,
+                   'peak_bytes_max': self.peak_bytes, 'allocated_bytes_total': self.allocated_bytes}
+        for quantile, value in zip(QUANTILES, np.quantile(seconds, QUANTILES)):
+            summary['p%d_s' % (quantile * 100)] = float(value)
+        return summary
+
+
+def _n_rows(X):
+    shape = getattr(X, 'shape', None)
+    return shape[0] if shape is not None else len(X)
+
+
+class Instrumentation:
+    def __init__(self, window=1000, track_memory=False, enabled=True):
+        self.window = window
+        self.track_memory = track_memory
+        self.enabled = enabled
+        self.stats = {}
+        self._lock = threading.Lock()
+        # running peak of every stage currently on the stack (nested stages reset tracemalloc's peak)
+        self._peaks = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def instrument(self, estimator, name=None):
+        if isinstance(estimator, Pipeline):
+            steps = [(step_name, self.instrument(step, self._join(name, step_name))) for step_name, step in estimator.steps]
+            wrapped = copy.copy(estimator)
+            wrapped.steps = steps
+            return wrapped if name is None else _Instrumented(wrapped, name, self)
+        if isinstance(estimator, ColumnTransformer) and hasattr(estimator, 'transformers_'):
+            wrapped = copy.copy(estimator)
+            wrapped.transformers_ = [(part, transformer if isinstance(transformer, str)
+                                      else self.instrument(transformer, self._join(name, part)), cols)
+                                     for part, transformer, cols in estimator.transformers_]
+            return _Instrumented(wrapped, name or 'columntransformer', self)
+        if isinstance(estimator, str):
+            return estimator
+        return _Instrumented(estimator, name or type(estimator).__name__.lower(), self)
+
+    def _join(self, parent, name):
+        return name if parent is None else parent + '/' + name
+
+    def _call(self, stage, method, X, args, kwargs):
+        memory = self.track_memory
+        if memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            current, peak = tracemalloc.get_traced_memory()
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], peak)
+            tracemalloc.reset_peak()
+            self._peaks.append(current)
+            start_bytes = current
+
+        start = time.perf_counter()
+        try:
+            return method(X, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            peak_delta = allocated = 0
+            if memory:
+                current, peak = tracemalloc.get_traced_memory()
+                peak = max(self._peaks.pop(), peak)
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+                peak_delta, allocated = peak - start_bytes, max(0, current - start_bytes)
+            self._record(stage, elapsed, _n_rows(X), peak_delta, allocated)
+
+    def _record(self, stage, elapsed, rows, peak_delta, allocated):
+        with self._lock:
+            stats = self.stats.get(stage)
+            if stats is None:
+                stats = self.stats[stage] = StageStats(self.window)
+            stats.seconds.append(elapsed)
+            stats.calls += 1
+            stats.rows += rows
+            stats.seconds_total += elapsed
+            stats.peak_bytes = max(stats.peak_bytes, peak_delta)
+            stats.allocated_bytes += allocated
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: stats.summary() for stage, stats in self.stats.items()}
+
+    def prometheus(self, prefix='readmission_pipeline'):
+        lines = []
+        snapshot = self.snapshot()
+
+        def metric(name, kind, help_text, values):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help_text))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+            for labels, value in values:
+                label_text = ','.join('%s="%s"' % item for item in labels)
+                lines.append('%s_%s{%s} %r' % (prefix, name, label_text, float(value)))
+
+        metric('stage_seconds', 'summary', 'wall time per call of a pipeline stage',
+               [((('stage', stage), ('quantile', str(quantile))), summary['p%d_s' % (quantile * 100)])
+                for stage, summary in snapshot.items() for quantile in QUANTILES])
+        lines += ['%s_stage_seconds_sum{stage="%s"} %r' % (prefix, stage, summary['seconds_total'])
+                  for stage, summary in snapshot.items()]
+        lines += ['%s_stage_seconds_count{stage="%s"} %d' % (prefix, stage, summary['calls'])
+                  for stage, summary in snapshot.items()]
+        metric('stage_rows_total', 'counter', 'rows processed by a pipeline stage',
+               [((('stage', stage),), summary['rows']) for stage, summary in snapshot.items()])
+        if self.track_memory:
+            metric('stage_peak_memory_bytes', 'gauge', 'largest peak of traced memory above the start of a call',
+                   [((('stage', stage),), summary['peak_bytes_max']) for stage, summary in snapshot.items()])
+            metric('stage_allocated_bytes_total', 'counter', 'bytes still allocated at the end of the calls',
+                   [((('stage', stage),), summary['allocated_bytes_total']) for stage, summary in snapshot.items()])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, prefix='readmission_pipeline'):
+        # for a textfile collector (e.g. node_exporter --collector.textfile.directory), written atomically
+        with open(path + '.tmp', 'w') as fh:
+            fh.write(self.prometheus(prefix))
+        os.replace(path + '.tmp', path)
+
+
+class _Instrumented:
+    # stands in for a fitted step; everything but the timed methods goes to the step itself
+    def __init__(self, step, stage, instrumentation):
+        self.step = step
+        self.stage = stage
+        self.instrumentation = instrumentation
+
+    def __getattr__(self, name):
+        if name == 'step':
+            raise AttributeError(name)
+        return getattr(self.step, name)
+
+    def _timed(self, method_name, X, args, kwargs):
+        method = getattr(self.step, method_name)
+        if not self.instrumentation.enabled:
+            return method(X, *args, **kwargs)
+        return self.instrumentation._call(self.stage, method, X, args, kwargs)
+
+    def transform(self, X, *args, **kwargs):
+        return self._timed('transform', X, args, kwargs)
+
+    def predict_proba(self, X, *args, **kwargs):
+        return self._timed('predict_proba', X, args, kwargs)
+
+    def predict(self, X, *args, **kwargs):
+        return self._timed('predict', X, args, kwargs)
+
+    def __repr__(self):
+        return 'Instrumented(%r, stage=%r)' % (self.step, self.stage)
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from custom_transformers.compiled_converter import binary_cols, lean_flag_columns, num_columns, _code_columns, \
+    _str_columns
+
+
+# Column-pruned, typed loading of train_data.csv with an on-disk cache:
+#
+#   df = load_train_data()                                # what ColumnConverter reads, plus admission_id and readmitted
+#   df = load_train_data(features=selected_features)      # and any other raw column the caller selects
+#   X = df.set_index('admission_id').drop(columns='readmitted')
+#
+# Only the raw columns ColumnConverter reads (taken from compiled_converter),
+# the requested features, the id and the target are parsed, chunksize rows
+# at a time, with the dtype plan below: strings as categoricals (the chunks'
+# categories are unioned at the end), integer counts and codes as float32,
+# which holds them exactly and is what ColumnConverter turns them into anyway,
+# and hemoglobin_level as float64 so the converted values do not change.
+# The converter treats such a frame exactly like one from a plain pd.read_csv.
+#
+# The typed frame is cached next to the source, as Parquet when pyarrow is
+# installed and otherwise as a directory with one .npy file per column (codes
+# for the categoricals) and a manifest, loaded memory-mapped. The cache key
+# covers the source file (path, size and modification time), the columns and
+# the dtype plan, so editing or replacing the CSV, or asking for other
+# columns, parses it again; caches of older keys of the same file are removed.
+
+FORMAT = 1
+MANIFEST = 'manifest.json'
+TRAIN_DATA = os.path.join('data', 'train_data.csv')
+
+_float64_columns = ['hemoglobin_level']
+_string_columns = list(binary_cols) + list(_str_columns) + ['payer_code', 'diag_1', 'diag_2', 'diag_3']
+
+
+def raw_columns(features=(), index='admission_id', target='readmitted'):
+    # raw columns a pipeline starting with ColumnConverter reads, in converter order
+    columns = [index] + num_columns + _string_columns + lean_flag_columns + list(_code_columns)
+    columns += [col for col in features if not col.endswith('_risk')]
+    if target is not None:
+        columns.append(target)
+    return list(dict.fromkeys(col for col in columns if col is not None))
+
+
+def dtype_plan(columns):
+    # read_csv dtypes; columns left out (the id, boolean flags) are inferred
+    plan = {}
+    for col in columns:
+        if col in _float64_columns:
+            plan[col] = 'float64'
+        elif col in num_columns:
+            plan[col] = 'float32'
+        elif col in _string_columns or col == 'readmitted':
+            plan[col] = 'category'
+    return plan
+
+
+def _concat(chunks):
+    # pd.concat would turn categoricals with different categories into object columns
+    df = pd.concat(chunks, ignore_index=True)
+    for col in chunks[0].columns:
+        if isinstance(chunks[0][col].dtype, pd.CategoricalDtype):
+            df[col] = pd.Series(union_categoricals([chunk[col] for chunk in chunks]), index=df.index)
+    return df
+
+
+def read_columns(path, columns, chunksize=200000):
+    header = pd.read_csv(path, nrows=0).columns
+    missing = [col for col in columns if col not in header]
+    if missing:
+        raise ValueError('%s has no column(s) %s' % (path, ', '.join(missing)))
+    reader = pd.read_csv(path, usecols=columns, dtype=dtype_plan(columns), chunksize=chunksize)
+    chunks = [chunk for chunk in reader]
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    return _concat(chunks)[columns]
+
+
+def _parquet():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _cache_key(path, columns, plan):
+    stat = os.stat(path)
+    source = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    key = json.dumps({'format': FORMAT, 'source': source, 'columns': columns, 'dtypes': plan}, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()[:16], source
+
+
+def _encode_column(series):
+    # (manifest entry, array to save) of a column: categoricals as codes plus their categories
+    entry = {'dtype': str(series.dtype)}
+    if series.dtype == object:
+        # e.g. a flag with missing values: stored as codes, restored as objects
+        series = series.astype('category')
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        entry['categories'] = [label.item() if isinstance(label, np.generic) else label
+                               for label in series.cat.categories]
+        entry['ordered'] = bool(series.cat.ordered)
+        return entry, series.cat.codes.to_numpy()
+    return entry, series.to_numpy()
+
+
+def _decode_column(entry, values):
+    if 'categories' in entry:
+        values = pd.Categorical.from_codes(values, entry['categories'], ordered=entry['ordered'])
+        if entry['dtype'] == 'object':
+            values = values.astype(object)
+    return values
+
+
+def _save_columns(df, directory, source):
+    os.makedirs(directory)
+    manifest = {'format': FORMAT, 'source': source, 'rows': len(df), 'columns': []}
+    for i, col in enumerate(df.columns):
+        entry, values = _encode_column(df[col])
+        entry = dict(name=col, file='col%d.npy' % i, **entry)
+        np.save(os.path.join(directory, entry['file']), values, allow_pickle=False)
+        manifest['columns'].append(entry)
+    with open(os.path.join(directory, MANIFEST), 'w') as fh:
+        json.dump(manifest, fh)
+
+
+def _load_columns(directory):
+    with open(os.path.join(directory, MANIFEST)) as fh:
+        manifest = json.load(fh)
+    data = {}
+    for entry in manifest['columns']:
+        values = np.load(os.path.join(directory, entry['file']), mmap_mode='r', allow_pickle=False)
+        data[entry['name']] = _decode_column(entry, values)
+    return pd.DataFrame(data, columns=[entry['name'] for entry in manifest['columns']])
+
+
+def load_train_data(path=TRAIN_DATA, features=(), columns=None, chunksize=200000, cache=True, cache_dir=None):
+    # columns overrides the pruned column list; cache_dir defaults to the directory of path
+    columns = raw_columns(features) if columns is None else list(columns)
+    if not cache:
+        return read_columns(path, columns, chunksize)
+
+    plan = dtype_plan(columns)
+    key, source = _cache_key(path, columns, plan)
+    cache_dir = os.path.dirname(os.path.abspath(path)) if cache_dir is None else cache_dir
+    stem = '.%s.cache.' % os.path.basename(path)
+    target = os.path.join(cache_dir, stem + key + ('.parquet' if _parquet() else ''))
+    if os.path.exists(target):
+        if target.endswith('.parquet'):
+            return pd.read_parquet(target, memory_map=True)
+        return _load_columns(target)
+
+    df = read_columns(path, columns, chunksize)
+    os.makedirs(cache_dir, exist_ok=True)
+    for name in os.listdir(cache_dir):
+        if name.startswith(stem) and '.tmp-' not in name:
+            stale = os.path.join(cache_dir, name)
+            shutil.rmtree(stale) if os.path.isdir(stale) else os.remove(stale)
+    tmp = '%s.tmp-%d-%d' % (target, os.getpid(), time.monotonic_ns())
+    if target.endswith('.parquet'):
+        df.to_parquet(tmp, index=False)
+    else:
+        _save_columns(df, tmp, source)
+    try:
+        os.replace(tmp, target)
+    except OSError:
+        # another process wrote the same cache first
+        shutil.rmtree(tmp) if os.path.isdir(tmp) else os.remove(tmp)
+    return df
@@ -1,20 +1,40 @@
-from sklearn.base import TransformerMixin
-from sklearn.impute import SimpleImputer, KNNImputer
-from sklearn.preprocessing import StandardScaler, power_transform, RobustScaler
+from sklearn.base import BaseEstimator, TransformerMixin
 import pandas as pd
 import numpy as np
 
+from custom_transformers.compiled_converter import convert_columns, convert_diag, FallbackToLegacy
 
-class ColumnConverter(TransformerMixin):
-    def __init__(self):
-        return None
+
+class ColumnConverter(TransformerMixin, BaseEstimator):
+    # fit learns nothing from the data, so outputs can be cached by input content
+    stateless = True
+
+    # lean=True runs the compiled conversion with the memory-lean dtype plan
+    # of compiled_converter (float32 numbers, int8 flags, fixed categories)
+
+    # defaults for pipelines pickled before the compiled and lean modes existed
+    compiled = False
+    lean = False
+
+    def __init__(self, compiled=False, lean=False):
+        self.compiled = compiled
+        self.lean = lean
     
     def fit(self, df, *args):
         return self
-    
+
     def transform(self, df, *args):
+        if self.compiled or self.lean:
+            try:
+                return convert_columns(df, lean=self.lean)
+            except FallbackToLegacy:
+                pass
+
        ### Put your transformation here
         _df = df.copy()
+        # raw strings read as categoricals (custom_transformers.loader) go through the rules below as plain values
+        for col in _df.columns[(_df.dtypes == 'category').to_numpy()]:
+            _df[col] = _df[col].astype(object)
 
         ### numerical variables (just assigning category type)
         num_columns = ['admission_source_code', 'time_in_hospital', 'num_procedures', 'num_medications',
@@ -177,55 +197,9 @@ class ColumnConverter(TransformerMixin):
         _df.loc[~(_df['medical_specialty'].isin(selected_specialties)), 'medical_specialty'] = 'other'
         _df['medical_specialty'] = _df['medical_specialty'].astype('category')
        
-       # diagnosis columns
-        infection = [str(code) for code in list(range(1, 140))]
-        neoplasms = [str(code) for code in list(range(141, 240))]
-        endocrine_nutritional_metabolic_immune = [str(code) for code in list(range(241, 280))]
-        blood = [str(code) for code in list(range(280, 290))]
-        mental = [str(code) for code in list(range(290, 320))]
-        nervous_system = [str(code) for code in list(range(320, 390))]
-        circulatory = [str(code) for code in list(range(390, 460))]
-        respiratory = [str(code) for code in list(range(460, 520))]
-        digestive = [str(code) for code in list(range(520, 580))]
-        genitourinary = [str(code) for code in list(range(580, 630))]
-        pregnancy = [str(code) for code in list(range(630, 680))]
-        skin = [str(code) for code in list(range(680, 710))]
-        musculoskeletal = [str(code) for code in list(range(710, 740))]
-        congenital = [str(code) for code in list(range(740, 760))]
-        perinatal = [str(code) for code in list(range(760, 780))]
-        ill_defined = [str(code) for code in list(range(780, 800))]
-        injury_poisoning = [str(code) for code in list(range(800, 900))] + ['e'+str(code) for code in list(range(800, 900))]
-        supplemental = ['v'+str(code) for code in list(range(1, 90))]
-
-        all_codes = infection + neoplasms + endocrine_nutritional_metabolic_immune + blood + mental+ nervous_system + circulatory + respiratory + digestive + genitourinary + pregnancy + skin + musculoskeletal+ congenital+ perinatal+ ill_defined+ injury_poisoning+ supplemental 
-
-        columns = ['diag_1', 'diag_2', 'diag_3']
-        for col in columns:
-            _df[col] = _df[col].str.lower().str[0:3]
-            _df[col] = _df[col].fillna(value='unknown')
-            _df.loc[~(_df[col].isin(all_codes)), col] = 'unknown'
-    
-            _df.loc[(_df[col].isin(infection)), col] = 'infection'
-            _df.loc[(_df[col].isin(neoplasms)), col] = 'neoplasms'
-            _df.loc[(_df[col].isin(endocrine_nutritional_metabolic_immune)), col] = 'endocrine_nutritional_metabolic_immune'
-            _df.loc[(_df[col].isin(blood)), col] = 'blood'
-            _df.loc[(_df[col].isin(mental)), col] = 'mental'
-            _df.loc[(_df[col].isin(nervous_system)), col] = 'nervous_system'
-            _df.loc[(_df[col].isin(circulatory)), col] = 'circulatory'
-            _df.loc[(_df[col].isin(respiratory)), col] = 'respiratory'
-            _df.loc[(_df[col].isin(digestive)), col] = 'digestive'
-            _df.loc[(_df[col].isin(genitourinary)), col] = 'genitourinary'
-            _df.loc[(_df[col].isin(pregnancy)), col] = 'pregnancy'
-            _df.loc[(_df[col].isin(skin)), col] = 'skin'
-            _df.loc[(_df[col].isin(musculoskeletal)), col] = 'musculoskeletal'
-            _df.loc[(_df[col].isin(congenital)), col] = 'congenital'
-            _df.loc[(_df[col].isin(perinatal)), col] = 'perinatal'
-            _df.loc[(_df[col].isin(ill_defined)), col] = 'ill_defined'
-            _df.loc[(_df[col].isin(injury_poisoning)), col] = 'injury_poisoning'
-            _df.loc[(_df[col].isin(supplemental)), col] = 'supplemental'
-            _df.loc[(_df[col].isin(infection)), col] = 'infection'
-            
-            _df[col] = _df[col].astype('category')
+       # diagnosis columns (ICD chapters, see diagnosis_index)
+        for col in ['diag_1', 'diag_2', 'diag_3']:
+            _df[col] = convert_diag(_df[col])
         
         # blood type
         _df['blood_type'] = _df['blood_type'].str.lower()
@@ -0,0 +1,212 @@
+import sys
+
+import numpy as np
+
+from custom_transformers.compiled_converter import cell_rules
+
+
+# Row mode of a fitted deployment pipeline
+#
+#   ColumnConverter -> custom_oe -> SelectColumns -> ColumnTransformer -> model
+#
+# for a single observation given as a plain dict (the `observation` field of a
+# request). Every stage is compiled into scalar lookups at construction time:
+#
+#   - ColumnConverter: the per value rules of compiled_converter
+#   - custom_oe: the mapping dict of its module
+#   - the 'num' pipeline: SimpleImputer.statistics_, RobustScaler.center_/scale_
+#   - the 'cat' pipeline: one precomputed block of dummies per label, from the
+#     OneHotTables of the fitted one-hot encoder (values it has no row for, i.e.
+#     unseen labels with handle_unknown='ignore', give NaN like the DataFrame path)
+#   - remainder='passthrough' columns are copied as floats
+#
+# and the feature vector is written into one reused float32 buffer, the dtype
+# the forest converts its input to anyway. transform() returns that buffer, so
+# it is overwritten by the next call and a RowPipeline must not be shared
+# between threads.
+#
+# model replaces the last step for predict_proba, e.g. a CompiledForest of it.
+#
+# row_spec() holds the compiled tables as plain data; RowPipeline.from_spec()
+# builds row mode from it without the fitted pipeline or sklearn, which is how
+# a model bundle serves single observations (serving.bundle).
+
+_MAX_MEMO = 100000
+
+
+def _remember(memo, value, result):
+    # NaN keys never hit (every NaN is a new object), unhashable values are not cached
+    if len(memo) > _MAX_MEMO:
+        memo.clear()
+    if value != value:
+        return
+    try:
+        memo[value] = result
+    except TypeError:
+        pass
+
+
+def row_spec(pipeline):
+    # everything row mode needs from a fitted pipeline, as plain data (lists,
+    # dicts and numpy arrays) that can be stored without pickling sklearn objects
+    from sklearn.compose import ColumnTransformer
+    from custom_transformers import preprocessor, preprocessor_redeploy
+    from custom_transformers.compiled_encoder import OneHotTables
+    from custom_transformers.featureselector import SelectColumns
+
+    steps = [step for _, step in pipeline.steps]
+    if len(steps) != 5:
+        raise ValueError('row mode expects ColumnConverter, custom_oe, SelectColumns, ColumnTransformer, model')
+    converter, encoder, selector, column_transformer, _ = steps
+    if not isinstance(converter, (preprocessor.ColumnConverter, preprocessor_redeploy.ColumnConverter)):
+        raise ValueError('first step is not a ColumnConverter: %r' % converter)
+    if not isinstance(selector, SelectColumns):
+        raise ValueError('third step is not SelectColumns: %r' % selector)
+    if not isinstance(column_transformer, ColumnTransformer):
+        raise ValueError('fourth step is not a ColumnTransformer: %r' % column_transformer)
+
+    columns = list(selector.cols)
+    redeploy = isinstance(converter, preprocessor_redeploy.ColumnConverter)
+    # True for the built in risk buckets, the learned table of the converter otherwise
+    spec = {'risk': redeploy and (getattr(converter, 'risk_table', None) or True),
+            # the mapping custom_oe passes to the ordinal encoder lives next to it
+            'ordinal': [{'col': m['col'], 'mapping': dict(m['mapping'])}
+                        for m in sys.modules[type(encoder).__module__].mapping],
+            'num': [], 'cat': [], 'rest': []}
+    position = 0
+    for _, transformer, cols in column_transformer.transformers_:
+        if transformer == 'drop' or len(cols) == 0:
+            continue
+        cols = [columns[col] if isinstance(col, (int, np.integer)) else col for col in cols]
+        if transformer == 'passthrough':
+            for col in cols:
+                spec['rest'].append({'column': col, 'position': position})
+                position += 1
+            continue
+
+        steps = transformer.named_steps
+        if 'onehot' in steps:
+            fill_value = steps['imputer'].fill_value if 'imputer' in steps else np.nan
+            onehot = steps['onehot']
+            # the tables of a LeanOneHotEncoder, or the same read from category_encoders
+            tables = getattr(onehot, 'tables_', None) or OneHotTables(onehot)
+            for col, labels, table in zip(cols, tables.labels, tables.tables):
+                spec['cat'].append({'column': col, 'start': position, 'labels': list(labels),
+                                    'table': table, 'fill_value': fill_value})
+                position += table.shape[1]
+            continue
+
+        unsupported = set(steps) - {'imputer', 'scaler'}
+        if unsupported:
+            raise ValueError('row mode cannot compile steps %s' % sorted(unsupported))
+        fill = steps['imputer'].statistics_ if 'imputer' in steps else np.full(len(cols), np.nan)
+        center = getattr(steps.get('scaler'), 'center_', None)
+        scale = getattr(steps.get('scaler'), 'scale_', None)
+        # a pipeline fitted on lean (float32) columns imputes and scales in float32
+        dtype = np.float32 if fill.dtype == np.float32 else np.float64
+        spec['num'].append({'columns': cols, 'start': position,
+                            'fill': np.asarray(fill, dtype=dtype),
+                            'center': np.zeros(len(cols), dtype) if center is None else np.asarray(center, dtype=dtype),
+                            'scale': np.ones(len(cols), dtype) if scale is None else np.asarray(scale, dtype=dtype)})
+        position += len(cols)
+    spec['width'] = position
+    return spec
+
+
+class RowPipeline:
+    def __init__(self, pipeline, model=None):
+        self.pipeline = pipeline
+        self._build(row_spec(pipeline), pipeline.steps[-1][1] if model is None else model)
+
+    @classmethod
+    def from_spec(cls, spec, model):
+        # row mode without the fitted pipeline (verify() is then unavailable)
+        row_pipeline = cls.__new__(cls)
+        row_pipeline.pipeline = None
+        row_pipeline._build(spec, model)
+        return row_pipeline
+
+    def _build(self, spec, model):
+        self.spec = spec
+        self.model = model
+        self._rules = cell_rules(risk=spec['risk'])
+        self._ordinal = {m['col']: m['mapping'] for m in spec['ordinal']}
+
+        self._num = []   # (raw column, rule, position, cast, fill, center, scale)
+        self._cat = []   # (raw column, rule, start, stop, memo, blocks, unknown block, missing block)
+        self._rest = []  # (raw column, rule, position, memo)
+        for block in spec['num']:
+            cast = np.float32 if block['fill'].dtype == np.float32 else float
+            for j, col in enumerate(block['columns']):
+                source, rule = self._cell(col)
+                self._num.append((source, rule, block['start'] + j, cast,
+                                  cast(block['fill'][j]), cast(block['center'][j]), cast(block['scale'][j])))
+        for block in spec['cat']:
+            # dummies of every known label, of an unknown label and of a missing value
+            table, labels, fill_value = block['table'], block['labels'], block['fill_value']
+            blocks = {label: table[row] for row, label in enumerate(labels)}
+            unknown = table[len(labels)]
+            if fill_value == fill_value:
+                missing = blocks.get(fill_value, unknown)
+            else:
+                missing = table[len(labels) + 1]
+            source, rule = self._cell(block['column'])
+            self._cat.append((source, rule, block['start'], block['start'] + table.shape[1], {}, blocks, unknown, missing))
+        for block in spec['rest']:
+            source, rule = self._cell(block['column'])
+            self._rest.append((source, rule, block['position'], {}))
+        self.buffer = np.zeros(spec['width'], dtype=np.float32)
+
+    def _cell(self, col):
+        # raw column and rule giving the value of col after ColumnConverter and custom_oe
+        source, rule = self._rules.get(col, (col, lambda value: np.nan if value is None else value))
+        if col in self._ordinal:
+            mapping, convert = self._ordinal[col], rule
+            rule = lambda value: mapping.get(convert(value), -1)
+        return source, rule
+
+    def transform(self, observation):
+        buffer = self.buffer
+        get = observation.get
+        for source, rule, position, cast, fill, center, scale in self._num:
+            value = rule(get(source))
+            if value != value:
+                value = fill
+            buffer[position] = (cast(value) - center) / scale
+
+        for source, rule, start, stop, memo, blocks, unknown, missing in self._cat:
+            value = get(source)
+            try:
+                block = memo[value]
+            except (KeyError, TypeError):
+                label = rule(value)
+                block = missing if label != label else blocks.get(label, unknown)
+                _remember(memo, value, block)
+            buffer[start:stop] = block
+
+        for source, rule, position, memo in self._rest:
+            value = get(source)
+            try:
+                buffer[position] = memo[value]
+            except (KeyError, TypeError):
+                converted = float(rule(value))
+                _remember(memo, value, converted)
+                buffer[position] = converted
+        return buffer
+
+    def predict_proba(self, observation):
+        return self.model.predict_proba(self.transform(observation)[None, :])
+
+    def verify(self, df):
+        # row mode against the DataFrame path on every row of df (raw columns,
+        # as fed to the pipeline); raises AssertionError on the first difference
+        if self.pipeline is None:
+            raise ValueError('verify needs the fitted pipeline, this RowPipeline was built from a spec')
+        expected = np.asarray(self.pipeline[:-1].transform(df), dtype=np.float32)
+        for i, observation in enumerate(df.to_dict('records')):
+            row = self.transform(observation)
+            if not np.array_equal(row, expected[i], equal_nan=True):
+                diff = np.flatnonzero(~((row == expected[i]) | (np.isnan(row) & np.isnan(expected[i]))))
+                raise AssertionError('row %d (%r) differs at features %s: %s != %s'
+                                     % (i, df.index[i], diff.tolist(), row[diff].tolist(), expected[i][diff].tolist()))
+        return len(df)
@@ -0,0 +1,246 @@
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from sklearn.base import BaseEstimator, clone, is_classifier
+from sklearn.metrics import check_scoring
+from sklearn.model_selection import ParameterGrid, check_cv
+
+
+# Successive halving search over a preprocessed matrix in shared memory, as
+# the last step of the grid search pipelines of the notebooks instead of
+# GridSearchCV:
+#
+#   grid_search_pipeline = make_pipeline(
+#       ColumnConverter(), custom_oe(), SelectColumns(cols=selected_features), preprocessor,
+#       SharedHalvingSearchCV(RandomForestClassifier(random_state=42), parameters,
+#                             resource='n_estimators', max_resources=1000, cv=5, scoring='f1'))
+#
+# The matrix the preprocessing hands over is copied once, as float32 (what the
+# sklearn trees fit on anyway), into a shared memory block together with the
+# labels and the test fold of every row. A pool of n_jobs processes attaches to
+# it when it starts, so a task is only (parameters, budget, fold) and no worker
+# receives a pickled copy of the data.
+#
+# Every round fits all remaining candidates on all folds with the round's
+# budget and keeps the best 1/factor of them by mean test score. There are
+# enough rounds to leave at most factor candidates for the last one, whose
+# budget is max_resources, and every round before has 1/factor of the budget
+# of the next, but not less than min_resources (default factor trees, or
+# 2 * factor rows). The budget is either the estimator's n_estimators
+# (resource='n_estimators', which then must not be in param_grid) or the
+# number of training rows of every fold (resource='n_samples', a fixed random
+# subset of the fold). The folds are those of GridSearchCV with the same cv.
+#
+# cv_results_ has the keys of GridSearchCV's, one entry per candidate and
+# round, plus iter, n_resources and elapsed_time (wall time of the candidate in
+# that round, all folds); best_params_, best_score_ and best_estimator_ (refit
+# on all rows with max_resources) come from the last round. Labels that are
+# not numbers ('Yes'/'No') are searched and refit as the index of their sorted
+# class, so the positive class of scoring is the same in both; predict() maps
+# back to the labels and score() takes them.
+
+_shared = {}
+
+
+def _layout(shape, dtype, rows):
+    # offsets of X, then y and ranks (float64, 8 byte aligned), then the test fold of
+    # every row, and the size of the block
+    x_bytes = (int(np.prod(shape)) * np.dtype(dtype).itemsize + 7) // 8 * 8
+    return x_bytes, x_bytes + rows * 8, x_bytes + rows * 16, x_bytes + rows * 20
+
+
+def _views(buffer, shape, dtype, rows):
+    y, ranks, folds, _ = _layout(shape, dtype, rows)
+    return {'X': np.ndarray(shape, dtype=dtype, buffer=buffer),
+            'y': np.ndarray((rows,), dtype=np.float64, buffer=buffer, offset=y),
+            'ranks': np.ndarray((rows,), dtype=np.float64, buffer=buffer, offset=ranks),
+            'folds': np.ndarray((rows,), dtype=np.int32, buffer=buffer, offset=folds)}
+
+
+def _attach(name, shape, dtype, rows):
+    # pool initializer
+    block = shared_memory.SharedMemory(name=name)
+    _shared['block'] = block
+    _shared.update(_views(block.buf, shape, dtype, rows))
+
+
+def _fit_and_score(estimator, params, resource, budget, fold, scoring, return_train_score):
+    start = time.perf_counter()
+    X, y, folds = _shared['X'], _shared['y'], _shared['folds']
+    test = np.flatnonzero(folds == fold)
+    train = np.flatnonzero(folds != fold)
+    params = dict(params)
+    if resource == 'n_samples':
+        # the same rows of the fold for every candidate: the lowest ranks
+        train = train[np.argsort(_shared['ranks'][train], kind='stable')[:budget]]
+    else:
+        params[resource] = budget
+    if 'n_jobs' in estimator.get_params():
+        # the pool does the parallelism, n_jobs=-1 in every worker would oversubscribe the cores
+        params['n_jobs'] = 1
+    estimator = clone(estimator).set_params(**params)
+    scorer = check_scoring(estimator, scoring)
+
+    estimator.fit(X[train], y[train])
+    fit_time = time.perf_counter() - start
+    scored = time.perf_counter()
+    result = {'test_score': scorer(estimator, X[test], y[test])}
+    if return_train_score:
+        result['train_score'] = scorer(estimator, X[train], y[train])
+    result.update(fit_time=fit_time, score_time=time.perf_counter() - scored,
+                  elapsed=time.perf_counter() - start)
+    return result
+
+
+class SharedHalvingSearchCV(BaseEstimator):
+    def __init__(self, estimator, param_grid, resource='n_estimators', max_resources=None, min_resources=None,
+                 factor=3, cv=5, scoring=None, n_jobs=None, refit=True, return_train_score=False, random_state=0):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.resource = resource
+        self.max_resources = max_resources
+        self.min_resources = min_resources
+        self.factor = factor
+        self.cv = cv
+        self.scoring = scoring
+        self.n_jobs = n_jobs
+        self.refit = refit
+        self.return_train_score = return_train_score
+        self.random_state = random_state
+
+    def _budgets(self, n_candidates, n_rows):
+        # max_resources / factor ** k for the rounds, from the last one down, none below min_resources
+        if self.resource == 'n_samples':
+            max_resources = self.max_resources or n_rows
+            floor = 2 * self.factor
+        else:
+            max_resources = self.max_resources or self.estimator.get_params()[self.resource]
+            floor = self.factor
+        # enough rounds to be down to at most factor candidates in the last one
+        n_rounds = max(1, math.ceil(math.log(max(n_candidates, 1)) / math.log(self.factor) - 1e-9))
+        min_resources = self.min_resources or floor
+        return sorted({int(max(min_resources, max_resources // self.factor ** k)) for k in range(n_rounds)})
+
+    def fit(self, X, y):
+        if self.resource != 'n_samples' and any(self.resource in grid for grid in
+                                                (self.param_grid if isinstance(self.param_grid, list)
+                                                 else [self.param_grid])):
+            raise ValueError('%s is the budget of the search and cannot be in param_grid' % self.resource)
+        X = np.asarray(X, dtype=np.float32)
+        y_in = np.asarray(y)
+        # numeric (and boolean) labels as they are, anything else as the index of its sorted class
+        # (in classes_), for the search and the refit alike so both score the same positive class
+        self.labels_encoded_ = not (np.issubdtype(y_in.dtype, np.number) or y_in.dtype == bool)
+        if is_classifier(self.estimator) or self.labels_encoded_:
+            self.classes_, codes = np.unique(y_in, return_inverse=True)
+        y_fit = codes if self.labels_encoded_ else y_in
+        rows = len(X)
+        cv = check_cv(self.cv, y_in, classifier=is_classifier(self.estimator))
+        folds = np.empty(rows, dtype=np.int32)
+        for k, (_, test) in enumerate(cv.split(X, y_in)):
+            folds[test] = k
+        n_folds = k + 1
+
+        block = shared_memory.SharedMemory(create=True, size=_layout(X.shape, X.dtype, rows)[-1])
+        try:
+            views = _views(block.buf, X.shape, X.dtype, rows)
+            views['X'][:] = X
+            views['y'][:] = y_fit
+            views['folds'][:] = folds
+            views['ranks'][:] = np.random.default_rng(self.random_state).random(rows)
+            del views
+            with ProcessPoolExecutor(max_workers=self.n_jobs or os.cpu_count(), initializer=_attach,
+                                     initargs=(block.name, X.shape, X.dtype.str, rows)) as pool:
+                self._search(pool, n_folds, rows)
+        finally:
+            block.close()
+            block.unlink()
+
+        if self.refit:
+            params = dict(self.best_params_)
+            if self.resource != 'n_samples':
+                params[self.resource] = int(self.n_resources_[-1])
+            self.best_estimator_ = clone(self.estimator).set_params(**params).fit(X, y_fit)
+        return self
+
+    def _search(self, pool, n_folds, rows):
+        candidates = list(ParameterGrid(self.param_grid))
+        training_rows = rows - rows // n_folds
+        budgets = self._budgets(len(candidates), training_rows)
+        if self.resource == 'n_samples':
+            budgets = [min(budget, training_rows) for budget in budgets]
+        self.n_candidates_, self.n_resources_ = [], []
+        entries = []
+        remaining = list(range(len(candidates)))
+        for iteration, budget in enumerate(budgets):
+            self.n_candidates_.append(len(remaining))
+            self.n_resources_.append(budget)
+            futures = {(c, fold): pool.submit(_fit_and_score, self.estimator, candidates[c], self.resource, budget,
+                                              fold, self.scoring, self.return_train_score)
+                       for c in remaining for fold in range(n_folds)}
+            scores = {}
+            for c in remaining:
+                results = [futures[(c, fold)].result() for fold in range(n_folds)]
+                entries.append((c, iteration, budget, results))
+                scores[c] = np.mean([result['test_score'] for result in results])
+            if iteration < len(budgets) - 1:
+                keep = max(1, math.ceil(len(remaining) / self.factor))
+                # NaN scores (failed scoring) sort last
+                remaining = sorted(remaining, key=lambda c: (np.isnan(scores[c]), -scores[c]))[:keep]
+                remaining.sort()
+        self.n_iterations_ = len(budgets)
+        self._results(candidates, entries, n_folds)
+
+    def _results(self, candidates, entries, n_folds):
+        results = {'iter': np.array([iteration for _, iteration, _, _ in entries]),
+                   'n_resources': np.array([budget for _, _, budget, _ in entries]),
+                   'params': [candidates[c] for c, _, _, _ in entries]}
+        for name in sorted({name for params in results['params'] for name in params}):
+            column = np.ma.MaskedArray(np.empty(len(entries), dtype=object), mask=True)
+            for i, params in enumerate(results['params']):
+                if name in params:
+                    column[i] = params[name]
+            results['param_' + name] = column
+        for kind in ['test'] + (['train'] if self.return_train_score else []):
+            splits = np.array([[result[kind + '_score'] for result in folds] for _, _, _, folds in entries])
+            for fold in range(n_folds):
+                results['split%d_%s_score' % (fold, kind)] = splits[:, fold]
+            results['mean_%s_score' % kind] = splits.mean(axis=1)
+            results['std_%s_score' % kind] = splits.std(axis=1)
+        for name in ['fit_time', 'score_time']:
+            times = np.array([[result[name] for result in folds] for _, _, _, folds in entries])
+            results['mean_' + name] = times.mean(axis=1)
+            results['std_' + name] = times.std(axis=1)
+        results['elapsed_time'] = np.array([sum(result['elapsed'] for result in folds) for _, _, _, folds in entries])
+
+        # candidates that got further rank higher, then by mean test score
+        scores = np.nan_to_num(results['mean_test_score'], nan=-np.inf)
+        order = np.lexsort((-scores, -results['iter']))
+        ranks = np.empty(len(entries), dtype=np.int32)
+        ranks[order] = np.arange(1, len(entries) + 1)
+        results['rank_test_score'] = ranks
+        self.cv_results_ = results
+        self.best_index_ = int(order[0])
+        self.best_params_ = results['params'][self.best_index_]
+        self.best_score_ = float(results['mean_test_score'][self.best_index_])
+
+    def predict(self, X):
+        prediction = self.best_estimator_.predict(X)
+        return self.classes_[prediction.astype(np.intp)] if self.labels_encoded_ else prediction
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(X)
+
+    def score(self, X, y):
+        y = np.asarray(y)
+        if self.labels_encoded_:
+            # the codes the search scored with; labels not seen at fit are an error of the caller
+            codes = np.searchsorted(self.classes_, y).clip(max=len(self.classes_) - 1)
+            if (self.classes_[codes] != y).any():
+                raise ValueError('y has labels that were not seen at fit')
+            y = codes
+        return check_scoring(self.best_estimator_, self.scoring)(self.best_estimator_, X, y)
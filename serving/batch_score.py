@@ -0,0 +1,229 @@
+import argparse
+import collections
+import json
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from serving.bundle import MANIFEST, load_bundle
+
+
+# Batch scorer for request logs in the moment_1 format (admission_id, observation
+# JSON, ...), using the artifacts the deployment notebooks write or a model
+# bundle (serving.bundle), which also carries the decision threshold:
+#
+#   python -m serving.batch_score data/moment_1_requests.csv scores.csv --artifacts /tmp --threshold 0.31
+#   python -m serving.batch_score data/moment_1_requests.csv scores.csv --artifacts /tmp/bundle
+#
+# The input is read in --chunksize rows at a time and only the admission_id and
+# observation columns are kept. Each chunk is parsed with a single json.loads of
+# all its observations and scored in a process pool whose workers load the
+# pipeline once. At most 2 * --workers chunks are in flight and results are
+# written as soon as the oldest chunk is done, so the output keeps the input
+# order and memory stays bounded whatever the size of the file.
+#
+# Output columns: admission_id, proba (of readmission), prediction (proba >= threshold).
+#
+# With --validate every chunk is checked by serving.validation first. Only its
+# valid rows are scored, the others are written to --rejections (default
+# <output>.rejections.jsonl), one {"admission_id": ..., "errors": {field: reason}}
+# per line, instead of failing the chunk. Rows without an observation are never
+# scored; they are rejected with {"observation": "missing"} under --validate and
+# counted on stderr in any case.
+#
+# With --shadow, a second pipeline (artifacts or bundle) is scored on the same
+# chunks through serving.shadow, sharing the conversion with the primary one.
+# Its probabilities go to --shadow-log (default <output>.shadow.csv) from a
+# background thread, and the agreement statistics are printed at the end; the
+# output file only has the primary scores.
+
+_artifacts = {}
+
+
+def load_artifacts(artifacts_dir, compiled=False):
+    if os.path.exists(os.path.join(artifacts_dir, MANIFEST)):
+        # a model bundle: forest and preprocessing arrays are mapped, not copied into every worker
+        bundle = load_bundle(artifacts_dir)
+        pipeline = bundle.pipeline
+        if compiled and hasattr(pipeline.steps[0][1], 'compiled'):
+            pipeline.steps[0][1].compiled = True
+        return bundle.columns, bundle.dtypes, pipeline
+
+    with open(os.path.join(artifacts_dir, 'columns.json')) as fh:
+        columns = json.load(fh)
+    with open(os.path.join(artifacts_dir, 'dtypes.pickle'), 'rb') as fh:
+        dtypes = pickle.load(fh)
+    pipeline = joblib.load(os.path.join(artifacts_dir, 'pipeline.pickle'))
+
+    # the pool does the parallelism, a forest with n_jobs=-1 in every worker would oversubscribe the cores
+    model_name, model = pipeline.steps[-1]
+    if 'n_jobs' in model.get_params():
+        pipeline.set_params(**{model_name + '__n_jobs': 1})
+    if compiled:
+        # lookup table ColumnConverter, same output as the default one
+        converter = pipeline.steps[0][1]
+        if hasattr(converter, 'compiled'):
+            converter.compiled = True
+    return columns, dtypes, pipeline
+
+
+def _init_worker(artifacts_dir, compiled, shadow_dir=None, validate=False):
+    _artifacts['columns'], _artifacts['dtypes'], _artifacts['pipeline'] = load_artifacts(artifacts_dir, compiled)
+    _artifacts['validator'] = None
+    if validate:
+        from serving.validation import Validator
+        _artifacts['validator'] = Validator()
+    _artifacts['shadow'] = None
+    if shadow_dir is not None:
+        from serving.shadow import ShadowPipeline
+        _artifacts['shadow'] = ShadowPipeline(_artifacts['pipeline'], load_artifacts(shadow_dir, compiled)[2])
+
+
+def parse_observations(observations, columns, dtypes):
+    # one JSON document for the whole chunk instead of one json.loads (and one pd.Series) per row
+    records = json.loads('[' + ','.join(observations) + ']')
+    df = pd.DataFrame.from_records(records, columns=columns)
+    return df.astype(dtypes.to_dict(), errors='ignore')
+
+
+def score_chunk(admission_ids, observations, threshold, validate=False):
+    # scores of the chunk, with validate the rejections of its invalid rows and with
+    # a shadow pipeline its probabilities (None otherwise)
+    df = parse_observations(observations, _artifacts['columns'], _artifacts['dtypes'])
+    df.index = pd.Index(admission_ids, name='admission_id')
+    rejections = []
+    if validate:
+        validation = _artifacts['validator'].validate(df)
+        if not validation.valid.all():
+            rejections = [{'admission_id': entry['index'], 'errors': entry['errors']}
+                          for entry in validation.rejections()]
+            df = df[validation.valid]
+    shadow = _artifacts['shadow']
+    if not len(df):
+        proba = shadow_proba = np.empty(0)
+    elif shadow is not None:
+        proba, shadow_proba = shadow.predict_proba(df)
+    else:
+        proba, shadow_proba = _artifacts['pipeline'].predict_proba(df)[:, 1], None
+    scores = pd.DataFrame({'admission_id': df.index.to_numpy(),
+                           'proba': proba,
+                           'prediction': proba >= threshold})
+    return scores, rejections, None if shadow is None else shadow_proba
+
+
+def _chunks(path, chunksize, on_missing=None):
+    # rows without an observation are not scored, their admission_ids go to on_missing
+    reader = pd.read_csv(path, usecols=['admission_id', 'observation'],
+                         dtype={'observation': str}, chunksize=chunksize)
+    for chunk in reader:
+        missing = chunk['observation'].isna()
+        if missing.any():
+            if on_missing is not None:
+                on_missing(chunk.loc[missing, 'admission_id'].tolist())
+            chunk = chunk[~missing]
+        yield chunk['admission_id'].to_numpy(), chunk['observation'].tolist()
+
+
+def default_threshold(artifacts_dir):
+    # the threshold of a bundle, 0.5 for the notebook artifacts
+    try:
+        with open(os.path.join(artifacts_dir, MANIFEST)) as fh:
+            return json.load(fh)['threshold']
+    except FileNotFoundError:
+        return 0.5
+
+
+def score_file(path, output, artifacts_dir, threshold=None, chunksize=20000, workers=None, compiled=False,
+               validate=False, rejections=None, shadow=None, shadow_log=None):
+    # returns the number of scored rows
+    workers = workers or os.cpu_count()
+    if threshold is None:
+        threshold = default_threshold(artifacts_dir)
+    n_rows = n_missing = 0
+    rejected = open(rejections or output + '.rejections.jsonl', 'w') if validate else None
+    log = None
+    if shadow is not None:
+        from serving.shadow import ShadowLog
+        log = ShadowLog(shadow_log or output + '.shadow.csv', primary_threshold=threshold,
+                        shadow_threshold=default_threshold(shadow))
+
+    def write(result):
+        scores, rows, shadow_proba = result
+        scores.to_csv(fh, header=False, index=False)
+        for row in rows:
+            rejected.write(json.dumps(row) + '\n')
+        if log is not None:
+            log.submit(scores['admission_id'], scores['proba'], shadow_proba)
+        return len(scores)
+
+    def skip(admission_ids):
+        # rows without an observation: rejected with --validate, counted in any case
+        nonlocal n_missing
+        n_missing += len(admission_ids)
+        if rejected is not None:
+            for admission_id in admission_ids:
+                rejected.write(json.dumps({'admission_id': admission_id, 'errors': {'observation': 'missing'}})
+                               + '\n')
+
+    try:
+        with open(output, 'w', newline='') as fh:
+            fh.write('admission_id,proba,prediction\n')
+
+            if workers == 1:
+                _init_worker(artifacts_dir, compiled, shadow, validate)
+                for admission_ids, observations in _chunks(path, chunksize, skip):
+                    n_rows += write(score_chunk(admission_ids, observations, threshold, validate))
+                return n_rows
+
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(artifacts_dir, compiled, shadow, validate)) as pool:
+                pending = collections.deque()
+                for admission_ids, observations in _chunks(path, chunksize, skip):
+                    pending.append(pool.submit(score_chunk, admission_ids, observations, threshold, validate))
+                    if len(pending) >= 2 * workers:
+                        n_rows += write(pending.popleft().result())
+                while pending:
+                    n_rows += write(pending.popleft().result())
+        return n_rows
+    finally:
+        if n_missing:
+            print('skipped %d rows without an observation' % n_missing, file=sys.stderr)
+        if rejected is not None:
+            rejected.close()
+        if log is not None:
+            log.close()
+            print('shadow: %s' % json.dumps(log.stats()), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Score a moment_1 style request log with a pipeline artifact')
+    parser.add_argument('input', help='csv with admission_id and observation (JSON) columns')
+    parser.add_argument('output', help='csv to write admission_id, proba, prediction to')
+    parser.add_argument('--artifacts', default='/tmp', help='directory with columns.json, dtypes.pickle, pipeline.pickle, or a model bundle')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='proba at or above which prediction is True (default: the bundle threshold, or 0.5)')
+    parser.add_argument('--chunksize', type=int, default=20000)
+    parser.add_argument('--workers', type=int, default=None, help='scoring processes (default: all cores)')
+    parser.add_argument('--compiled', action='store_true', help='use the lookup table ColumnConverter')
+    parser.add_argument('--validate', action='store_true', help='score only valid observations, reject the others')
+    parser.add_argument('--rejections', default=None,
+                        help='JSON lines file for the rejected observations (default: <output>.rejections.jsonl)')
+    parser.add_argument('--shadow', default=None, help='artifacts or bundle of a pipeline to shadow score')
+    parser.add_argument('--shadow-log', default=None,
+                        help='csv for the shadow probabilities (default: <output>.shadow.csv)')
+    args = parser.parse_args(argv)
+
+    n_rows = score_file(args.input, args.output, args.artifacts, threshold=args.threshold,
+                        chunksize=args.chunksize, workers=args.workers, compiled=args.compiled,
+                        validate=args.validate, rejections=args.rejections,
+                        shadow=args.shadow, shadow_log=args.shadow_log)
+    print('scored %d observations' % n_rows, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from custom_transformers.compiled_forest import CompiledForest
+from custom_transformers.row_mode import RowPipeline, row_spec
+
+
+# Single versioned model bundle, replacing pipeline.pickle + columns.json +
+# dtypes.pickle of the deployment notebooks:
+#
+#   python -m serving.bundle build /tmp/bundle --pipeline /tmp/pipeline.pickle \
+#       --columns /tmp/columns.json --dtypes /tmp/dtypes.pickle --threshold 0.31
+#   bundle = load_bundle('/tmp/bundle')
+#   bundle.predict_proba_one(observation), bundle.predict_one(observation)
+#   bundle.predict_proba(df), bundle.predict(df), bundle.pipeline
+#
+# A bundle is a directory with
+#   manifest.json        format, model version, content hash, threshold, input
+#                        columns and dtypes, the category vocabularies the model
+#                        knows, and size + sha256 of every other file
+#   forest_<name>.npy    node arrays of the CompiledForest of the model
+#   row_*.npy            imputer statistics, scaler parameters and dummy tables
+#                        of the row mode spec (custom_transformers.row_mode)
+#   preprocessing.joblib the fitted steps before the model (uncompressed)
+#
+# Loading maps the .npy files and the arrays inside preprocessing.joblib
+# read-only instead of unpickling a forest into every process, so worker
+# processes share the pages of one bundle and start in milliseconds. The
+# forest is scored by CompiledForest, whose probabilities match the sklearn
+# forest up to the order in which the trees are summed.
+#
+# Single observations are scored in row mode from the manifest and the row_*
+# arrays alone. Only DataFrame scoring unpickles preprocessing.joblib, and with
+# it scikit-learn (and category_encoders for the default encoders), on first
+# use; this module imports neither, so a serving process that only scores
+# observations never pays for them (see benchmarks/cold_start.py).
+
+FORMAT = 1
+MANIFEST = 'manifest.json'
+PREPROCESSING = 'preprocessing.joblib'
+_FOREST_ARRAYS = ['feature', 'threshold', 'children', 'value', 'roots', 'classes']
+
+
+class BundleError(ValueError):
+    pass
+
+
+def _sha256(path):
+    # in 1 MiB chunks (hashlib.file_digest needs Python 3.11)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _content_hash(manifest):
+    # everything that changes the predictions: files, schema and threshold
+    content = {key: manifest[key] for key in ('format', 'threshold', 'columns', 'dtypes', 'files', 'row_mode')
+               if key in manifest}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def _jsonable(label):
+    return label.item() if isinstance(label, np.generic) else label
+
+
+def _vocabularies(preprocessing):
+    # labels of every categorical column the fitted preprocessing knows: the
+    # fixed ordinal mapping of custom_oe and the labels of the one-hot encoders
+    from custom_transformers.compiled_encoder import OneHotTables
+    vocabularies = {}
+    for _, step in preprocessing.steps:
+        # the mapping custom_oe passes to the ordinal encoder lives next to it
+        mapping = getattr(sys.modules[type(step).__module__], 'mapping', None)
+        if mapping is not None:
+            for m in mapping:
+                vocabularies[m['col']] = [_jsonable(label) for label in m['mapping']]
+        for _, transformer, cols in getattr(step, 'transformers_', []):
+            steps = getattr(transformer, 'named_steps', {})
+            if 'onehot' not in steps:
+                continue
+            onehot = steps['onehot']
+            tables = getattr(onehot, 'tables_', None) or OneHotTables(onehot)
+            for col, labels in zip(cols, tables.labels):
+                vocabularies[str(col)] = [_jsonable(label) for label in labels]
+    return vocabularies
+
+
+def _save_row_spec(spec, directory, files):
+    # arrays of the spec to row_*.npy, the rest (and the file names) to the manifest
+    def save(array, filename):
+        np.save(os.path.join(directory, filename), np.ascontiguousarray(array), allow_pickle=False)
+        files[filename] = {'dtype': str(array.dtype), 'shape': list(array.shape)}
+        return filename
+
+    # category_encoders turns the mapping dicts of custom_oe into int64 Series when it fits
+    ordinal = [{'col': m['col'], 'mapping': {label: int(code) for label, code in m['mapping'].items() if label == label}}
+               for m in spec['ordinal']]
+    row = {'risk': spec['risk'], 'ordinal': ordinal, 'width': spec['width'], 'rest': spec['rest'],
+           'num': [], 'cat': []}
+    for i, block in enumerate(spec['num']):
+        entry = {'columns': block['columns'], 'start': block['start']}
+        for name in ('fill', 'center', 'scale'):
+            entry[name] = save(block[name], 'row_num%d_%s.npy' % (i, name))
+        row['num'].append(entry)
+    for i, block in enumerate(spec['cat']):
+        row['cat'].append({'column': block['column'], 'start': block['start'],
+                           'labels': [_jsonable(label) for label in block['labels']],
+                           'fill_value': _jsonable(block['fill_value']),
+                           'table': save(block['table'], 'row_cat%d.npy' % i)})
+    return row
+
+
+def _load_row_spec(path, row):
+    def load(filename):
+        return np.load(os.path.join(path, filename), mmap_mode='r', allow_pickle=False)
+
+    spec = dict(row)
+    spec['num'] = [dict(block, **{name: load(block[name]) for name in ('fill', 'center', 'scale')})
+                   for block in row['num']]
+    spec['cat'] = [dict(block, table=load(block['table'])) for block in row['cat']]
+    return spec
+
+
+def save_bundle(pipeline, path, dtypes, columns=None, threshold=0.5, model_version=None):
+    # pipeline: fitted, ending in a forest or tree; dtypes: X_train.dtypes;
+    # columns defaults to the index of dtypes. path must not exist yet.
+    import joblib
+    from sklearn.pipeline import Pipeline
+
+    if os.path.exists(path):
+        raise FileExistsError(path)
+    columns = list(dtypes.index) if columns is None else list(columns)
+    preprocessing = Pipeline(pipeline.steps[:-1])
+    forest = CompiledForest.from_model(pipeline)
+    try:
+        spec = row_spec(pipeline)
+    except ValueError:
+        # not the deployment layout, observations are then scored as one row DataFrames
+        spec = None
+
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    try:
+        files = {}
+        for name in _FOREST_ARRAYS:
+            array = getattr(forest, name if name != 'classes' else 'classes_')
+            filename = 'forest_%s.npy' % name
+            np.save(os.path.join(tmp, filename), np.ascontiguousarray(array), allow_pickle=False)
+            files[filename] = {'dtype': str(array.dtype), 'shape': list(array.shape)}
+        row = None if spec is None else _save_row_spec(spec, tmp, files)
+        joblib.dump(preprocessing, os.path.join(tmp, PREPROCESSING))
+        files[PREPROCESSING] = {}
+        for filename, entry in files.items():
+            entry['bytes'] = os.path.getsize(os.path.join(tmp, filename))
+            entry['sha256'] = _sha256(os.path.join(tmp, filename))
+
+        manifest = {'format': FORMAT,
+                    'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                    'threshold': float(threshold),
+                    'columns': columns,
+                    'dtypes': {col: str(dtypes[col]) for col in columns},
+                    'categories': {col: [_jsonable(label) for label in dtypes[col].categories]
+                                   for col in columns if isinstance(dtypes[col], pd.CategoricalDtype)},
+                    'vocabularies': _vocabularies(preprocessing),
+                    'forest': {'n_trees': forest.n_trees, 'max_depth': forest.max_depth,
+                               'n_features': forest.n_features_in_},
+                    'row_mode': row,
+                    'versions': {'numpy': np.__version__, 'pandas': pd.__version__,
+                                 'sklearn': sys.modules['sklearn'].__version__},
+                    'files': files}
+        manifest['content_hash'] = _content_hash(manifest)
+        manifest['model_version'] = model_version or manifest['content_hash'][:12]
+        with open(os.path.join(tmp, MANIFEST), 'w') as fh:
+            json.dump(manifest, fh, indent=1)
+        os.rename(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return manifest
+
+
+class ModelBundle:
+    def __init__(self, path, manifest, forest, row_pipeline=None):
+        self.path = path
+        self.manifest = manifest
+        self.model_version = manifest['model_version']
+        self.content_hash = manifest['content_hash']
+        self.threshold = manifest['threshold']
+        self.columns = manifest['columns']
+        self.dtypes = pd.Series({col: pd.CategoricalDtype(manifest['categories'][col])
+                                 if col in manifest['categories'] else pd.api.types.pandas_dtype(dtype)
+                                 for col, dtype in manifest['dtypes'].items()}, dtype=object)
+        self.forest = forest
+        self.row_pipeline = row_pipeline
+        self._preprocessing = None
+        self._pipeline = None
+
+    @property
+    def preprocessing(self):
+        # unpickled (which imports scikit-learn) when first needed
+        if self._preprocessing is None:
+            import joblib
+            self._preprocessing = joblib.load(os.path.join(self.path, PREPROCESSING), mmap_mode='r')
+        return self._preprocessing
+
+    @property
+    def pipeline(self):
+        # the deployment layout with the compiled forest as its last step
+        if self._pipeline is None:
+            from sklearn.pipeline import Pipeline
+            self._pipeline = Pipeline(self.preprocessing.steps + [('compiledforest', self.forest)])
+        return self._pipeline
+
+    def frame(self, records):
+        # observations (dicts) as the DataFrame the pipeline was trained on
+        df = pd.DataFrame.from_records(records, columns=self.columns)
+        return df.astype(self.dtypes.to_dict(), errors='ignore')
+
+    def predict_proba(self, df):
+        return self.pipeline.predict_proba(df)
+
+    def predict(self, df):
+        return self.predict_proba(df)[:, 1] >= self.threshold
+
+    def predict_proba_one(self, observation):
+        # one observation (a dict); row mode reuses one buffer, so not from several threads at once
+        if self.row_pipeline is None:
+            return self.predict_proba(self.frame([observation]))[0]
+        return self.forest.predict_proba_row(self.row_pipeline.transform(observation))
+
+    def predict_one(self, observation):
+        return self.predict_proba_one(observation)[1] >= self.threshold
+
+
+def load_bundle(path, verify=True):
+    # verify compares sizes and sha256 of all files with the manifest
+    try:
+        with open(os.path.join(path, MANIFEST)) as fh:
+            manifest = json.load(fh)
+    except OSError:
+        raise BundleError('%s: %s is missing' % (path, MANIFEST))
+    if manifest.get('format') != FORMAT:
+        raise BundleError('%s: unsupported bundle format %r' % (path, manifest.get('format')))
+    if _content_hash(manifest) != manifest['content_hash']:
+        raise BundleError('%s: manifest does not match its content hash' % path)
+    for filename, entry in manifest['files'].items():
+        file_path = os.path.join(path, filename)
+        try:
+            if os.path.getsize(file_path) != entry['bytes']:
+                raise BundleError('%s: size of %s does not match the manifest' % (path, filename))
+            if verify and _sha256(file_path) != entry['sha256']:
+                raise BundleError('%s: checksum of %s does not match the manifest' % (path, filename))
+        except OSError:
+            raise BundleError('%s: %s is missing' % (path, filename))
+
+    arrays = {name: np.load(os.path.join(path, 'forest_%s.npy' % name), mmap_mode='r', allow_pickle=False)
+              for name in _FOREST_ARRAYS}
+    forest = CompiledForest.from_children(max_depth=manifest['forest']['max_depth'],
+                                          n_features=manifest['forest']['n_features'], **arrays)
+    row_pipeline = None
+    if manifest.get('row_mode') is not None:
+        row_pipeline = RowPipeline.from_spec(_load_row_spec(path, manifest['row_mode']), forest)
+    return ModelBundle(path, manifest, forest, row_pipeline)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build or check a model bundle')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='bundle the artifacts of the deployment notebooks')
+    build.add_argument('path', help='bundle directory to create')
+    build.add_argument('--pipeline', default='/tmp/pipeline.pickle')
+    build.add_argument('--columns', default='/tmp/columns.json')
+    build.add_argument('--dtypes', default='/tmp/dtypes.pickle')
+    build.add_argument('--threshold', type=float, default=0.5)
+    build.add_argument('--model-version', default=None)
+    check = commands.add_parser('check', help='verify a bundle and time loading it')
+    check.add_argument('path')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        with open(args.columns) as fh:
+            columns = json.load(fh)
+        with open(args.dtypes, 'rb') as fh:
+            dtypes = pickle.load(fh)
+        import joblib
+        manifest = save_bundle(joblib.load(args.pipeline), args.path, dtypes, columns=columns,
+                               threshold=args.threshold, model_version=args.model_version)
+    else:
+        start = time.perf_counter()
+        manifest = load_bundle(args.path).manifest
+        print('loaded and verified in %.1f ms' % ((time.perf_counter() - start) * 1000))
+    print('model version %s, %d trees, %d bytes' % (manifest['model_version'], manifest['forest']['n_trees'],
+                                                     sum(entry['bytes'] for entry in manifest['files'].values())))
+
+
+if __name__ == '__main__':
+    main()
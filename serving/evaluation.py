@@ -0,0 +1,230 @@
+import argparse
+import json
+import warnings
+
+import numpy as np
+import pandas as pd
+
+
+# Threshold selection and per group metrics for logged predictions, with
+# bootstrap confidence intervals:
+#
+#   curve = pr_curve(y_true, proba, groups=X[['race', 'gender']])
+#   precision_threshold(curve, min_precision=0.5)      # per group, 'all' is the whole population
+#   results, summary = evaluate(y_true, proba, X, ['race', 'gender', 'medical_specialty'],
+#                               min_precision=0.5, n_boot=1000)
+#
+#   python -m serving.evaluation data/moment_1_requests.csv scores.csv --columns race gender medical_specialty
+#
+# pr_curve() sorts the scores once for the whole population and every group of
+# every column (rows are stacked per column and sorted by group, then score)
+# and takes precision, recall and F1 at every distinct score of every group
+# from running sums, like sklearn's precision_recall_curve does for one group.
+# precision_threshold() picks, like the deployment notebooks, the lowest
+# threshold whose precision reaches min_precision. Precision is not monotone in
+# the threshold, so this is a scan for the first threshold that qualifies, not
+# a binary search.
+#
+# At a fixed threshold a group only needs its four confusion matrix counts.
+# Resampling rows with replacement and counting them again is the same as
+# drawing those counts from a multinomial over the cells, so evaluate() draws
+# all n_boot resamples of every column at once from the cells, whatever the
+# number of rows. results has one row per (column, group) with rows,
+# positives, precision, recall and F1 (and their _low/_high percentile
+# intervals) at the chosen threshold, plus the threshold the group alone
+# would need for min_precision. summary has, per column, the spread of the
+# metric between groups with more than min_samples rows (the discrimination
+# check of the notebooks) with its interval and whether it is within max_diff.
+
+ALL = 'all'
+METRICS = ['precision', 'recall', 'f1']
+
+
+def _stack(groups, n):
+    # every row once for the whole population and once per column of groups: the
+    # group id of each stacked row (row i of block k is stacked row k * n + i) and
+    # (column, group) per id. Rows without a group (NaN) get a hidden id per
+    # column, dropped from the output but kept as a cell so resamples keep their size.
+    ids = [np.zeros(n, dtype=np.int32)]
+    keys = [(ALL, ALL)]
+    hidden = []
+    columns = [] if groups is None else list(groups.columns)
+    for col in columns:
+        codes, labels = pd.factorize(groups[col], sort=True)
+        offset = len(keys)
+        keys += [(col, label) for label in labels]
+        hidden.append(len(keys))
+        keys.append((col, None))
+        ids.append(np.where(codes < 0, hidden[-1], codes + offset).astype(np.int32))
+    return np.concatenate(ids), keys, hidden
+
+
+def _frame(keys, ids, data, hidden):
+    keep = ~np.isin(ids, hidden)
+    ids = ids[keep]
+    names = list(dict.fromkeys(col for col, _ in keys))
+    column_codes = np.array([names.index(col) for col, _ in keys])
+    labels = np.empty(len(keys), dtype=object)
+    labels[:] = [group for _, group in keys]
+    return pd.DataFrame(dict({'column': pd.Categorical.from_codes(column_codes[ids], names), 'group': labels[ids]},
+                             **{name: np.asarray(values)[keep] for name, values in data.items()}))
+
+
+def _metrics(tp, fp, fn):
+    # precision, recall and F1 with NaN where they are undefined
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {'precision': tp / (tp + fp), 'recall': tp / (tp + fn), 'f1': 2 * tp / (2 * tp + fp + fn)}
+
+
+def _curve(y, scores, stacked, weights=None):
+    ids, keys, hidden = stacked
+    n = len(y)
+    # the one sort of the scores; every block then only needs a stable sort of its
+    # small integer group ids, which keeps the score order within every group
+    by_score = np.argsort(-scores, kind='stable')
+    order = np.concatenate([k * n + by_score[np.argsort(ids[k * n + by_score], kind='stable')]
+                            for k in range(len(ids) // n)]) if n else by_score
+    rows = order % n if n else order
+    ids, scores, y = ids[order], scores[rows], y[rows]
+    w = np.ones(len(rows), dtype=np.int64) if weights is None else np.asarray(weights)[rows]
+
+    tp = np.cumsum(w * y)
+    fp = np.cumsum(w * ~y)
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    ends = np.r_[starts[1:], len(ids)] - 1
+    lengths = ends - starts + 1
+    tp_before = np.repeat(np.r_[0, tp][starts], lengths)
+    fp_before = np.repeat(np.r_[0, fp][starts], lengths)
+    positives = np.repeat(tp[ends], lengths) - tp_before
+    tp, fp = tp - tp_before, fp - fp_before
+
+    last = np.r_[(ids[1:] != ids[:-1]) | (scores[1:] != scores[:-1]), True]
+    tp, fp, fn = tp[last], fp[last], (positives - tp)[last]
+    return _frame(keys, ids[last], dict({'threshold': scores[last], 'tp': tp, 'fp': fp, 'fn': fn},
+                                        **_metrics(tp, fp, fn)), hidden)
+
+
+def pr_curve(y_true, proba, groups=None, weights=None):
+    # per (column, group) and distinct score, in decreasing threshold order: tp, fp, fn,
+    # precision, recall and f1 of predicting proba >= threshold
+    y = np.asarray(y_true, dtype=bool)
+    return _curve(y, np.asarray(proba, dtype=np.float64), _stack(groups, len(y)), weights)
+
+
+def precision_threshold(curve, min_precision=0.5):
+    # per (column, group): the lowest threshold with precision >= min_precision, NaN if there is none
+    groups = curve[['column', 'group']].drop_duplicates()
+    qualified = curve[curve['precision'] >= min_precision]
+    # within a group the curve runs from the highest threshold down, the lowest is its last row
+    lowest = qualified.drop_duplicates(['column', 'group'], keep='last')
+    lowest = pd.Series(lowest['threshold'].to_numpy(), index=pd.MultiIndex.from_frame(lowest[['column', 'group']]))
+    return lowest.reindex(pd.MultiIndex.from_frame(groups), copy=False).rename('threshold')
+
+
+def _cells(y, scores, threshold, ids, n_ids):
+    # (n_ids, 4) confusion counts: tn, fp, fn, tp
+    cell = np.tile(y.astype(np.intp) * 2 + (scores >= threshold), len(ids) // max(len(y), 1))
+    return np.bincount(ids * 4 + cell, minlength=n_ids * 4).reshape(n_ids, 4)
+
+
+def _bootstrap(cells, blocks, n_boot, rng):
+    # (n_boot, n_ids, 4) resampled counts, one multinomial per column block
+    samples = np.empty((n_boot,) + cells.shape, dtype=np.int64)
+    for block in blocks:
+        counts = cells[block].ravel()
+        total = counts.sum()
+        drawn = rng.multinomial(total, counts / total, size=n_boot) if total else np.zeros((n_boot, counts.size))
+        samples[:, block] = drawn.reshape(n_boot, len(block), 4)
+    return samples
+
+
+def evaluate(y_true, proba, frame=None, columns=(), threshold=None, min_precision=0.5, n_boot=1000,
+             alpha=0.05, metric='precision', min_samples=50, max_diff=0.1, seed=0):
+    # threshold=None picks the population's precision_threshold(min_precision)
+    y = np.asarray(y_true, dtype=bool)
+    scores = np.asarray(proba, dtype=np.float64)
+    stacked = _stack(None if not columns else frame[list(columns)], len(y))
+    ids, keys, hidden = stacked
+    own = precision_threshold(_curve(y, scores, stacked), min_precision)
+    if threshold is None:
+        threshold = own.loc[(ALL, ALL)]
+
+    cells = _cells(y, scores, threshold, ids, len(keys))
+    blocks = [np.arange(1)] + [np.arange(start + 1, end + 1) for start, end in zip([0] + hidden[:-1], hidden)]
+    boot = _bootstrap(cells, blocks, n_boot, np.random.default_rng(seed))
+    point = _metrics(cells[:, 3] * 1.0, cells[:, 1] * 1.0, cells[:, 2] * 1.0)
+    sampled = _metrics(boot[..., 3] * 1.0, boot[..., 1] * 1.0, boot[..., 2] * 1.0)
+    quantiles = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+
+    data = {'rows': cells.sum(axis=1), 'positives': cells[:, 2] + cells[:, 3],
+            'threshold': np.full(len(keys), threshold)}
+    for name in METRICS:
+        with warnings.catch_warnings():
+            # groups without a single defined value in any resample (e.g. the hidden NaN cells)
+            warnings.simplefilter('ignore', RuntimeWarning)
+            low, high = np.nanpercentile(sampled[name], quantiles, axis=0)
+        data.update({name: point[name], name + '_low': low, name + '_high': high})
+    results = _frame(keys, np.arange(len(keys)), data, hidden)
+    results['precision_threshold'] = own.reindex(pd.MultiIndex.from_frame(results[['column', 'group']])).to_numpy()
+
+    summary = []
+    for col, block in zip(columns, blocks[1:]):
+        block = block[:-1]
+        included = block[data['rows'][block] > min_samples]
+        values = point[metric][included]
+        spread = np.nanmax(values) - np.nanmin(values) if np.isfinite(values).any() else np.nan
+        sampled_values = sampled[metric][:, included]
+        finite = np.isfinite(sampled_values).any(axis=1)
+        spreads = np.nanmax(sampled_values[finite], axis=1) - np.nanmin(sampled_values[finite], axis=1)
+        low, high = np.percentile(spreads, quantiles) if len(spreads) else (np.nan, np.nan)
+        summary.append({'column': col, 'metric': metric, 'groups': len(included), 'diff': spread,
+                        'diff_low': low, 'diff_high': high, 'max_diff': max_diff,
+                        'is_satisfied': bool(spread <= max_diff)})
+    return results, pd.DataFrame(summary, columns=['column', 'metric', 'groups', 'diff', 'diff_low', 'diff_high',
+                                                   'max_diff', 'is_satisfied'])
+
+
+def load_logged(requests_path, scores_path, columns):
+    # truth and group columns (after ColumnConverter) of a request log joined with batch_score output
+    from custom_transformers.preprocessor import ColumnConverter
+
+    requests = pd.read_csv(requests_path, usecols=['admission_id', 'observation', 'actual_readmitted'],
+                           dtype={'observation': str})
+    requests = requests.dropna(subset=['observation', 'actual_readmitted'])
+    scores = pd.read_csv(scores_path, usecols=['admission_id', 'proba'])
+    logged = requests.merge(scores, on='admission_id')
+    observations = pd.DataFrame.from_records(json.loads('[' + ','.join(logged['observation']) + ']'))
+    frame = ColumnConverter(compiled=True).fit_transform(observations)[list(columns)]
+    truth = logged['actual_readmitted']
+    if truth.dtype == object:
+        truth = truth.astype(str).str.lower().isin(['yes', 'true', '1'])
+    return truth.to_numpy(dtype=bool), logged['proba'].to_numpy(), frame
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('requests', help='request log with admission_id, observation and actual_readmitted')
+    parser.add_argument('scores', help='batch_score output with admission_id and proba')
+    parser.add_argument('--columns', nargs='*', default=['race', 'gender', 'medical_specialty'])
+    parser.add_argument('--threshold', type=float, default=None, help='default: lowest with --min-precision')
+    parser.add_argument('--min-precision', type=float, default=0.5)
+    parser.add_argument('--bootstrap', type=int, default=1000)
+    parser.add_argument('--metric', choices=METRICS, default='precision')
+    parser.add_argument('--min-samples', type=int, default=50)
+    parser.add_argument('--max-diff', type=float, default=0.1)
+    parser.add_argument('--output', help='CSV for the per group results')
+    args = parser.parse_args(argv)
+
+    y_true, proba, frame = load_logged(args.requests, args.scores, args.columns)
+    results, summary = evaluate(y_true, proba, frame, args.columns, threshold=args.threshold,
+                                min_precision=args.min_precision, n_boot=args.bootstrap, metric=args.metric,
+                                min_samples=args.min_samples, max_diff=args.max_diff)
+    if args.output:
+        results.to_csv(args.output, index=False)
+    with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.max_rows', None):
+        print(results.round(4).to_string(index=False))
+        print(summary.round(4).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from custom_transformers.compiled_converter import cell_rules
+
+
+# Idempotent prediction cache for re-sent admissions.
+#
+#   cache = PredictionCache(bundle.content_hash, risk=bundle.manifest['row_mode']['risk'],
+#                           max_bytes=64 << 20, ttl=3600, path='/var/cache/predictions.sqlite')
+#   key = cache.key(admission_id, observation)
+#   result = cache.get(key)
+#   if result is None:
+#       result = score(observation)
+#       cache.put(key, result)
+#
+# The key is the admission_id plus a hash of the observation after the per
+# value rules of ColumnConverter (compiled_converter.cell_rules): two payloads
+# collide exactly when the converter turns them into the same cells, so e.g.
+# 'Yes' and 'yes' or 'V57' and 'v57' share an entry while values the converter
+# tells apart never do. Fields the converter does not touch are hashed as sent.
+# key() returns None for observations the rules reject (they are not cached).
+#
+# Entries are kept in LRU order and evicted beyond max_bytes (an estimate of
+# key and JSON result sizes) and, with ttl, after ttl seconds. The cache
+# belongs to one model: entries of any other model hash are dropped, on
+# invalidate() and when a persisted cache is opened.
+#
+# With path, entries are mirrored to a SQLite file, written in batches of
+# _FLUSH_EVERY changes (and on flush()/close()), and the newest entries that
+# fit are loaded back when the cache is opened, so a restart starts warm.
+
+_ENTRY_OVERHEAD = 200
+_FLUSH_EVERY = 256
+
+
+class PredictionCache:
+    def __init__(self, model_hash, risk=False, max_bytes=64 << 20, ttl=None, path=None):
+        self.model_hash = model_hash
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        self._rules = cell_rules(risk=risk)
+        self._sources = {source for source, _ in self._rules.values()}
+        self._entries = collections.OrderedDict()   # key -> (result JSON, expires, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._pending = {}                          # key -> (result JSON, expires) or None to delete
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'invalidations': 0}
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS predictions '
+                             '(key TEXT PRIMARY KEY, model_hash TEXT, result TEXT, expires REAL, stored REAL)')
+            self._db.execute('DELETE FROM predictions WHERE model_hash != ?', (model_hash,))
+            self._db.commit()
+            self._load()
+
+    def key(self, admission_id, observation):
+        cells = {}
+        try:
+            for col, (source, rule) in self._rules.items():
+                cells[col] = rule(observation.get(source))
+        except (TypeError, ValueError):
+            return None
+        cells.update((name, value) for name, value in observation.items() if name not in self._sources)
+        canonical = json.dumps(cells, sort_keys=True, default=repr)
+        return '%s:%s' % (admission_id, hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest())
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            result, expires, _ = entry
+            if expires is not None and expires < time.time():
+                self._remove(key)
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+        return json.loads(result)
+
+    def put(self, key, result):
+        if key is None:
+            return
+        result = json.dumps(result)
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            self._insert(key, result, expires)
+            if self._db is not None:
+                self._pending[key] = (result, expires)
+                if len(self._pending) >= _FLUSH_EVERY:
+                    self._flush()
+
+    def _insert(self, key, result, expires):
+        if key in self._entries:
+            self._remove(key)
+        size = len(key) + len(result) + _ENTRY_OVERHEAD
+        self._entries[key] = (result, expires, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.stats['evictions'] += 1
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+        if self._db is not None:
+            self._pending[key] = None
+
+    def invalidate(self, model_hash):
+        # a new model: everything cached so far is stale
+        if model_hash == self.model_hash:
+            return
+        with self._lock:
+            self.model_hash = model_hash
+            self._entries.clear()
+            self._pending.clear()
+            self._bytes = 0
+            self.stats['invalidations'] += 1
+            if self._db is not None:
+                self._db.execute('DELETE FROM predictions')
+                self._db.commit()
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self._bytes, model_hash=self.model_hash)
+
+    def _load(self):
+        # newest entries first, until the memory cap
+        rows = self._db.execute('SELECT key, result, expires FROM predictions WHERE expires IS NULL OR expires > ? '
+                                'ORDER BY stored DESC', (time.time(),))
+        loaded = []
+        size = 0
+        for key, result, expires in rows:
+            size += len(key) + len(result) + _ENTRY_OVERHEAD
+            if size > self.max_bytes:
+                break
+            loaded.append((key, result, expires))
+        for key, result, expires in reversed(loaded):
+            self._insert(key, result, expires)
+        self._pending.clear()
+        self._db.execute('DELETE FROM predictions WHERE expires IS NOT NULL AND expires <= ?', (time.time(),))
+        self._db.commit()
+
+    def _flush(self):
+        now = time.time()
+        self._db.executemany('DELETE FROM predictions WHERE key = ?',
+                             [(key,) for key, entry in self._pending.items() if entry is None])
+        self._db.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)',
+                             [(key, self.model_hash, result, expires, now)
+                              for key, entry in self._pending.items() if entry is not None
+                              for result, expires in [entry]])
+        self._db.commit()
+        self._pending.clear()
+
+    def flush(self):
+        with self._lock:
+            if self._db is not None:
+                self._flush()
+
+    def close(self):
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,425 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from serving.bundle import load_bundle
+from serving.prediction_cache import PredictionCache
+
+
+# Micro-batching prediction server for a model bundle (serving.bundle), on
+# plain asyncio:
+#
+#   python -m serving.server /tmp/bundle --port 8000 --workers 2 --max-batch 64 --max-wait-ms 2
+#   curl -d '{"admission_id": 1, "observation": {...}}' localhost:8000/predict
+#   -> {"admission_id": 1, "proba": 0.41, "prediction": true}
+#
+# POST /predict takes one observation, either as {"observation": {...}} with
+# an optional admission_id (the observation may also be a JSON string, as in
+# the moment_1 request logs) or as the bare observation object. prediction is
+# proba >= the threshold stored in the bundle (or --threshold).
+# GET /health reports the model version, queue length, batching and cache counters.
+#
+# With --cache-mb, probabilities are cached per admission_id and normalised
+# observation (serving.prediction_cache), so re-sent admissions are answered
+# without scoring; --cache-path keeps the cache in a SQLite file across restarts.
+#
+# Requests are put on a bounded queue and merged into batches of at most
+# --max-batch observations. A batch is closed when it is full or --max-wait-ms
+# after its first request arrived. At most --workers batches are scored at a
+# time, each in a worker process (the bundle's arrays are memory-mapped, so
+# the workers share them). While all workers are busy requests keep queueing
+# and the next batch takes as many as it can at once, so batches grow with the
+# load instead of the latency. When the queue is full, requests get 503 with
+# Retry-After immediately instead of waiting.
+#
+# Batches are scored in row mode into one float32 matrix and the forest
+# predicts them in a single call. An observation that cannot be scored (e.g.
+# a label the encoder never saw, which gives NaN features) fails alone with
+# 422, the rest of its batch is unaffected.
+#
+# With --validate every batch is checked by serving.validation before scoring
+# and invalid observations get 422 with the reason of every failing field,
+# {"admission_id": 1, "error": "invalid observation", "fields": {"num_medications": "type"}}.
+#
+# With --shadow every batch is also scored by a second bundle (e.g. the redeploy
+# next to the deployed model). Responses only carry the primary scores; the
+# shadow's go to a serving.shadow.ShadowLog thread, its agreement statistics to
+# /health and its probabilities to --shadow-log. In frame mode both run as one
+# ShadowPipeline sharing the conversion, in row mode the shadow adds its own row
+# pipeline and forest to the batch. Cached answers are not shadow scored.
+
+MAX_BODY = 1 << 20
+
+_worker = {}
+
+
+class Overloaded(Exception):
+    pass
+
+
+class ScoringError(Exception):
+    pass
+
+
+def _init_worker(bundle_path, mode, validate=False, shadow_path=None):
+    # checksums were verified by the server process
+    _worker['bundle'] = load_bundle(bundle_path, verify=False)
+    _worker['mode'] = mode
+    _worker['validator'] = None
+    if validate:
+        # serving.validation is only imported when it is used
+        from serving.validation import Validator
+        _worker['validator'] = Validator()
+    _worker['shadow'] = None if shadow_path is None else load_bundle(shadow_path, verify=False)
+    _worker['shadow_pipeline'] = None
+
+
+def score_batch(observations):
+    # [(proba of readmission or None, error or None)] for a list of observation dicts;
+    # the error of an invalid observation is {'error': ..., 'fields': {field: reason}}.
+    # With a shadow bundle every result has the shadow's proba (or None) as a third element.
+    validator = _worker.get('validator')
+    if validator is not None:
+        validation = validator.validate_records(observations)
+        if not validation.valid.all():
+            no_shadow = () if _worker.get('shadow') is None else (None,)
+            results = [(None, {'error': 'invalid observation', 'fields': entry['errors']}) + no_shadow
+                       for entry in validation.rejections()]
+            valid = [observation for observation, ok in zip(observations, validation.valid) if ok]
+            scored = iter(_score(valid) if valid else [])
+            results = iter(results)
+            return [next(scored) if ok else next(results) for ok in validation.valid]
+    return _score(observations)
+
+
+def _score(observations):
+    bundle, shadow = _worker['bundle'], _worker.get('shadow')
+    if _worker['mode'] == 'frame' or bundle.row_pipeline is None or \
+            (shadow is not None and shadow.row_pipeline is None):
+        return _score_frames(bundle, observations, shadow)
+
+    proba, errors = _score_rows(bundle, observations)
+    results = [(float(p), None) if p == p else (None, error or 'observation gives NaN features (unknown label?)')
+               for p, error in zip(proba, errors)]
+    if shadow is None:
+        return results
+    # the shadow's own row pipeline and forest, on the same validated batch
+    shadow_proba = _score_rows(shadow, observations)[0]
+    return [result + (float(p) if p == p else None,) for result, p in zip(results, shadow_proba)]
+
+
+def _score_rows(bundle, observations):
+    # row mode: probas (NaN where there is none) and errors
+    row_pipeline = bundle.row_pipeline
+    X = np.empty((len(observations), len(row_pipeline.buffer)), dtype=np.float32)
+    errors = [None] * len(observations)
+    for i, observation in enumerate(observations):
+        try:
+            X[i] = row_pipeline.transform(observation)
+        except Exception as exc:
+            errors[i] = '%s: %s' % (type(exc).__name__, exc)
+            X[i] = np.nan
+    scorable = ~np.isnan(X).any(axis=1)
+    proba = np.full(len(observations), np.nan)
+    if scorable.any():
+        proba[scorable] = bundle.forest.predict_proba(X[scorable])[:, 1]
+    return proba, errors
+
+
+def _shadow_pipeline(bundle, shadow):
+    # primary and shadow pipelines sharing their common steps (serving.shadow), built on first use
+    if _worker.get('shadow_pipeline') is None:
+        from serving.shadow import ShadowPipeline
+        _worker['shadow_pipeline'] = ShadowPipeline(bundle.pipeline, shadow.pipeline)
+    return _worker['shadow_pipeline']
+
+
+def _score_frames(bundle, observations, shadow=None):
+    # the DataFrame path, one batch at a time and row by row if the batch fails
+    try:
+        df = bundle.frame(observations)
+        if shadow is None:
+            return [(float(p), None) for p in bundle.predict_proba(df)[:, 1]]
+        proba, shadow_proba = _shadow_pipeline(bundle, shadow).predict_proba(df)
+        return [(float(p), None, float(s)) for p, s in zip(proba, shadow_proba)]
+    except Exception:
+        if len(observations) == 1 and shadow is None:
+            raise
+    results = []
+    for observation in observations:
+        try:
+            results.append((float(bundle.predict_proba(bundle.frame([observation]))[0, 1]), None))
+        except Exception as exc:
+            results.append((None, '%s: %s' % (type(exc).__name__, exc)))
+    # the shadow is not scored row by row
+    return results if shadow is None else [result + (None,) for result in results]
+
+
+class MicroBatcher:
+    def __init__(self, score, max_batch=64, max_wait=0.002, max_queue=1024, concurrency=1):
+        # score: coroutine function taking a list of observations, returning score_batch results
+        self.score = score
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self._arrived = asyncio.Event()
+        self._slots = asyncio.Semaphore(concurrency)
+        self.stats = {'requests': 0, 'rejected': 0, 'batches': 0, 'rows': 0, 'errors': 0}
+
+    async def submit(self, observation):
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((observation, future))
+        except asyncio.QueueFull:
+            self.stats['rejected'] += 1
+            raise Overloaded()
+        self.stats['requests'] += 1
+        self._arrived.set()
+        result = await future
+        if result[1] is not None:
+            raise ScoringError(result[1])
+        # (proba, None) or with a shadow bundle (proba, None, shadow proba)
+        return result
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        tasks = set()
+        while True:
+            await self._slots.acquire()
+            batch = await self._next_batch()
+            task = asyncio.create_task(self._score(batch))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    async def _score(self, batch):
+        try:
+            results = await self.score([observation for observation, _ in batch])
+        except Exception as exc:
+            self.stats['errors'] += len(batch)
+            results = [(None, '%s: %s' % (type(exc).__name__, exc))] * len(batch)
+        finally:
+            self._slots.release()
+        self.stats['batches'] += 1
+        self.stats['rows'] += len(batch)
+        for (_, future), result in zip(batch, results):
+            # the client may have gone away
+            if not future.done():
+                future.set_result(result)
+
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            413: 'Payload Too Large', 422: 'Unprocessable Entity', 503: 'Service Unavailable'}
+
+
+class PredictionServer:
+    def __init__(self, bundle_path, workers=1, max_batch=64, max_wait=0.002, max_queue=1024, threshold=None,
+                 mode='row', cache_bytes=0, cache_ttl=None, cache_path=None, validate=False, shadow=None,
+                 shadow_log=None):
+        self.bundle = load_bundle(bundle_path)
+        self.threshold = self.bundle.threshold if threshold is None else threshold
+        self.shadow = None
+        if shadow is not None:
+            # serving.shadow is only imported when it is used
+            from serving.shadow import ShadowLog
+            self.shadow = load_bundle(shadow)
+            self.shadow_log = ShadowLog(shadow_log, primary_threshold=self.threshold,
+                                        shadow_threshold=self.shadow.threshold)
+        self.cache = None
+        if cache_bytes:
+            row_mode = self.bundle.manifest.get('row_mode') or {}
+            self.cache = PredictionCache(self.bundle.content_hash, risk=row_mode.get('risk', False),
+                                         max_bytes=cache_bytes, ttl=cache_ttl, path=cache_path)
+        if workers:
+            # the pool starts its workers on the first batch, when the listening and client
+            # sockets (and the shadow log thread) exist; forked workers would inherit the
+            # sockets and keep closed connections open, so they come from a fork server
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                initargs=(bundle_path, mode, validate, shadow),
+                                                mp_context=context)
+        else:
+            # scoring in a thread of the server process, e.g. for debugging
+            _init_worker(bundle_path, mode, validate, shadow)
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batcher_args = dict(max_batch=max_batch, max_wait=max_wait, max_queue=max_queue,
+                                 concurrency=max(1, workers))
+        self.batcher = None
+
+    async def _score(self, observations):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, score_batch, observations)
+
+    async def predict(self, body):
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return 400, {'error': 'body is not JSON'}
+        if not isinstance(payload, dict):
+            return 400, {'error': 'expected a JSON object'}
+        admission_id = payload.get('admission_id')
+        observation = payload.get('observation', payload)
+        if isinstance(observation, str):
+            try:
+                observation = json.loads(observation)
+            except ValueError:
+                return 400, {'error': 'observation is not JSON'}
+        if not isinstance(observation, dict):
+            return 400, {'error': 'observation must be an object'}
+
+        key = None if self.cache is None else self.cache.key(admission_id, observation)
+        proba = None if key is None else self.cache.get(key)
+        if proba is None:
+            try:
+                proba, _, *shadow = await self.batcher.submit(observation)
+            except Overloaded:
+                return 503, {'error': 'overloaded, retry later'}
+            except ScoringError as exc:
+                error = exc.args[0]
+                if isinstance(error, dict):
+                    return 422, dict({'admission_id': admission_id}, **error)
+                return 422, {'admission_id': admission_id, 'error': str(exc)}
+            if key is not None:
+                self.cache.put(key, proba)
+            if shadow and shadow[0] is not None:
+                self.shadow_log.submit([admission_id], [proba], shadow)
+        return 200, {'admission_id': admission_id, 'proba': proba, 'prediction': proba >= self.threshold}
+
+    async def dispatch(self, method, target, body):
+        path = target.split('?', 1)[0]
+        if path == '/predict':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            return await self.predict(body)
+        if path == '/health':
+            health = {'status': 'ok', 'model_version': self.bundle.model_version,
+                      'threshold': self.threshold, 'queue': self.batcher.queue.qsize(), **self.batcher.stats}
+            if self.cache is not None:
+                health['cache'] = self.cache.info()
+            if self.shadow is not None:
+                health['shadow'] = dict(self.shadow_log.stats(), model_version=self.shadow.model_version)
+            return 200, health
+        return 404, {'error': 'not found'}
+
+    async def handle(self, reader, writer):
+        # HTTP/1.1 with keep-alive, just enough for JSON requests
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                try:
+                    method, target, version = lines[0].split(' ', 2)
+                    headers = dict((name.strip().lower(), value.strip())
+                                   for name, value in (line.split(':', 1) for line in lines[1:] if line))
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    await self._respond(writer, 400, {'error': 'malformed request'}, False)
+                    break
+                if length > MAX_BODY:
+                    await self._respond(writer, 413, {'error': 'body too large'}, False)
+                    break
+                try:
+                    body = await reader.readexactly(length)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                status, payload = await self.dispatch(method, target, body)
+                await self._respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode()
+        head = ['HTTP/1.1 %d %s' % (status, _REASONS[status]),
+                'Content-Type: application/json',
+                'Content-Length: %d' % len(body),
+                'Connection: %s' % ('keep-alive' if keep_alive else 'close')]
+        if status == 503:
+            head.append('Retry-After: 1')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+        await writer.drain()
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        self.batcher = MicroBatcher(self._score, **self.batcher_args)
+        batching = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        print('serving model %s on %s:%d' % (self.bundle.model_version, host, port), file=sys.stderr, flush=True)
+        async with server:
+            await stop.wait()
+        batching.cancel()
+        self.executor.shutdown(cancel_futures=True)
+        if self.cache is not None:
+            self.cache.close()
+        if self.shadow is not None:
+            self.shadow_log.close()
+            print('shadow: %s' % json.dumps(self.shadow_log.stats()), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-batching prediction server for a model bundle')
+    parser.add_argument('bundle', help='model bundle directory (serving.bundle)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='scoring processes, 0 scores in a thread of the server process')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0)
+    parser.add_argument('--max-queue', type=int, default=1024, help='queued requests before answering 503')
+    parser.add_argument('--threshold', type=float, default=None, help='default: the threshold of the bundle')
+    parser.add_argument('--mode', choices=['row', 'frame'], default='row',
+                        help='score batches in row mode or as DataFrames through the pipeline')
+    parser.add_argument('--cache-mb', type=float, default=0, help='prediction cache size, 0 disables it')
+    parser.add_argument('--cache-ttl', type=float, default=None, help='seconds a cached prediction stays valid')
+    parser.add_argument('--cache-path', default=None, help='SQLite file to keep the cache in across restarts')
+    parser.add_argument('--validate', action='store_true',
+                        help='check observations (serving.validation) and reject invalid ones with 422')
+    parser.add_argument('--shadow', default=None, help='model bundle to score every batch with as well, off the response')
+    parser.add_argument('--shadow-log', default=None, help='csv for the shadow probabilities (default: none, /health only)')
+    args = parser.parse_args(argv)
+
+    server = PredictionServer(args.bundle, workers=args.workers, max_batch=args.max_batch,
+                              max_wait=args.max_wait_ms / 1000, max_queue=args.max_queue,
+                              threshold=args.threshold, mode=args.mode, cache_bytes=int(args.cache_mb * (1 << 20)),
+                              cache_ttl=args.cache_ttl, cache_path=args.cache_path, validate=args.validate,
+                              shadow=args.shadow, shadow_log=args.shadow_log)
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
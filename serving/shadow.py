@@ -0,0 +1,182 @@
+import csv
+import queue
+import sys
+import threading
+
+import numpy as np
+
+
+# Shadow scoring: a primary and a shadow deployment pipeline on the same
+# observations, with the work they have in common done once.
+#
+#   shadow = ShadowPipeline(primary_pipeline, shadow_pipeline)
+#   primary_proba, shadow_proba = shadow.predict_proba(df)
+#   log = ShadowLog('shadow.csv', primary_threshold=0.31, shadow_threshold=0.35)
+#   log.submit(df.index, primary_proba, shadow_proba)    # returns at once
+#   log.stats()                                          # agreement so far
+#   log.close()
+#
+# Both pipelines have the deployment layout (ColumnConverter -> custom_oe ->
+# SelectColumns -> ColumnTransformer -> model). Their leading stateless steps
+# are computed once when one step's output serves both:
+# - the same step, or equal stateless steps of the same class;
+# - the ColumnConverters of the initial deployment and of the redeploy (same
+#   lean mode), whose outputs only differ by the diag_*_risk columns the
+#   redeploy adds; its output goes to both, the initial SelectColumns never
+#   reads the extra columns;
+# - custom_oe of both, whose mappings agree on the columns they share; the one
+#   with more columns encodes for both.
+# From the first step that differs on, each pipeline runs its own steps on
+# the shared, encoded frame. With the notebook pipelines that is SelectColumns,
+# the ColumnTransformer and the model, so scoring both costs one conversion
+# plus the two branches.
+#
+# ShadowLog takes the results off the caller's path: submit() only puts them
+# on a queue, a background thread appends them to a CSV file (admission_id,
+# primary, shadow) and updates the agreement statistics (predictions at the
+# two thresholds, differences and correlation of the probabilities).
+
+_CONVERTERS = _ENCODERS = None
+
+
+def _step_classes():
+    # the converter and encoder classes, imported (with scikit-learn) when first
+    # compared, so importing this module stays cheap for servers without --shadow
+    global _CONVERTERS, _ENCODERS
+    if _CONVERTERS is None:
+        from custom_transformers import preprocessor, preprocessor_redeploy
+        from custom_transformers import custom_ordinal_encoder, custom_ordinal_encoder_redeploy
+        _CONVERTERS = (preprocessor.ColumnConverter, preprocessor_redeploy.ColumnConverter)
+        _ENCODERS = (custom_ordinal_encoder.custom_oe, custom_ordinal_encoder_redeploy.custom_oe)
+    return _CONVERTERS, _ENCODERS
+
+
+def _mapping(encoder):
+    # the mapping custom_oe encodes with lives next to it, as for row mode
+    return {m['col']: dict(m['mapping']) for m in sys.modules[type(encoder).__module__].mapping}
+
+
+def shared_step(a, b):
+    # the step whose output serves as the output of both a and b, None if there is none
+    if a is b:
+        return a
+    from custom_transformers.cache import is_stateless
+    if not (is_stateless(a) and is_stateless(b)):
+        return None
+    if type(a) is type(b) and a.get_params() == b.get_params():
+        return a
+    converters, encoders = _step_classes()
+    if isinstance(a, converters) and isinstance(b, converters):
+        if getattr(a, 'lean', False) != getattr(b, 'lean', False):
+            return None
+        # the redeploy converter is the second one
+        risk_a, risk_b = isinstance(a, converters[1]), isinstance(b, converters[1])
+        if risk_a and risk_b:
+            return a if getattr(a, 'risk_table', None) == getattr(b, 'risk_table', None) else None
+        return a if risk_a else b
+    if isinstance(a, encoders) and isinstance(b, encoders):
+        mapping_a, mapping_b = _mapping(a), _mapping(b)
+        if any(mapping_a[col] != mapping_b[col] for col in set(mapping_a) & set(mapping_b)):
+            return None
+        if set(mapping_b) <= set(mapping_a):
+            return a
+        if set(mapping_a) <= set(mapping_b):
+            return b
+    return None
+
+
+class ShadowPipeline:
+    def __init__(self, primary, shadow):
+        self.primary = primary
+        self.shadow = shadow
+        self.shared = []
+        for (_, a), (_, b) in zip(primary.steps[:-1], shadow.steps[:-1]):
+            step = shared_step(a, b)
+            if step is None:
+                break
+            self.shared.append(step)
+
+    def transform(self, df):
+        # the output of the shared steps
+        for step in self.shared:
+            df = step.transform(df)
+        return df
+
+    def predict_proba(self, df):
+        # probabilities of readmission of the primary and of the shadow pipeline
+        shared = self.transform(df)
+        n = len(self.shared)
+        return self.primary[n:].predict_proba(shared)[:, 1], self.shadow[n:].predict_proba(shared)[:, 1]
+
+
+class ShadowLog:
+    def __init__(self, path=None, primary_threshold=0.5, shadow_threshold=0.5, max_queue=1024):
+        self.path = path
+        self.primary_threshold = primary_threshold
+        self.shadow_threshold = shadow_threshold
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        # rows, both positive, primary only, shadow only, |difference|, difference and the sums of the correlation
+        self._counts = np.zeros(4, dtype=np.int64)
+        self._sums = np.zeros(7)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name='shadow-log', daemon=True)
+        self._thread.start()
+
+    def submit(self, admission_ids, primary, shadow):
+        # never blocks the caller: a full queue drops the batch (counted in stats()['dropped'])
+        try:
+            self._queue.put_nowait((list(admission_ids), np.asarray(primary, dtype=np.float64),
+                                    np.asarray(shadow, dtype=np.float64)))
+        except queue.Full:
+            with self._lock:
+                self.dropped += len(primary)
+
+    def _run(self):
+        fh = None if self.path is None else open(self.path, 'w', newline='')
+        writer = None if fh is None else csv.writer(fh)
+        if writer is not None:
+            writer.writerow(['admission_id', 'primary', 'shadow'])
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                admission_ids, primary, shadow = item
+                scored = ~(np.isnan(primary) | np.isnan(shadow))
+                self._update(primary[scored], shadow[scored])
+                if writer is not None:
+                    writer.writerows(zip(admission_ids, primary.tolist(), shadow.tolist()))
+        finally:
+            if fh is not None:
+                fh.close()
+
+    def _update(self, primary, shadow):
+        positive_p, positive_s = primary >= self.primary_threshold, shadow >= self.shadow_threshold
+        diff = shadow - primary
+        with self._lock:
+            self._counts += [len(primary), (positive_p & positive_s).sum(), (positive_p & ~positive_s).sum(),
+                             (~positive_p & positive_s).sum()]
+            self._sums += [np.abs(diff).sum(), diff.sum(), primary.sum(), shadow.sum(),
+                           (primary ** 2).sum(), (shadow ** 2).sum(), (primary * shadow).sum()]
+
+    def stats(self):
+        with self._lock:
+            (rows, both, primary_only, shadow_only), sums, dropped = self._counts.tolist(), self._sums.copy(), \
+                self.dropped
+        stats = {'rows': rows, 'dropped': dropped, 'both_positive': both, 'primary_only': primary_only,
+                 'shadow_only': shadow_only, 'both_negative': rows - both - primary_only - shadow_only}
+        if rows:
+            abs_diff, diff, sp, ss, spp, sss, sps = sums / rows
+            var_p, var_s = spp - sp ** 2, sss - ss ** 2
+            stats.update(agreement=1 - (primary_only + shadow_only) / rows,
+                         primary_positive_rate=(both + primary_only) / rows,
+                         shadow_positive_rate=(both + shadow_only) / rows,
+                         mean_abs_diff=abs_diff, mean_diff=diff,
+                         correlation=(sps - sp * ss) / np.sqrt(var_p * var_s) if var_p > 0 and var_s > 0 else None)
+        return stats
+
+    def close(self):
+        # waits until everything submitted is written
+        self._queue.put(None)
+        self._thread.join()
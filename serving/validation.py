@@ -0,0 +1,275 @@
+import json
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
+
+from custom_transformers import compiled_converter as cc
+from custom_transformers.icd9_index import normalize as icd9_code
+
+
+# Columnar validation of a batch of observations before the pipeline, so one
+# malformed row is rejected on its own instead of failing (or being quietly
+# turned into 'unknown' in) the whole batch:
+#
+#   validator = Validator()                      # compiles SCHEMA once
+#   result = validator.validate(df)              # raw observations, as batch_score / bundle.frame build them
+#   result.valid                                 # boolean array of the rows to score
+#   result.errors                                # boolean error mask per field
+#   result.report()                              # {'rows': ..., 'invalid': ..., 'fields': {field: counts and examples}}
+#   result.rejections()                          # [{'index': ..., 'errors': {field: reason}}] of the invalid rows
+#   validator.validate_records(observations)     # the same for a list of observation dicts
+#
+# SCHEMA covers every raw field ColumnConverter reads (both deployments), with
+# the vocabularies of compiled_converter: a field is a number (with a range,
+# integer or not, or a list of allowed codes), a flag (booleans or 0/1), a
+# label (a string whose value, normalized the way the converter does, must be
+# one of values; the placeholders of the training data such as '?' or 'None'
+# are allowed), free text or a diagnosis (an ICD-9 shaped code, see
+# custom_transformers.icd9_index). Missing values are allowed where the
+# pipeline imputes them, a column absent from the batch is missing everywhere.
+#
+# Every field is checked in one pass: object and categorical columns are
+# factorized and only their distinct values are checked (memoized per field,
+# like the lookup tables of compiled_converter), numeric columns are checked
+# with array comparisons. The result per row and field is one of REASONS.
+
+OK, MISSING, TYPE, RANGE, VOCABULARY = range(5)
+REASONS = ['ok', 'missing', 'type', 'range', 'vocabulary']
+
+_count = {'kind': 'number', 'min': 0, 'max': 1000, 'integer': True}
+
+payer_codes = ['MC', 'MD', 'HM', 'UN', 'BC', 'SP', 'CP', 'SI', 'DM', 'CM', 'CH', 'PO', 'WC', 'OT', 'OG', 'MP', 'FR']
+
+SCHEMA = {
+    'time_in_hospital': dict(_count, min=1, max=365),
+    'num_lab_procedures': _count,
+    'num_procedures': _count,
+    'num_medications': _count,
+    'number_outpatient': _count,
+    'number_emergency': _count,
+    'number_inpatient': _count,
+    'number_diagnoses': _count,
+    'hemoglobin_level': {'kind': 'number', 'min': 0, 'max': 30},
+    # the ids of the admission tables of the original dataset, unmapped ones end up 'unknown'
+    'admission_type_code': {'kind': 'number', 'values': list(range(1, 9))},
+    'admission_source_code': {'kind': 'number', 'values': list(range(1, 27))},
+    'discharge_disposition_code': {'kind': 'number', 'values': list(range(1, 31))},
+    'has_prosthesis': {'kind': 'flag'},
+    'blood_transfusion': {'kind': 'flag'},
+    'diuretics': {'kind': 'label', 'normalize': 'lower', 'values': ['yes', 'no']},
+    'insulin': {'kind': 'label', 'normalize': 'lower', 'values': ['yes', 'no']},
+    'change': {'kind': 'label', 'normalize': 'lower', 'values': ['ch', 'no']},
+    'diabetesMed': {'kind': 'label', 'normalize': 'lower', 'values': ['yes', 'no']},
+    'complete_vaccination_status': {'kind': 'label', 'normalize': 'lower', 'values': ['complete', 'incomplete']},
+    'age': {'kind': 'label', 'normalize': 'bin', 'values': cc.ordered_age[1:] + ['100-110', '?']},
+    'weight': {'kind': 'label', 'normalize': 'bin', 'values': cc.ordered_weight[1:] + ['?']},
+    'max_glu_serum': {'kind': 'label', 'normalize': 'lower', 'values': cc.ordered_max_glu[1:] + ['none']},
+    'A1Cresult': {'kind': 'label', 'normalize': 'lower', 'values': cc.ordered_A1C[1:] + ['none']},
+    'gender': {'kind': 'label', 'normalize': 'lower', 'values': ['male', 'female', 'unknown/invalid']},
+    'race': {'kind': 'label', 'normalize': 'prefix', 'values': list(cc.race_groups) + ['oth', '?']},
+    'blood_type': {'kind': 'label', 'normalize': 'lower', 'values': cc.blood_types + ['unknown']},
+    'payer_code': {'kind': 'label', 'values': payer_codes + ['?']},
+    # rare specialties are 'other' by design
+    'medical_specialty': {'kind': 'text'},
+    'diag_1': {'kind': 'diagnosis'},
+    'diag_2': {'kind': 'diagnosis'},
+    'diag_3': {'kind': 'diagnosis'},
+}
+
+_normalizers = {
+    None: lambda value: value,
+    'lower': str.lower,
+    'bin': lambda value: value.lower().lstrip('[').rstrip(')'),
+    'prefix': lambda value: value.lower().lstrip()[0:3],
+}
+
+
+def _number(value):
+    # float of a raw value as astype('float64') reads it, None if it is not a number
+    if isinstance(value, (bool, np.bool_)):
+        return None
+    if isinstance(value, (int, float, np.number)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+def _check_numbers(values, spec):
+    # reasons of an array of floats (NaN missing)
+    reasons = np.zeros(len(values), dtype=np.int8)
+    present = ~np.isnan(values)
+    bad = np.zeros(len(values), dtype=bool)
+    if 'min' in spec:
+        bad |= values < spec['min']
+    if 'max' in spec:
+        bad |= values > spec['max']
+    if spec.get('integer'):
+        bad |= values != np.floor(values)
+    reasons[present & bad] = RANGE
+    if 'values' in spec:
+        reasons[present & ~bad & ~np.isin(values, spec['values'])] = VOCABULARY
+    reasons[~present] = OK if spec.get('nullable', True) else MISSING
+    return reasons
+
+
+def _value_rule(spec):
+    # raw value -> reason, for the distinct values of object and categorical columns
+    kind = spec['kind']
+    if kind == 'number':
+        low, high, values = spec.get('min', -np.inf), spec.get('max', np.inf), spec.get('values')
+
+        def rule(value):
+            number = _number(value)
+            if number is None:
+                return TYPE
+            if number != number:
+                return OK if spec.get('nullable', True) else MISSING
+            if not low <= number <= high or (spec.get('integer') and number != int(number)):
+                return RANGE
+            return OK if values is None or number in values else VOCABULARY
+    elif kind == 'flag':
+        def rule(value):
+            if isinstance(value, (bool, np.bool_)):
+                return OK
+            number = _number(value) if not isinstance(value, str) else None
+            if number is None:
+                return TYPE
+            return OK if number in (0, 1) else RANGE
+    elif kind == 'label':
+        normalize, values = _normalizers[spec.get('normalize')], set(spec['values'])
+
+        def rule(value):
+            if not isinstance(value, str):
+                return TYPE
+            return OK if normalize(value) in values else VOCABULARY
+    elif kind == 'text':
+        def rule(value):
+            return OK if isinstance(value, str) else TYPE
+    elif kind == 'diagnosis':
+        def rule(value):
+            if not isinstance(value, str):
+                return TYPE
+            return OK if value == '?' or icd9_code(value) is not None else VOCABULARY
+    else:
+        raise ValueError('unknown field kind %r' % kind)
+    return rule
+
+
+class _FieldCheck:
+    def __init__(self, spec):
+        self.spec = spec
+        self.rule = _value_rule(spec)
+        self.missing = OK if spec.get('nullable', True) else MISSING
+        self.memo = {}
+
+    def reason(self, value):
+        # memoized rule, keyed with the type too: True == 1 but only 1 is a number
+        key = (type(value), value)
+        try:
+            return self.memo[key]
+        except KeyError:
+            pass
+        except TypeError:
+            return self.rule(value)
+        if len(self.memo) > 100000:
+            self.memo.clear()
+        reason = self.memo[key] = self.rule(value)
+        return reason
+
+    def __call__(self, series):
+        if is_numeric_dtype(series.dtype) and not is_bool_dtype(series.dtype):
+            if self.spec['kind'] == 'number':
+                return _check_numbers(series.to_numpy(dtype=np.float64), self.spec)
+            if self.spec['kind'] == 'flag':
+                values = series.to_numpy(dtype=np.float64)
+                reasons = np.where(np.isin(values, [0, 1]), OK, RANGE).astype(np.int8)
+                reasons[np.isnan(values)] = self.missing
+                return reasons
+        if is_bool_dtype(series.dtype) and self.spec['kind'] != 'flag':
+            return np.full(len(series), TYPE, dtype=np.int8)
+        codes, uniques, _, _ = cc._factorize(series)
+        # code -1 (missing) indexes the extra last slot
+        table = np.array([self.reason(value) for value in uniques] + [self.missing], dtype=np.int8)
+        return table[codes]
+
+    def values(self, values):
+        # reasons of a list of raw values (None and NaN missing)
+        return [self.missing if value is None or value != value else self.reason(value) for value in values]
+
+
+class Validator:
+    def __init__(self, schema=None):
+        self.schema = SCHEMA if schema is None else schema
+        self._checks = {field: _FieldCheck(spec) for field, spec in self.schema.items()}
+
+    def validate(self, df):
+        reasons = np.empty((len(df), len(self._checks)), dtype=np.int8)
+        for j, (field, check) in enumerate(self._checks.items()):
+            if field in df.columns:
+                reasons[:, j] = check(df[field])
+            else:
+                # missing in every row, which nullable fields allow (as validate_records does)
+                reasons[:, j] = check.missing
+        return Validation(list(self._checks), reasons, df.index,
+                          lambda field: df[field].to_numpy() if field in df.columns else None)
+
+    def validate_records(self, records):
+        # the same for a list of observation dicts (e.g. a micro batch), without building a
+        # DataFrame first; a field absent from a record is a missing value
+        reasons = np.array([check.values([record.get(field) for record in records])
+                            for field, check in self._checks.items()], dtype=np.int8).reshape(-1, len(records)).T
+        return Validation(list(self._checks), reasons, pd.RangeIndex(len(records)),
+                          lambda field: np.array([record.get(field) for record in records], dtype=object))
+
+
+class Validation:
+    def __init__(self, fields, reasons, index, column):
+        # column(field): the raw values of a field, for the examples of report()
+        self.fields = fields
+        self.reasons = reasons
+        self.index = index
+        self._column = column
+        self.valid = ~reasons.any(axis=1)
+
+    @property
+    def errors(self):
+        return pd.DataFrame(self.reasons > 0, index=self.index, columns=self.fields)
+
+    def report(self, examples=3):
+        # counts per field and reason and the first few distinct offending values, for fields with errors
+        fields = {}
+        for j in np.flatnonzero(self.reasons.any(axis=0)):
+            field = self.fields[j]
+            counts = np.bincount(self.reasons[:, j], minlength=len(REASONS))
+            entry = {REASONS[reason]: int(counts[reason]) for reason in range(1, len(REASONS)) if counts[reason]}
+            column = self._column(field)
+            if column is not None:
+                bad = column[self.reasons[:, j] > 0]
+                entry['examples'] = [_jsonable(value) for value in pd.unique(bad)[:examples]]
+            fields[field] = entry
+        return {'rows': len(self.index), 'invalid': int((~self.valid).sum()), 'fields': fields}
+
+    def rejections(self):
+        # one entry per invalid row: its index label and the reason of every failing field
+        rows, cols = np.nonzero(self.reasons)
+        rejected = {}
+        for row, col in zip(rows, cols):
+            rejected.setdefault(row, {})[self.fields[col]] = REASONS[self.reasons[row, col]]
+        return [{'index': _jsonable(self.index[row]), 'errors': errors} for row, errors in rejected.items()]
+
+
+def _jsonable(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    try:
+        json.dumps(value)
+    except TypeError:
+        return repr(value)
+    return value